@@ -75,6 +75,9 @@ def arguments():
     parser.add_argument("--sample-file", type=str, default=None, help="Sample file")
     parser.add_argument("--frame-stride", type=str, default=8, help="Stride to sample")
     parser.add_argument("--num-cond-frames", type=int, default=None)
+    parser.add_argument("--media-writers", type=int, default=4, help="Number of background processes encoding the generated videos, 0 to write synchronously")
+    parser.add_argument("--gt-store", type=str, default=None, help="Directory of the ground truth artifacts shared by all runs, linked into the test directory")
+    parser.add_argument("--raw-output", type=str, default="none", choices=["none", "both", "only"], help="Additionally (both) or exclusively (only) save the results as lossless uint8 frames for the evaluation")
     args = parser.parse_args()
     
     args.machine = args.machine if args.machine is not None else socket.gethostname()
@@ -215,6 +218,9 @@ def format_config_file(
         sample_file: str = None,
         frame_stride: int = 8,
         num_cond_frames: int = None,
+        media_writers: int = 4,
+        raw_output: str = "none",
+        gt_store: str = None,
 ):
     """
     Load and modify the YAML configuration file for evaluation.
@@ -244,6 +250,9 @@ def format_config_file(
         sample_file (str, optional): Path to a sample file. Defaults to None.
         frame_stride (int, optional): Frame stride for sampling. Defaults to 8.
         num_cond_frames (int, optional): Number of additional conditioning frames. Defaults to None.
+        media_writers (int, optional): Number of background writer processes of the image logger. Defaults to 4.
+        raw_output (str, optional): Lossless uint8 output of the test results, "none", "both" (raw and videos) or "only". Defaults to "none".
+        gt_store (str, optional): Directory of the shared ground truth artifacts. Defaults to None (written per run).
 
     Returns:
         dict: Modified configuration dictionary with updated evaluation settings.
@@ -315,6 +324,10 @@ def format_config_file(
                 "num_val_batches": -1,
                 "save_suffix": '',
                 "log_all_gpus": True,
+                "media_writer_workers": media_writers,
+                "raw_output": raw_output != "none",
+                "save_videos": raw_output != "only",
+                "gt_store": str(Path(gt_store).resolve()) if gt_store is not None else None,
                 "log_images_kwargs":
                     {
                         "ddim_steps": 25,
@@ -569,7 +582,10 @@ def main():
         context_sampling_strategy = args.sstrat,
         sample_file=args.sample_file,
         frame_stride = args.frame_stride,
-        num_cond_frames = args.num_cond_frames
+        num_cond_frames = args.num_cond_frames,
+        media_writers = args.media_writers,
+        raw_output = args.raw_output,
+        gt_store = args.gt_store,
     )
 
     write_exp_meta_file(
@@ -20,12 +20,16 @@ import time
 from datetime import datetime
 import pandas as pd
 import traceback
+import hashlib
 
 from einops import rearrange
 
-from torchmetrics.image import StructuralSimilarityIndexMeasure, LearnedPerceptualImagePatchSimilarity
-
 from utils.evaluation import *
+from utils.frame_metrics import stream_frame_metrics, summarize_frame_metrics
+from utils.fvd_bank import FVDFeatureBank
+from utils.raw_store import RAW_DIRECTORY, open_raw_store
+from utils.pose_evaluation import run_pose_evaluation, metric, compute_camera_poses
+from utils.result_store import DEFAULT_RESULT_DB, ResultStore, hash_files
 
 DEFAULT_EVALUATION_FILE = "results/evaluation.csv"
 
@@ -33,7 +37,7 @@ DEFAULT_EVALUATION_FILE = "results/evaluation.csv"
 #################### FVD Computation ######################
 ###########################################################
 
-def get_video_path_pairs(path: str):
+def get_video_path_pairs(path: str, raw_store=None):
     """
     Generate pairs of ground truth and generated video file paths from directories.
 
@@ -43,23 +47,24 @@ def get_video_path_pairs(path: str):
 
     Args:
         path (str): The path to the directory containing video subdirectories.
+        raw_store (RawSampleStore, optional): Raw test results, samples contained in it do not require the videos.
 
     Yields:
         tuple[str, str]: A tuple containing the ground truth video path and the generated video path.
     """
     path = Path(path)
 
-    video_dirs = sorted([p for p in path.iterdir() if p.is_dir()])
+    video_dirs = sorted([p for p in path.iterdir() if p.is_dir() and p.name != RAW_DIRECTORY])
     for dir in video_dirs:
         gt_file = dir / "ground_truth.mp4"
         gen_file = dir / "generated.mp4"
 
-        if gt_file.exists() and gen_file.exists():
+        if (gt_file.exists() and gen_file.exists()) or (raw_store is not None and dir.name in raw_store):
             yield (str(gt_file), str(gen_file))
         else:
             print(f"Missing ground truth or generated video for {dir}")
 
-def load_videos(paths, desc):
+def load_videos(paths, desc, raw_store=None):
     """
     Load videos from the provided file paths and stack them into a tensor.
 
@@ -69,12 +74,37 @@ def load_videos(paths, desc):
     Args:
         paths (iterable): An iterable of video file paths.
         desc (str): A description string (unused in this implementation).
+        raw_store (RawSampleStore, optional): Raw test results, videos contained in it are read from the store.
 
     Returns:
         torch.Tensor: A tensor containing all loaded videos.
     """
     from fvdcal.video_preprocess import load_video
-    return torch.stack([load_video(path, num_frames=None) for path in paths])
+
+    def load(path):
+        raw = raw_store.resolve(path) if raw_store is not None else None
+        if raw is not None:
+            # uint8 frames, scaled to the [0, 1] range of load_video
+            return torch.from_numpy(raw_store.frames(*raw)).permute(0, 3, 1, 2).float() / 255.0  # T,C,H,W
+        return load_video(path, num_frames=None)
+    return torch.stack([load(path) for path in paths])
+
+def input_hash(paths, raw_store=None) -> str:
+    """
+    Content hash of the inputs of a sample, used to detect stale results in the result store.
+
+    Args:
+        paths (iterable): Input files of the sample, missing files are ignored.
+        raw_store (RawSampleStore, optional): Raw test results, videos contained in it are hashed by their frames.
+
+    Returns:
+        str: sha1 over the content hashes of the inputs.
+    """
+    hashes = []
+    for path in paths:
+        raw = raw_store.resolve(path) if raw_store is not None else None
+        hashes.append(raw_store.content_hash(*raw) if raw is not None else hash_files(path))
+    return hashlib.sha1(":".join(hashes).encode()).hexdigest()
 
 def fvd(
         path, 
@@ -82,7 +112,12 @@ def fvd(
         max_videos_per_batch: int = None, 
         max_videos: int = None,
         sample_list: str = None,
-        model_path: str = "ckpts"
+        model_path: str = "ckpts",
+        feature_bank: str = None,
+        raw_store=None,
+        result_store: ResultStore = None,
+        run: str = None,
+        resume: bool = True,
         ):
     """
     Compute the FVD (Fréchet Video Distance) scores for videos in a directory.
@@ -98,6 +133,12 @@ def fvd(
         max_videos (int, optional): Maximum number of videos to evaluate.
         sample_list (str, optional): Path to a file containing a list of samples to include.
         model_path (str, optional): Path to the model directory. Defaults to "ckpts".
+        feature_bank (str, optional): Directory of a persistent feature bank. If given, the ground truth features and
+            statistics are cached across runs and every video is decoded once for both methods.
+        raw_store (RawSampleStore, optional): Raw test results, read instead of the videos. Requires feature_bank.
+        result_store (ResultStore, optional): Store of the scores, stored scores of the same videos are reused.
+        run (str, optional): Run name in the result store.
+        resume (bool, optional): Reuse stored scores. Defaults to True.
 
     Returns:
         tuple[float, float]: FVD scores computed using the 'videogpt' and 'stylegan' methods.
@@ -105,11 +146,7 @@ def fvd(
     from fvdcal import FVDCalculation, FVDCalculation2
     print(colored("Starting FVD evaluation...", "green"))
 
-    fvd_videogpt_calculator = FVDCalculation2(method="videogpt", batch_size=max_videos_per_batch)
-    fvd_stylegan_calculator = FVDCalculation2(method="stylegan", batch_size=max_videos_per_batch)
-    #model_path = "src/evaluation/FVD/model"
-
-    video_list = list(get_video_path_pairs(path))
+    video_list = list(get_video_path_pairs(path, raw_store))
     if sample_list is not None:
         with open(sample_list, "r") as f:
             valid_sample_list = [line.strip() for line in f.readlines()]
@@ -118,6 +155,8 @@ def fvd(
             if str(Path(gt_path).parent.stem) in valid_sample_list:
                 video_list_subsample.append((gt_path, gen_path))
         video_list = video_list_subsample
+    if feature_bank is None and not all(os.path.exists(p) for v in video_list for p in v):
+        raise ValueError("FVD of raw-only results requires a feature bank (--fvd-bank)")
     if max_videos is not None:
         video_list = video_list[:min(len(video_list), max_videos)]
 
@@ -126,17 +165,38 @@ def fvd(
     
     print(f"Found {len(video_list)} videos to evaluate!")
 
-    fvd_videogpt = fvd_videogpt_calculator(video_list_gt, video_list_gen, model_path=model_path)
-    fvd_stylegan = fvd_stylegan_calculator(video_list_gt, video_list_gen, model_path=model_path)
+    # FVD is a set metric, it is stored as a single sample keyed by the content of all videos
+    if result_store is not None:
+        stage, sample = "fvd", "__all__"
+        sample_hash = input_hash([p for v in video_list for p in v], raw_store)
+        if resume and sample in result_store.completed(run, stage, {sample: sample_hash}):
+            values = result_store.values(run, stage, [sample])
+            print(colored("FVD scores of these videos found in the result store", "green"))
+            return values["videogpt"][sample], values["stylegan"][sample]
+
+    if feature_bank is not None:
+        bank = FVDFeatureBank(feature_bank, model_path=model_path, raw_store=raw_store)
+        scores = bank.fvd(video_list_gt, video_list_gen, batch_size=max_videos_per_batch)
+        print(f"Feature bank: {bank.hits} cached, {bank.misses} embedded videos")
+        fvd_videogpt, fvd_stylegan = scores["videogpt"], scores["stylegan"]
+    else:
+        fvd_videogpt_calculator = FVDCalculation2(method="videogpt", batch_size=max_videos_per_batch)
+        fvd_stylegan_calculator = FVDCalculation2(method="stylegan", batch_size=max_videos_per_batch)
+        #model_path = "src/evaluation/FVD/model"
+        fvd_videogpt = fvd_videogpt_calculator(video_list_gt, video_list_gen, model_path=model_path).item()
+        fvd_stylegan = fvd_stylegan_calculator(video_list_gt, video_list_gen, model_path=model_path).item()
 
     print(colored("FVD evaluation finished!", "green"))
+    if result_store is not None:
+        result_store.put_sample(run, stage, sample, sample_hash, {"videogpt": fvd_videogpt, "stylegan": fvd_stylegan,
+                                                                  "num_videos": len(video_list)})
 
     save_dict = {
         "image_path": path,
         "num_videos": len(video_list),
         "output_path": output,
-        "fvd_videogpt": fvd_videogpt.item(),
-        "fvd_stylegan": fvd_stylegan.item(),
+        "fvd_videogpt": fvd_videogpt,
+        "fvd_stylegan": fvd_stylegan,
         "time": datetime.now().strftime("%Y-%m-%d %H:%M:%S")
     }
 
@@ -144,160 +204,12 @@ def fvd(
     with open(out_file, "w") as file:
         yaml.safe_dump(save_dict, file, default_flow_style=False, sort_keys=False)
 
-    return fvd_videogpt.item(), fvd_stylegan.item()
+    return fvd_videogpt, fvd_stylegan
 
 ###########################################################
 ################ Camera Pose Evaluation ###################
 ###########################################################
 
-def compute_camera_poses(img_dir: str, pose_dir: str, f: float, cx: float, cy: float, use_colmap=False, suppress_output: bool = False) -> tuple:
-    """
-    Compute relative camera poses from video frames using COLMAP or GLOMAP.
-
-    This function extracts frames from a video and computes camera poses by running
-    feature extraction, matching, and mapping commands. It then converts the results
-    to obtain the relative camera-to-world transformation.
-
-    Args:
-        img_dir (str): Directory where extracted video frames are stored.
-        pose_dir (str): Directory to store pose estimation results.
-        f (float): Focal length.
-        cx (float): Principal point x-coordinate.
-        cy (float): Principal point y-coordinate.
-        use_colmap (bool, optional): Whether to use COLMAP instead of GLOMAP. Defaults to False.
-        suppress_output (bool, optional): If True, suppresses command output messages. Defaults to False.
-
-    Returns:
-        tuple: The computed relative camera pose transformation.
-    """
-    def convert(config: dict) -> list[str]:
-        return sum([[f"--{k}", f"{v}"] for k, v in config.items()], [])
-    
-    def run_command(cmd):
-        if not suppress_output:
-            print(colored("Running: ", "yellow") + " ".join(cmd))
-        result = subprocess.run(cmd, shell=False)
-        if result.returncode != 0:
-            error_message = result.stderr.decode("utf-8")
-            print(colored("Error:", "red"), error_message)
-            return False
-        return True
-
-    model_dir = f"{pose_dir}/model"
-    os.makedirs(model_dir, exist_ok=True)
-
-    db_path = f"{pose_dir}/database.db"
-
-    if os.path.exists(db_path):
-        os.remove(db_path)
-
-    config = {
-        "feature_extractor": {
-            "database_path": db_path,
-            "image_path": img_dir,
-            "ImageReader.single_camera": 1,
-            "ImageReader.camera_model": "SIMPLE_PINHOLE",
-            "ImageReader.camera_params": f"{f},{cx},{cy}",
-            "SiftExtraction.estimate_affine_shape": 1,
-            "SiftExtraction.domain_size_pooling": 1,
-        },
-        "sequential_matcher": {
-            "database_path": db_path,
-            "SiftMatching.guided_matching": 1,
-            "SiftMatching.max_num_matches": 65536,
-        },
-        "mapper": {
-            "database_path": db_path,
-            "image_path": img_dir,
-            "output_path": model_dir,
-            "output_format": "txt",
-            "RelPoseEstimation.max_epipolar_error": 4,
-            "BundleAdjustment.optimize_intrinsics": 0,
-        },
-    }
-
-    if not run_command(["colmap", "feature_extractor"] + convert(config["feature_extractor"])):
-        return None
-    if not run_command(["colmap", "sequential_matcher"] + convert(config["sequential_matcher"])):
-        return None
-    if not run_command(["glomap" if not use_colmap else "colmap", "mapper"] + convert(config["mapper"])):
-        return None
-
-    write_depth_pose_from_colmap_format(f"{model_dir}/0", model_dir, ext=".txt")
-
-    w2c = rt34_to_44(get_rt(f"{model_dir}/poses"))
-    c2w = w2c.inverse()
-    rel_c2w = relative_pose(c2w, mode="left")
-
-    return rel_c2w
-
-
-def calc_roterr(r1: Tensor, r2: Tensor) -> Tensor:  # N, 3, 3
-    """
-    Calculate the rotation error between two rotation matrices.
-
-    Args:
-        r1 (Tensor): First rotation matrix tensor of shape (N, 3, 3).
-        r2 (Tensor): Second rotation matrix tensor of shape (N, 3, 3).
-
-    Returns:
-        Tensor: The rotation error in radians.
-    """
-    return (((r1.transpose(-1, -2) @ r2).diagonal(dim1=-1, dim2=-2).sum(-1) - 1) / 2).clamp(-1, 1).acos()
-
-
-def calc_transerr(t1: Tensor, t2: Tensor) -> Tensor:  # N, 3
-    """
-    Calculate the translation error between two translation vectors.
-
-    Args:
-        t1 (Tensor): First translation vector tensor of shape (N, 3).
-        t2 (Tensor): Second translation vector tensor of shape (N, 3).
-
-    Returns:
-        Tensor: The Euclidean distance (L2 norm) between the two translation vectors.
-    """
-    return (t2 - t1).norm(p=2, dim=-1)
-
-
-def calc_cammc(rt1: Tensor, rt2: Tensor) -> Tensor:  # N, 3, 4
-    """
-    Calculate the camera metric error between two camera pose representations.
-
-    Args:
-        rt1 (Tensor): First camera pose tensor of shape (N, 3, 4).
-        rt2 (Tensor): Second camera pose tensor of shape (N, 3, 4).
-
-    Returns:
-        Tensor: The computed camera metric error.
-    """
-    return (rt2 - rt1).reshape(-1, 12).norm(p=2, dim=-1)
-
-def metric(c2w_1: Tensor, c2w_2: Tensor) -> tuple[float, float, float]:
-    """
-    Compute the overall error metrics between two sets of camera poses.
-
-    This function computes the total rotation error, translation error, and camera metric error 
-    between the provided camera-to-world transformation tensors.
-
-    Args:
-        c2w_1 (Tensor): First set of camera-to-world transformations of shape (N, 3, 4).
-        c2w_2 (Tensor): Second set of camera-to-world transformations of shape (N, 3, 4).
-
-    Returns:
-        tuple[float, float, float]: A tuple containing the rotation error, translation error, and camera metric error.
-    """
-    RotErr = calc_roterr(c2w_1[:, :3, :3], c2w_2[:, :3, :3]).sum().item()
-
-    c2w_1_rel = normalize_t(c2w_1, c2w_1)
-    c2w_2_rel = normalize_t(c2w_2, c2w_2)
-
-    TransErr = calc_transerr(c2w_1_rel[:, :3, 3], c2w_2_rel[:, :3, 3]).sum().item()
-    CamMC = calc_cammc(c2w_1_rel[:, :3, :4], c2w_2_rel[:, :3, :4]).sum().item()
-
-    return RotErr, TransErr, CamMC
-
-
 def camera_pose_evaluation(path,
                             output,
                             max_videos: int = None,
@@ -306,13 +218,27 @@ def camera_pose_evaluation(path,
                             trial_strategy: "Literal['average', 'best']" = "average",
                             sort_videos: bool = False,
                             sample_list: str = None,
+                            num_workers: int = None,
+                            threads_per_task: int = 4,
+                            timeout: float = None,
+                            retries: int = 1,
+                            early_stop_tol: float = None,
+                            min_trials: int = 2,
+                            raw_store=None,
+                            estimator: "Literal['sfm', 'fast']" = "sfm",
+                            image_format: str = "bmp",
+                            result_store: ResultStore = None,
+                            run: str = None,
+                            resume: bool = True,
+                            retry_failed: bool = False,
                             ) -> Tuple[float, float, float]:
     """
     Evaluate camera pose estimation errors for generated videos.
 
     This function computes camera pose errors by comparing estimated poses with ground truth 
     poses for each video directory in the specified path. It supports multiple trials per video 
-    and aggregates the errors using either an average or best strategy.
+    and aggregates the errors using either an average or best strategy. Videos are evaluated
+    concurrently, each in a private scratch directory below output/tmp.
 
     Args:
         path (str): Path to the directory containing video subdirectories.
@@ -323,17 +249,35 @@ def camera_pose_evaluation(path,
         trial_strategy (str, optional): Strategy to aggregate trials ("average" or "best"). Defaults to "average".
         sort_videos (bool, optional): If True, sorts the video directories. Defaults to False.
         sample_list (str, optional): Path to a file containing a list of samples to include.
+        num_workers (int, optional): Number of concurrent videos. Defaults to the number of cores / threads_per_task.
+        threads_per_task (int, optional): Number of threads of the colmap/glomap commands of a video. Defaults to 4.
+        timeout (float, optional): Timeout in seconds of every colmap/glomap command. Defaults to None.
+        retries (int, optional): Number of retries of a failed video. Defaults to 1.
+        early_stop_tol (float, optional): Skip the remaining trials of a video once the CamMC spread of at least
+            min_trials successful trials is within early_stop_tol of their mean. Defaults to None (run all trials).
+        min_trials (int, optional): Minimum number of successful trials before stopping early. Defaults to 2.
+        raw_store (RawSampleStore, optional): Raw test results, read instead of the generated videos.
+        estimator (str, optional): "sfm" runs colmap/glomap, "fast" the in-process screening estimator of
+            utils.fast_pose. Defaults to "sfm".
+        image_format (str, optional): Format of the frames extracted for colmap/glomap ("bmp", "png" or "jpg").
+            Defaults to "bmp".
+        result_store (ResultStore, optional): Store of the per-video results. Videos with stored results of the same
+            inputs and settings are skipped, the averages are computed over the stored results.
+        run (str, optional): Run name in the result store.
+        resume (bool, optional): Skip videos with stored results. Defaults to True.
+        retry_failed (bool, optional): Evaluate videos that failed in a previous run again instead of skipping them.
+            Defaults to False.
 
     Returns:
         Tuple[float, float, float]: Average rotation error, translation error, and camera metric error.
     """
     print("Starting camera pose evaluation...")
-    eval_paths = [p for p in Path(path).iterdir() if p.is_dir()]
+    eval_paths = [p for p in Path(path).iterdir() if p.is_dir() and p.name != RAW_DIRECTORY]
     if sort_videos:
         eval_paths = sorted(eval_paths, key=lambda x: str(Path(x).stem))
 
     tmp_dir = Path(output) / "tmp"
-    detail_eval_file = Path(output) / "camera_eval.yaml"
+    detail_eval_file = Path(output) / ("camera_eval.yaml" if estimator == "sfm" else f"camera_eval_{estimator}.yaml")
     if sample_list is not None:
         with open(sample_list, "r") as f:
             valid_sample_list = [line.strip() for line in f.readlines()]
@@ -348,95 +292,122 @@ def camera_pose_evaluation(path,
     
     os.makedirs(tmp_dir, exist_ok=True)
 
+    samples = [str(p.stem) for p in eval_paths]
+    todo = list(range(len(eval_paths)))
+    if result_store is not None:
+        if estimator == "fast":
+            stage = "pose[fast]"
+        else:
+            stage = f"pose[{'colmap' if use_colmap else 'glomap'},trials={trials_per_video},{trial_strategy}"
+            stage += f",tol={early_stop_tol},min={min_trials}]" if early_stop_tol is not None else "]"
+        hashes = {s: input_hash([p / "generated.mp4", p / "camera_data.npy"], raw_store) for s, p in zip(samples, eval_paths)}
+        done = result_store.completed(run, stage, hashes) if resume else set()
+        failed = result_store.failed(run, stage, hashes) & done
+        if retry_failed:
+            done -= failed
+        todo = [i for i, s in enumerate(samples) if s not in done]
+        if len(done) > 0:
+            print(f"Skipping {len(eval_paths) - len(todo)} videos with stored results")
+        if len(failed) > 0:
+            print(f"{'Retrying' if retry_failed else 'Skipping'} {len(failed)} videos that failed before")
+
+    def store_result(index, result):
+        if result_store is None:
+            return
+        sample = samples[todo[index]]
+        if result is None:
+            # recorded such that a resumed run does not spend the full retry budget on it again
+            result_store.put_failure(run, stage, sample, hashes[sample])
+            return
+        values = {k: v for k, v in result.items() if k in ("RotErr", "TransErr", "CamMC", "Trials", "Tracked") or k.startswith("Time")}
+        trials = {k: result[f"Trial{k}"] for k in ("RotErr", "TransErr", "CamMC") if f"Trial{k}" in result}
+        result_store.put_sample(run, stage, sample, hashes[sample], values, trials)
+
+    results = run_pose_evaluation(
+        [eval_paths[i] for i in todo],
+        tmp_dir,
+        num_workers=num_workers,
+        threads_per_task=threads_per_task,
+        retries=retries,
+        use_colmap=use_colmap,
+        trials_per_video=trials_per_video,
+        trial_strategy=trial_strategy,
+        timeout=timeout,
+        early_stop_tol=early_stop_tol,
+        min_trials=min_trials,
+        raw_store=raw_store,
+        estimator=estimator,
+        image_format=image_format,
+        on_result=store_result,
+    )
+
+    if result_store is not None:
+        # stored and new results of all videos
+        values = result_store.values(run, stage, samples)
+        trials = {k: result_store.trials(run, stage, k, samples) for k in ("RotErr", "TransErr", "CamMC")}
+        results = []
+        for sample in samples:
+            if sample not in values.get("CamMC", {}):
+                results.append(None)
+                continue
+            result = {k: v[sample] for k, v in values.items() if sample in v}
+            result.update({f"Trial{k}": v[sample] for k, v in trials.items() if sample in v})
+            results.append(result)
+
+    # aggregated in input order, independent of the completion order of the workers
     save_dict = {}
     rot_err_list = []
     trans_err_list = []
     cam_mc_list = []
-    for i, p in tqdm(enumerate(eval_paths), total=len(eval_paths)):
-        cam_data_file = p / "camera_data.npy"
-        video_file = p / "generated.mp4"
-        if not cam_data_file.exists():
-            print(f"Could not find camera data for {str(p.stem)}. Skipping...")
+    for p, result in zip(eval_paths, results):
+        if result is None:
             continue
-        try:
-            cam_data_gt = torch.from_numpy(np.load(cam_data_file)).float()
-            cam_data_gt = cam_data_gt[:, 1:] 
-            gt_w2c = cam_data_gt[:, 6:].reshape((-1, 3, 4))
-            gt_c2w = rt34_to_44(gt_w2c).inverse()
-            gt_rel_c2w = relative_pose(gt_c2w, mode="left")
-
-            img_dir = f"{tmp_dir}/img"
-            os.makedirs(img_dir, exist_ok=True)
-            get_frames(str(video_file), img_dir)
-
-            start = time.perf_counter()
-
-            fx, fy, cx, cy = cam_data_gt[0, :4]
-            trial_rot_err = []
-            trial_trans_err = []
-            trial_cam_mc = []
-            for _ in range(trials_per_video):
-                sample_rel_c2w = compute_camera_poses(img_dir, f"{tmp_dir}/pose", fx, cx, cy, use_colmap=use_colmap, suppress_output=True)
-                if sample_rel_c2w is None:
-                    continue
-                num_gen_imgs = sample_rel_c2w.shape[0]
-                gt_rel_c2w = relative_pose(gt_c2w[:num_gen_imgs], mode="left")
-                rot_err, trans_err, cam_mc = metric(gt_rel_c2w.float().clone(), sample_rel_c2w.float().clone())
-                trial_rot_err.append(rot_err)
-                trial_trans_err.append(trans_err)
-                trial_cam_mc.append(cam_mc)
-            if len(trial_cam_mc) == 0:
-                continue
-            elif len(trial_cam_mc) == 1:
-                rot_err, trans_err, cam_mc = trial_rot_err[0], trial_trans_err[0], trial_cam_mc[0]
-            else:
-                if trial_strategy == "average":
-                    rot_err, trans_err, cam_mc = np.mean(trial_rot_err), np.mean(trial_trans_err), np.mean(trial_cam_mc)
-                elif trial_strategy == "best":
-                    min_index = np.argmin(cam_mc)
-                    rot_err, trans_err, cam_mc = trial_rot_err[min_index], trial_trans_err[min_index], trial_cam_mc[min_index]
-                else:
-                    raise ValueError(f"Invalid trial strategy: {trial_strategy}")
-
-            end = time.perf_counter()
-
-            save_dict[str(p.stem)] = {
-                "RotErr": rot_err,
-                "TransErr": trans_err,
-                "CamMC": cam_mc,
-                "Time": end - start
-            }
-            rot_err_list.append(rot_err)
-            trans_err_list.append(trans_err)
-            cam_mc_list.append(cam_mc)
-        except Exception as e:
-            print(colored(f"Error processing '{str(p.stem)}': {str(e)}", "red"))
-            traceback.print_exc()
+        save_dict[str(p.stem)] = result
+        rot_err_list.append(result["RotErr"])
+        trans_err_list.append(result["TransErr"])
+        cam_mc_list.append(result["CamMC"])
 
     with open(detail_eval_file, "w") as file:
         yaml.dump(save_dict, file, default_flow_style=False, sort_keys=False)
-    print(colored(f"Camera pose evaluation finished!", "green"))
+    print(colored(f"Camera pose evaluation finished! ({len(save_dict)}/{len(eval_paths)} videos)", "green"))
+
+    # wall time per stage, summed over the videos
+    stage_times = {}
+    for result in save_dict.values():
+        for k, v in result.items():
+            if k.startswith("Time") and k != "Time":
+                stage_times[k[len("Time"):].lower()] = stage_times.get(k[len("Time"):].lower(), 0.0) + v
+    if len(stage_times) > 0:
+        print("Stage times: " + ", ".join(f"{stage} {seconds:.1f}s" for stage, seconds in stage_times.items()))
 
     return np.mean(rot_err_list), np.mean(trans_err_list), np.mean(cam_mc_list)
 
-def compute_extended_metrics(path, output, max_videos_per_batch=None, max_videos=None, sample_list=None):
+def compute_extended_metrics(path, output, max_videos_per_batch=None, max_videos=None, sample_list=None, frame_batch_size=256, raw_store=None,
+                             result_store: ResultStore = None, run: str = None, resume: bool = True):
     """
     Compute extended evaluation metrics for videos.
 
     This function calculates metrics such as MSE, RMSE, SSIM, and LPIPS for a set of video pairs.
-    Videos are loaded in batches and evaluated frame-by-frame, then the results are aggregated.
+    Videos are decoded in chunks, the frames of a chunk are evaluated in large batches and only
+    running sums per timestep are kept.
 
     Args:
         path (str): Path to the directory containing video subdirectories.
         output (str): Directory where detailed evaluation results will be saved.
-        max_videos_per_batch (int, optional): Maximum number of videos to process per batch.
+        max_videos_per_batch (int, optional): Maximum number of videos to decode at once. Defaults to 16.
         max_videos (int, optional): Maximum number of videos to evaluate.
         sample_list (str, optional): Path to a file containing a list of samples to include.
+        frame_batch_size (int, optional): Number of frames per metric call. Defaults to 256.
+        raw_store (RawSampleStore, optional): Raw test results, read instead of the videos.
+        result_store (ResultStore, optional): Store of the per-video and per-timestep values. Videos with stored
+            results of the same inputs are skipped, the metrics are computed over the stored values.
+        run (str, optional): Run name in the result store.
+        resume (bool, optional): Skip videos with stored results. Defaults to True.
 
     Returns:
         tuple: A tuple containing the total MSE, RMSE, average SSIM, and average LPIPS.
     """
-    video_list = list(get_video_path_pairs(path))
+    video_list = list(get_video_path_pairs(path, raw_store))
     if sample_list is not None:
         with open(sample_list, "r") as f:
             valid_sample_list = [line.strip() for line in f.readlines()]
@@ -448,72 +419,56 @@ def compute_extended_metrics(path, output, max_videos_per_batch=None, max_videos
     if max_videos:
         video_list = video_list[:min(len(video_list), max_videos)]
     print(f"Found {len(video_list)} videos to evaluate!")
-    if max_videos_per_batch is not None and len(video_list) > max_videos_per_batch:
-        video_list = [video_list[i:min(len(video_list), i + max_videos_per_batch)] for i in range(0, len(video_list), max_videos_per_batch)]
-    else:
-        video_list = [video_list]
-
-    ssim_eval = StructuralSimilarityIndexMeasure(data_range=255)
-    lpips_eval = LearnedPerceptualImagePatchSimilarity(net_type='squeeze')
-
-    mse_total_list = []
-    mse_per_timestep_list = []
-    ssim_list = []
-    lpips_list = []
-    ssim_per_timestep_list = []
-    lpips_per_timestep_list = []
-
-    for i, batch in tqdm(enumerate(video_list), total=len(video_list)):
-        video_gt_paths = [video[0] for video in batch]
-        video_gen_paths = [video[1] for video in batch]
-
-        gt_videos = load_videos(video_gt_paths, "loading real videos")
-        sample_videos = load_videos(video_gen_paths, "loading generated videos")
-
-        mse_total = torch.mean((gt_videos - sample_videos) ** 2)
-        mse_per_timestep = torch.mean((gt_videos - sample_videos) ** 2, dim=[i for i in range(sample_videos.dim()) if i != 1])
-
-        lpips_timestep_list = []
-        ssim_timestep_list = []
-        for t in range(sample_videos.shape[1]):
-            ssim_timestep_list.append(ssim_eval(sample_videos[:, t], gt_videos[:, t]))
-            lpips_timestep_list.append(lpips_eval(sample_videos[:, t], gt_videos[:, t]))
-
-        ssim = np.mean(ssim_timestep_list)
-        lpips = np.mean(lpips_timestep_list)
-
-        mse_total_list.append(mse_total.item())
-        mse_per_timestep_list.append(mse_per_timestep)
-
-        ssim_list.append(ssim)
-        lpips_list.append(lpips)
-        ssim_per_timestep_list.append(ssim_timestep_list)
-        lpips_per_timestep_list.append(lpips_timestep_list)
 
-    mse_total = float(np.mean(mse_total_list))
-    rmse = float(np.sqrt(mse_total))
-    mse_per_timestep = torch.mean(torch.stack(mse_per_timestep_list, dim=0), dim=0).tolist()
+    stage = "frame"
+    samples = [str(Path(gt_path).parent.stem) for gt_path, _ in video_list]
+    todo = video_list
+    if result_store is not None:
+        hashes = {s: input_hash(v, raw_store) for s, v in zip(samples, video_list)}
+        done = result_store.completed(run, stage, hashes) if resume else set()
+        todo = [v for s, v in zip(samples, video_list) if s not in done]
+        if len(done) > 0:
+            print(f"Skipping {len(video_list) - len(todo)} videos with stored results")
+
+    def store_chunk(pairs, values):
+        if result_store is None:
+            return
+        for i, (gt_path, _) in enumerate(pairs):
+            sample = str(Path(gt_path).parent.stem)
+            result_store.put_sample(run, stage, sample, hashes[sample],
+                                    {name: float(v[i].mean()) for name, v in values.items()},
+                                    trials={name: v[i].tolist() for name, v in values.items()})
+
+    save_dict = None
+    if len(todo) > 0 or result_store is None:
+        save_dict = stream_frame_metrics(
+            todo,
+            lambda paths: load_videos(paths, "loading videos", raw_store),
+            videos_per_chunk=max_videos_per_batch or 16,
+            frame_batch_size=frame_batch_size,
+            progress=lambda it: tqdm(it, total=len(it)),
+            on_chunk=store_chunk,
+        )
 
-    ssim = float(np.mean(ssim_list))
-    lpips = float(np.mean(lpips_list))
-    ssim_per_timestep = np.mean(np.stack(ssim_per_timestep_list, axis=0), axis=0).tolist()
-    lpips_per_timestep = np.mean(np.stack(lpips_per_timestep_list, axis=0), axis=0).tolist()
+    if result_store is not None:
+        # per-timestep sums over the stored values of all videos
+        per_timestep = {name: result_store.trials(run, stage, name, samples) for name in ("mse", "ssim", "lpips")}
+        T = max([len(v) for v in per_timestep["mse"].values()], default=0)
+        sums = {name: np.zeros(T) for name in per_timestep}
+        counts = np.zeros(T, dtype=np.int64)
+        for name, videos in per_timestep.items():
+            for v in videos.values():
+                sums[name][:len(v)] += v
+        for v in per_timestep["mse"].values():
+            counts[:len(v)] += 1
+        save_dict = summarize_frame_metrics(sums, counts)
 
     detail_eval_file = Path(output) / "frame_eval.yaml"
-    save_dict = {
-        "mse_total": mse_total,
-        "mse_per_timestep": mse_per_timestep,
-        "rmse": rmse,
-        "ssim": ssim,
-        "lpips": lpips,
-        "ssim_per_timestep": ssim_per_timestep,
-        "lpips_per_timestep": lpips_per_timestep
-    }
     os.makedirs(detail_eval_file.parent, exist_ok=True)
     with open(detail_eval_file, "w") as file:
         yaml.dump(save_dict, file, default_flow_style=False, sort_keys=False)
 
-    return mse_total, rmse, ssim, lpips
+    return save_dict["mse_total"], save_dict["rmse"], save_dict["ssim"], save_dict["lpips"]
 
 ###########################################################
 ########################## Main ###########################
@@ -535,14 +490,28 @@ def arguments():
     parser.add_argument("--max-videos-in-mem", type=int, default=None, help="Maximum number of videos to load into memory")
     parser.add_argument("-o", "--output", type=str, default=None, help="Output file path")
     parser.add_argument("--fvd", action="store_true", default=False, help="Compute FVD scores")
+    parser.add_argument("--no-raw", action="store_true", default=False, help="Decode the videos even if raw output is present")
+    parser.add_argument("--frame-batch-size", type=int, default=256, help="Number of frames per SSIM/LPIPS call of the extended metrics")
+    parser.add_argument("--fvd-bank", type=str, default=None, help="Directory of the persistent FVD feature bank")
     parser.add_argument("--extended", action="store_true", default=False, help="Compute extended evaluation scores.")
     parser.add_argument("--glomap", action="store_true", default=False, help="Compute GLOMAP metrics on camera poses")
-    parser.add_argument("--colmap", action="store_true", default=False, help="Compute GLOMAP metrics on camera poses")
+    parser.add_argument("--colmap", action="store_true", default=False, help="Compute COLMAP metrics on camera poses")
+    parser.add_argument("--fast-pose", action="store_true", default=False, help="Compute screening camera pose metrics with the in-process estimator, no colmap/glomap required")
     parser.add_argument("-n", "--name", type=str, default=None, help="Trial name")
     parser.add_argument("--evaluation-file", type=str, default=DEFAULT_EVALUATION_FILE, help="Evaluation file path")
     parser.add_argument("--max-videos", type=int, default=None, help="Maximum number of videos to evaluate")
     parser.add_argument("--sample-list", type=str, default=None)
-    parser.add_argument("--num-trials", type=int, default=1)
+    parser.add_argument("--num-trials", type=int, default=5, help="Number of pose estimation trials per video")
+    parser.add_argument("--pose-workers", type=int, default=None, help="Number of videos evaluated concurrently, defaults to #cores / --pose-threads")
+    parser.add_argument("--pose-threads", type=int, default=4, help="Number of threads per colmap/glomap command")
+    parser.add_argument("--pose-timeout", type=float, default=None, help="Timeout in seconds of a colmap/glomap command")
+    parser.add_argument("--pose-retries", type=int, default=1, help="Number of retries of a failed video")
+    parser.add_argument("--pose-early-stop-tol", type=float, default=None, help="Stop the trials of a video once their relative CamMC spread is below this value")
+    parser.add_argument("--pose-min-trials", type=int, default=2, help="Minimum number of successful trials before stopping early")
+    parser.add_argument("--pose-image-format", type=str, default="bmp", choices=["bmp", "png", "jpg"], help="Format of the frames extracted for colmap/glomap")
+    parser.add_argument("--result-db", type=str, default=DEFAULT_RESULT_DB, help="SQLite database of the per-sample results, empty to disable")
+    parser.add_argument("--no-resume", action="store_true", default=False, help="Recompute samples that have stored results")
+    parser.add_argument("--retry-failed", action="store_true", default=False, help="Evaluate the camera poses of videos that failed in a previous run again")
 
     args = parser.parse_args()
     return args
@@ -564,23 +533,63 @@ def main(args):
     if not os.path.exists(args.output):
         os.makedirs(args.output)
 
+    raw_store = None if args.no_raw else open_raw_store(args.path)
+    if raw_store is not None:
+        print(f"Reading {len(raw_store)} samples from the raw output in {args.path}")
+
+    result_store, run = None, None
+    if args.result_db:
+        result_store = ResultStore(args.result_db)
+        run = args.name if args.name is not None else str(Path(args.path).resolve())
+        result_store.register_run(run, str(Path(args.path).resolve()))
+        print(f"Storing per-sample results of run '{run}' in {args.result_db}")
+    stored = dict(result_store=result_store, run=run, resume=not args.no_resume)
+
     fvd_videogpt, fvd_stylegan, rot_err, trans_err, cam_mc = -1, -1, -1, -1, -1
     mse, ssim, lpips, rmse = -1, -1, -1, -1
 
     if args.fvd:
-        fvd_stylegan, fvd_videogpt = fvd(args.path, args.output, args.max_videos_in_mem, args.max_videos, args.sample_list)
+        fvd_videogpt, fvd_stylegan = fvd(args.path, args.output, args.max_videos_in_mem, args.max_videos, args.sample_list,
+                                         feature_bank=args.fvd_bank, raw_store=raw_store, **stored)
 
     if args.colmap or args.glomap:
         rot_err, trans_err, cam_mc = camera_pose_evaluation(
             path=args.path,
             output=args.output,
             max_videos=args.max_videos,
-            trials_per_video=5,
-            sample_list=args.sample_list
+            use_colmap=args.colmap,
+            trials_per_video=args.num_trials,
+            sample_list=args.sample_list,
+            num_workers=args.pose_workers,
+            threads_per_task=args.pose_threads,
+            timeout=args.pose_timeout,
+            retries=args.pose_retries,
+            early_stop_tol=args.pose_early_stop_tol,
+            min_trials=args.pose_min_trials,
+            raw_store=raw_store,
+            image_format=args.pose_image_format,
+            retry_failed=args.retry_failed,
+            **stored,
         )
     
+    if args.fast_pose:
+        rot_err_fast, trans_err_fast, cam_mc_fast = camera_pose_evaluation(
+            path=args.path,
+            output=args.output,
+            max_videos=args.max_videos,
+            sample_list=args.sample_list,
+            num_workers=args.pose_workers,
+            threads_per_task=1,
+            retries=0,
+            raw_store=raw_store,
+            estimator="fast",
+            retry_failed=args.retry_failed,
+            **stored,
+        )
+
     if args.extended:
-        mse, rmse, ssim, lpips = compute_extended_metrics(args.path, args.output, args.max_videos_in_mem, args.max_videos, args.sample_list)
+        mse, rmse, ssim, lpips = compute_extended_metrics(args.path, args.output, args.max_videos_in_mem, args.max_videos, args.sample_list,
+                                                          frame_batch_size=args.frame_batch_size, raw_store=raw_store, **stored)
 
     eval_dict = {
         "Run name": args.name if args.name is not None else "N/A",
@@ -593,6 +602,8 @@ def main(args):
         "Input path": str(Path(args.path).resolve()),
         "Output path": str(Path(args.output).resolve()),
     }
+    if args.fast_pose:
+        eval_dict.update({"RotErr (fast)": rot_err_fast, "TransErr (fast)": trans_err_fast, "CamMC (fast)": cam_mc_fast})
 
     print(f"Savin results to: {args.evaluation_file}")
     if os.path.exists(args.evaluation_file):
@@ -609,10 +620,17 @@ def main(args):
     print(f"  RotErr:         {rot_err:.4f}")
     print(f"  TransErr:       {trans_err:.4f}")
     print(f"  CamMC:          {cam_mc:.4f}")
+    if args.fast_pose:
+        print(f"  RotErr (fast):  {rot_err_fast:.4f}")
+        print(f"  TransErr (fast):{trans_err_fast:.4f}")
+        print(f"  CamMC (fast):   {cam_mc_fast:.4f}")
     print(f"  MSE:            {mse:.4f}")
     print(f"  RMSE:           {rmse:.4f}")
     print(f"  SSIM:           {ssim:.4f}")
     print(f"  LPIPS:          {lpips:.4f}")
+
+    if result_store is not None:
+        result_store.close()
     
 
 if __name__ == "__main__":
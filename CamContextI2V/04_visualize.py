@@ -11,11 +11,19 @@ from einops import rearrange
 from pathlib import Path
 
 from utils.utils import instantiate_from_config
-from main.runtime import Image2Video, bezier_curve
+from main.runtime import Image2Video, bezier_curve, stream_image
+from main.inference_server import InferenceServer
 
 # Parse command-line arguments for the demo application.
 parser = argparse.ArgumentParser()
 parser.add_argument("--device", type=str, default="cuda")
+parser.add_argument("--precision", type=str, default="auto", choices=["auto", "fp16", "bf16", "fp32"])
+parser.add_argument("--no-share-weights", action="store_true", default=False, help="Keep a full copy of the frozen backbone per model")
+parser.add_argument("--max-batch-size", type=int, default=1, help="Batch compatible requests of concurrent users, 1 serves requests one by one")
+parser.add_argument("--preview-every", type=int, default=5, help="Sampling steps between two preview videos, 0 disables previews")
+parser.add_argument("--preview-mode", type=str, default="latent_rgb", choices=["latent_rgb", "vae"])
+parser.add_argument("--no-latent-continuity", action="store_true", default=False, help="Auto-regressive steps decode and re-encode the last frame")
+parser.add_argument("--overlap-frames", type=int, default=1, help="Latent frames shared by consecutive auto-regressive steps")
 parser.add_argument("--result_dir", type=str, default="./results/demo")
 parser.add_argument("--data_dir", type=str, default="/home/group-cvg/datasets/realestate10k_new")
 parser.add_argument("--model_meta_path", type=str, default="./configs/demo/models.json")
@@ -195,7 +203,12 @@ def multicond_comparison_app():
         model_names.extend(detected_model_names)
         model_metadata.update(detected_models)
 
-    image2video = Image2Video(args.result_dir, args.model_meta_path, args.camera_pose_meta_path, device=args.device, model_meta_data=model_metadata)
+    image2video = Image2Video(args.result_dir, args.model_meta_path, args.camera_pose_meta_path, device=args.device, model_meta_data=model_metadata, precision=args.precision,
+                              share_weights=not args.no_share_weights, preview_every=args.preview_every, preview_mode=args.preview_mode,
+                              latent_continuity=not args.no_latent_continuity, overlap_frames=args.overlap_frames)
+    # the single worker of the server owns the models, the sampling of an abandoned event (disconnected client) never
+    # overlaps with the next event, with --max-batch-size 1 requests are served one by one
+    image2video = InferenceServer(image2video, max_batch_size=args.max_batch_size)
     dataset = load_dataset()
 
     with gr.Blocks(analytics_enabled=False) as app_interface:
@@ -258,8 +271,8 @@ def multicond_comparison_app():
                 video_name (str): Selected video name from the dataset.
                 *inputs: Additional inputs including model selection, prompts, camera settings, etc.
 
-            Returns:
-                tuple: Generated video and camera trajectory visualization.
+            Yields:
+                tuple: Preview videos during sampling, then the generated video and camera trajectory visualization.
             """
             index = dataset.get_index_by_name(video_name)
             batch = dataset[index]
@@ -272,7 +285,11 @@ def multicond_comparison_app():
             batch['video'] = batch['video'][:, ref_index:]
             batch['RT'] = batch['RT'][ref_index:]
             inputs = list(inputs[:1]) + [None] + list(inputs[1:])
-            return image2video.get_image(*inputs, batch=batch)
+            for kind, outputs in stream_image(image2video.get_image, *inputs, batch=batch):
+                if kind == "preview":
+                    yield outputs, gr.update()
+                else:
+                    yield tuple(outputs)
         
         def load_video(video_name):
             """
@@ -330,5 +347,6 @@ def get_ip_addr():
 
 if __name__ == "__main__":
     app = multicond_comparison_app()
-    app.queue(max_size=12)
+    # concurrent events are required to fill the batches of the inference server
+    app.queue(max_size=12, default_concurrency_limit=max(1, args.max_batch_size))
     app.launch(max_threads=10, server_name=get_ip_addr() if args.use_host_ip else None, allowed_paths=["gradio", "internal"])
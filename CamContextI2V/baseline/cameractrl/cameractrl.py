@@ -5,6 +5,8 @@ from einops import rearrange, repeat
 from torch import nn
 
 from model.base import CameraControlLVDM
+from model.modules.camera_condition import CameraCondition
+from lvdm.common import disable_autocast
 from baseline.cameractrl.cameractrl_modified_modules import (
     new__forward_for_BasicTransformerBlock_of_TemporalTransformer,
     new_forward_for_BasicTransformerBlock_of_TemporalTransformer,
@@ -55,7 +57,7 @@ class CameraCtrl(CameraControlLVDM):
         return_kwargs = {}
 
         batch_size, num_frames, device, H, W = x.shape[0], x.shape[2], self.model.device, x.shape[3], x.shape[4]
-        with torch.no_grad(),  torch.autocast('cuda', enabled=False):
+        with torch.no_grad(),  disable_autocast():
             camera_intrinsics_3x3 = super().get_input(batch, 'camera_intrinsics').float()  # b, t, 3, 3
             w2c_RT_4x4 = super().get_input(batch, 'RT').float()  # b, t, 4, 4
             c2w_RT_4x4 = w2c_RT_4x4.inverse()  # w2c --> c2w
@@ -65,7 +67,7 @@ class CameraCtrl(CameraControlLVDM):
             relative_c2w_RT_4x4[:, :, :3, 3] = relative_c2w_RT_4x4[:, :, :3, 3] * trace_scale_factor
 
         if self.pose_encoder is not None:
-            with torch.no_grad(), torch.autocast('cuda', enabled=False):
+            with torch.no_grad(), disable_autocast():
                 pluker_embedding = self.ray_condition(camera_intrinsics_3x3, relative_c2w_RT_4x4, H, W, device, flip_flag=None)  # b, 6, t, H, W
 
             pluker_embedding_features = self.pose_encoder(pluker_embedding)  # bf c h w
@@ -73,8 +75,8 @@ class CameraCtrl(CameraControlLVDM):
         else:
             pluker_embedding_features = None
 
-        return_kwargs["camera_condition"] = {
+        return_kwargs["camera_condition"] = CameraCondition({
                 "pluker_embedding_features": pluker_embedding_features,
-            }
+            })
 
         return return_log, return_kwargs
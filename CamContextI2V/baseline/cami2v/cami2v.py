@@ -13,12 +13,16 @@ from baseline.cami2v.cami2v_modified_modules import (
     new_forward_for_TimestepEmbedSequential,
     new_forward_for_unet,
 )
-from baseline.cami2v.epipolar import Epipolar, pix2coord
+from model.modules.epipolar import Epipolar, get_epipolar_band, pix2coord
+from model.modules.camera_condition import CameraCondition
+from lvdm.common import disable_autocast
 
 mainlogger = logging.getLogger('mainlogger')
 
 
 class CamI2V(CameraControlLVDM):
+    supports_camera_mask = True
+
     def __init__(self, add_type="add_into_temporal_attn", epipolar_config=None, *args, **kwargs):
         super(CamI2V, self).__init__(*args, **kwargs)
         self.add_type = add_type
@@ -45,6 +49,16 @@ class CamI2V(CameraControlLVDM):
                 self.epipolar_config.pluker_add_type = "add_to_pre_x_only"
             if not hasattr(self.epipolar_config, "add_small_perturbation_on_zero_T"):
                 self.epipolar_config.add_small_perturbation_on_zero_T = False
+            if not hasattr(self.epipolar_config, "sparse_attention"):
+                self.epipolar_config.sparse_attention = False
+            if self.epipolar_config.sparse_attention and (
+                self.epipolar_config.epipolar_hybrid_attention
+                or self.epipolar_config.epipolar_hybrid_attention_v2
+                or self.epipolar_config.only_self_pixel_on_current_frame
+                or self.epipolar_config.current_frame_as_register_token
+            ):
+                mainlogger.warning("Sparse epipolar attention does not support the selected mask modifications. Falling back to dense epipolar masks.")
+                self.epipolar_config.sparse_attention = False
 
         bound_method = new_forward_for_unet.__get__(
             self.model.diffusion_model,
@@ -89,7 +103,7 @@ class CamI2V(CameraControlLVDM):
                         # _module.add_module('norm_epipolar', nn.LayerNorm(_module.attn1.to_k.in_features))
 
     @torch.no_grad()
-    @torch.autocast(device_type="cuda", enabled=False)
+    @disable_autocast()
     def get_relative_c2w_RT_pairs(self, RT: Tensor):
         '''
         :param RT: B, T, 4 4   c2w relative RT
@@ -103,7 +117,7 @@ class CamI2V(CameraControlLVDM):
         return relative_RT_pairs  # B,T,T,4,4
 
     @torch.no_grad()
-    @torch.autocast(device_type="cuda", enabled=False)
+    @disable_autocast()
     def get_fundamental_matrix(self, K: Tensor, R: Tensor, t: Tensor) -> Tensor:
         '''
         :param   K: B, 3, 3
@@ -117,7 +131,7 @@ class CamI2V(CameraControlLVDM):
         return F
 
     @torch.no_grad()
-    @torch.autocast(device_type="cuda", enabled=False)
+    @disable_autocast()
     def get_epipolar_mask(self, F: Tensor, T: int, H: int, W: int, downsample: int):
         """
         modified to take in batch inputs
@@ -187,6 +201,16 @@ class CamI2V(CameraControlLVDM):
 
         return rearrange(mask, "B T1 T2 HW1 HW2 -> B (T1 HW1) (T2 HW2)")
 
+    @torch.no_grad()
+    @disable_autocast()
+    def get_epipolar_band(self, F: Tensor, T: int, H: int, W: int, downsample: int):
+        """
+        Sparse alternative to get_epipolar_mask() that never materializes the dense mask.
+
+        return: EpipolarBand holding the key indices of every query (B, T1*HW, T2, K)
+        """
+        return get_epipolar_band(F, H, W, downsample)
+
     def add_small_perturbation(self, t, epsilon=1e-6):
         zero_mask = (t.abs() < epsilon).all(dim=-2, keepdim=True)  # 检查 T 的 x, y, z 是否都接近 0
         perturbation = torch.randn_like(t) * epsilon  # 生成微小扰动
@@ -199,7 +223,7 @@ class CamI2V(CameraControlLVDM):
         return_kwargs = {}
         
         batch_size, num_frames, device, H, W = x.shape[0], x.shape[2], self.model.device, x.shape[3], x.shape[4]
-        with torch.no_grad(), torch.autocast('cuda', enabled=False):
+        with torch.no_grad(), disable_autocast():
             camera_intrinsics_3x3 = super().get_input(batch, 'camera_intrinsics').float()  # b, t, 3, 3
             w2c_RT_4x4 = super().get_input(batch, 'RT').float()  # b, t, 4, 4
             c2w_RT_4x4 = w2c_RT_4x4.inverse()  # w2c --> c2w
@@ -218,12 +242,13 @@ class CamI2V(CameraControlLVDM):
 
                 K = camera_intrinsics_3x3.unsqueeze(1)
                 F = self.get_fundamental_matrix(K, R, t)
-                sample_locs_dict = {d: self.get_epipolar_mask(F, T, H // d, W // d, d) for d in [int(8 * ds) for ds in self.epipolar_config.attention_resolution]}
+                epipolar_mask_func = self.get_epipolar_band if self.epipolar_config.sparse_attention else self.get_epipolar_mask
+                sample_locs_dict = {d: epipolar_mask_func(F, T, H // d, W // d, d) for d in [int(8 * ds) for ds in self.epipolar_config.attention_resolution]}
             else:
                 sample_locs_dict = None
 
         if self.pose_encoder is not None:
-            with torch.no_grad(), torch.autocast('cuda', enabled=False):
+            with torch.no_grad(), disable_autocast():
                 pluker_embedding = self.ray_condition(camera_intrinsics_3x3, relative_c2w_RT_4x4, H, W, device, flip_flag=None)  # b, 6, t, H, W
 
             pluker_embedding_features = self.pose_encoder(pluker_embedding)  # bf c h w
@@ -231,11 +256,11 @@ class CamI2V(CameraControlLVDM):
         else:
             pluker_embedding_features = None
 
-        return_kwargs["camera_condition"] = {
+        return_kwargs["camera_condition"] = CameraCondition({
             "pluker_embedding_features": pluker_embedding_features,
             "sample_locs_dict": sample_locs_dict,
             "cond_frame_index": cond_frame_index,
             "add_type": self.add_type,
-        }
+        })
 
         return return_log, return_kwargs
@@ -274,6 +274,10 @@ def new__forward_for_BasicTransformerBlock_of_TemporalTransformer(self, x, conte
                     rearrange(normed_x, '(b h w) f c -> b f c h w', h=camera_condition['h'], w=camera_condition['w']),
                     **camera_condition,
                 )  # (b h w) f c
+        if camera_condition.get('camera_mask', None) is not None:
+            # samples of batched guidance branches without camera condition
+            camera_mask = repeat(camera_condition['camera_mask'], 'b -> (b hw) 1 1', hw=camera_condition['h'] * camera_condition['w'])
+            zero_init_x = zero_init_x * camera_mask.to(zero_init_x.dtype)
         if 'add_type' in camera_condition and camera_condition['add_type'] == "add_to_main_branch":
             x = zero_init_x + self.attn1(normed_x, context=context if self.disable_self_attn else None, mask=mask) + x
         else:
@@ -5,6 +5,8 @@ from einops import rearrange
 from torch import nn
 
 from model import CameraControlLVDM
+from model.modules.camera_condition import CameraCondition
+from lvdm.common import disable_autocast
 from baseline.motionctrl.motionctrl_modified_modules import (
     new__forward_for_BasicTransformerBlock_of_TemporalTransformer,
     new_forward_for_BasicTransformerBlock_of_TemporalTransformer,
@@ -55,7 +57,7 @@ class MotionCtrl(CameraControlLVDM):
         return_log = {}
         return_kwargs = {}
 
-        with torch.no_grad(),  torch.autocast('cuda', enabled=False):
+        with torch.no_grad(),  disable_autocast():
             w2c_RT_4x4 = super().get_input(batch, 'RT').float()  # b, t, 4, 4
             c2w_RT_4x4 = w2c_RT_4x4.inverse()  # w2c --> c2w
 
@@ -64,8 +66,8 @@ class MotionCtrl(CameraControlLVDM):
 
             relative_w2c_RT_4x4 = relative_c2w_RT_4x4.inverse()
 
-        return_kwargs["camera_condition"] = {
+        return_kwargs["camera_condition"] = CameraCondition({
             "RT": rearrange(relative_w2c_RT_4x4[:, :, :3, :4], "b t x y -> b t (x y)"),
-        }
+        })
 
         return return_log, return_kwargs
@@ -0,0 +1,116 @@
+"""
+Binary camera metadata index for RealEstate10K.
+
+The per-video metadata txt files (url line followed by one line per frame: timestamp, fx, fy, cx, cy, 2 unused
+values and the row-major 3x4 w2c matrix) are parsed once into a columnar index:
+
+    rows.npy     float32 [total_frames, 19], the parsed frame lines of all videos, concatenated
+    offsets.npy  int64 [num_videos + 1], first row of every video, offsets[i + 1] - offsets[i] frames
+    names.npy    bytes [num_videos], video names in index order
+
+The arrays are memory-mapped, so dataloader workers share the pages of the index instead of parsing text:
+
+    python -m data.camera_index --meta-path <dir with txt files> --out-dir <index dir> [--meta-list <list>]
+"""
+import argparse
+import logging
+from multiprocessing import Pool
+from pathlib import Path
+from typing import List
+
+import numpy as np
+
+mainlogger = logging.getLogger('mainlogger')
+
+NUM_COLUMNS = 19
+
+
+class CameraIndex:
+    """ Read-only, memory-mapped camera metadata index written by compile_camera_index """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        self.rows = np.load(self.root / "rows.npy", mmap_mode="r")
+        self.offsets = np.load(self.root / "offsets.npy")
+        self.names = np.load(self.root / "names.npy")
+        # name -> id hash table, built from the names array once per process
+        self.ids = {name.decode("utf-8"): i for i, name in enumerate(self.names)}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.ids
+
+    def __len__(self):
+        return len(self.ids)
+
+    def __getitem__(self, name: str) -> np.ndarray:
+        """ Returns the [num_frames, 19] rows of a video as a view into the index """
+        video_id = self.ids[name]
+        return self.rows[self.offsets[video_id]:self.offsets[video_id + 1]]
+
+    def __getstate__(self):
+        # workers started with spawn map the index again instead of receiving a pickled copy of the rows
+        state = self.__dict__.copy()
+        del state["rows"]
+        return state
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self.rows = np.load(self.root / "rows.npy", mmap_mode="r")
+
+    def num_frames(self, name: str) -> int:
+        video_id = self.ids[name]
+        return int(self.offsets[video_id + 1] - self.offsets[video_id])
+
+
+def parse_metadata_file(path):
+    """ Parses the frame lines of a metadata txt file, the first line contains the video url """
+    try:
+        with open(path, "r") as f:
+            lines = f.readlines()[1:]
+        rows = np.loadtxt(lines, ndmin=2, dtype=np.float64).astype(np.float32)
+    except Exception as e:
+        return path, None, str(e)
+    if rows.shape[0] == 0 or rows.shape[1] != NUM_COLUMNS:
+        return path, None, f"unexpected shape {rows.shape}"
+    return path, rows, None
+
+
+def compile_camera_index(meta_path: str, out_dir: str, names: List[str] = None, num_workers: int = 8):
+    """ Parses the metadata txt files of meta_path (or of the given names) into a binary index at out_dir """
+    if names is None:
+        names = sorted(path.stem for path in Path(meta_path).glob("*.txt"))
+    paths = [Path(meta_path) / f"{name}.txt" for name in names]
+
+    valid_names, all_rows, offsets = [], [], [0]
+    with Pool(num_workers) as pool:
+        for path, rows, error in pool.imap(parse_metadata_file, paths, chunksize=64):
+            if rows is None:
+                mainlogger.warning(f"Skipping {path}: {error}")
+                continue
+            valid_names.append(Path(path).stem)
+            all_rows.append(rows)
+            offsets.append(offsets[-1] + rows.shape[0])
+
+    out_dir = Path(out_dir)
+    out_dir.mkdir(parents=True, exist_ok=True)
+    rows = np.concatenate(all_rows, axis=0) if len(all_rows) > 0 else np.zeros((0, NUM_COLUMNS), dtype=np.float32)
+    np.save(out_dir / "rows.npy", np.ascontiguousarray(rows))
+    np.save(out_dir / "offsets.npy", np.asarray(offsets, dtype=np.int64))
+    np.save(out_dir / "names.npy", np.asarray(valid_names, dtype=np.bytes_))
+    mainlogger.info(f"Compiled camera index of {len(valid_names)} videos ({rows.shape[0]} frames) to {out_dir}")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Compile the per-video camera metadata into a binary index")
+    parser.add_argument("--meta-path", type=str, required=True)
+    parser.add_argument("--out-dir", type=str, required=True)
+    parser.add_argument("--meta-list", type=str, default=None, help="Optional list of video names to include")
+    parser.add_argument("--num-workers", type=int, default=8)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    names = None
+    if args.meta_list is not None:
+        with open(args.meta_list, "r") as f:
+            names = [line.strip() for line in f.readlines() if line.strip()]
+    compile_camera_index(args.meta_path, args.out_dir, names, num_workers=args.num_workers)
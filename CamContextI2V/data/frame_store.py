@@ -0,0 +1,293 @@
+"""
+Preprocessed frame store for video datasets.
+
+Frames are decoded once, resized and center-cropped to the training resolution and appended as raw uint8
+arrays (F x H x W x 3) to shard files. An index maps every video to its shard, frame offset, number of frames
+and fps, such that clips are served by slicing memory-mapped shards without any codec work.
+
+Building a store is incremental and resumable, videos already contained in the index are skipped:
+
+    python -m data.frame_store --video-dir <dir with mp4s> --out-dir <store dir> --resolution 256 256
+"""
+import argparse
+import json
+import logging
+import os
+from multiprocessing import Pool
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+import torch
+from torchvision import transforms
+
+mainlogger = logging.getLogger('mainlogger')
+
+INDEX_FILE = "index.json"
+SHARD_FILE = "shard_{:05d}.u8"
+
+
+def resize_center_crop(frames: torch.Tensor, H: int, W: int) -> Tuple[torch.Tensor, int, int]:
+    '''
+    :param frames: C,F,H,W
+    :return: frames: C,F,H,W cropped to the target resolution, height and width after resizing
+    '''
+    ori_H, ori_W = frames.shape[-2:]
+    if ori_W / ori_H > W / H:
+        frames = transforms.functional.resize(frames, size=[H, int(ori_W * H / ori_H)])
+    else:
+        frames = transforms.functional.resize(frames, size=[int(ori_H * W / ori_W), W])
+
+    resized_H, resized_W = frames.shape[2], frames.shape[3]
+    frames = frames.squeeze(0)
+
+    top, left = (resized_H - H) // 2, (resized_W - W) // 2
+    frames = transforms.functional.crop(frames, top=top, left=left, height=H, width=W)
+    return frames, resized_H, resized_W
+
+
+class _FrameBatch:
+    """ Mimics the NDArray returned by decord.VideoReader.get_batch """
+    __slots__ = ("frames",)
+
+    def __init__(self, frames: np.ndarray):
+        self.frames = frames
+
+    def asnumpy(self) -> np.ndarray:
+        return self.frames
+
+
+class StoredVideo:
+    """
+        Read-only view of a single video in a FrameStore with the subset of the decord.VideoReader interface used
+        by the datasets. Frames are already resized and cropped to the resolution of the store.
+    """
+
+    def __init__(self, frames: np.ndarray, fps: float, resized_hw: Tuple[int, int]):
+        self.frames = frames
+        self.fps = fps
+        self.resized_hw = tuple(resized_hw)
+
+    def __len__(self):
+        return self.frames.shape[0]
+
+    def get_avg_fps(self) -> float:
+        return self.fps
+
+    def get_batch(self, indices) -> _FrameBatch:
+        # fancy indexing copies the selected frames out of the memory map
+        return _FrameBatch(self.frames[np.asarray(indices, dtype=np.int64)])
+
+    def __getitem__(self, index):
+        return _FrameBatch(np.array(self.frames[index]))
+
+
+class FrameStore:
+    """
+        Memory-mapped frame store written by FrameStoreWriter. Shards are mapped lazily on first access, so a
+        store can be created in the main process and shared with forked dataloader workers.
+    """
+
+    def __init__(self, root: str):
+        self.root = Path(root)
+        with open(self.root / INDEX_FILE, "r") as f:
+            index = json.load(f)
+        self.resolution = tuple(index["resolution"])
+        self.load_raw_resolution = index["load_raw_resolution"]
+        self.shards = index["shards"]
+        self.videos = index["videos"]
+        self._maps = {}
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.videos
+
+    def __len__(self):
+        return len(self.videos)
+
+    def open(self, name: str) -> StoredVideo:
+        entry = self.videos[name]
+        shard = self._shard(entry["shard"])
+        frames = shard[entry["offset"]:entry["offset"] + entry["num_frames"]]
+        return StoredVideo(frames, entry["fps"], entry["resized_hw"])
+
+    def _shard(self, shard_index: int) -> np.ndarray:
+        shard = self._maps.get(shard_index, None)
+        if shard is None:
+            H, W = self.resolution
+            path = self.root / self.shards[shard_index]["file"]
+            # the number of frames is taken from the index, trailing frames of an interrupted write are ignored
+            shape = (self.shards[shard_index]["num_frames"], H, W, 3)
+            shard = np.memmap(path, dtype=np.uint8, mode="r", shape=shape) if shape[0] > 0 else np.zeros(shape, dtype=np.uint8)
+            self._maps[shard_index] = shard
+        return shard
+
+    def __getstate__(self):
+        # memory maps are reopened in the receiving process
+        state = self.__dict__.copy()
+        state["_maps"] = {}
+        return state
+
+
+class FrameStoreWriter:
+    """
+        Appends preprocessed videos to a frame store. The index is rewritten atomically every flush_every videos;
+        frames written after the last index update are truncated when the writer is reopened.
+
+        Parameters:
+            root (str): Directory of the store.
+            resolution (list): Target resolution [H, W], has to match an existing store.
+            load_raw_resolution (bool): Decode at the raw video resolution instead of 530x300 before resizing.
+            shard_size_gb (float): Approximate size of a shard file.
+            flush_every (int): Number of videos between index updates.
+    """
+
+    def __init__(self,
+                 root: str,
+                 resolution: List[int] = [256, 256],
+                 load_raw_resolution: bool = True,
+                 shard_size_gb: float = 4.0,
+                 flush_every: int = 32,
+                 ):
+        self.root = Path(root)
+        self.root.mkdir(parents=True, exist_ok=True)
+        self.flush_every = flush_every
+        self.frame_bytes = resolution[0] * resolution[1] * 3
+        self.shard_frames = max(1, int(shard_size_gb * 2**30 // self.frame_bytes))
+
+        index_path = self.root / INDEX_FILE
+        if index_path.exists():
+            with open(index_path, "r") as f:
+                self.index = json.load(f)
+            assert list(self.index["resolution"]) == list(resolution), \
+                f"Store at {root} has resolution {self.index['resolution']}, requested {list(resolution)}"
+            assert self.index["load_raw_resolution"] == load_raw_resolution, \
+                f"Store at {root} was written with load_raw_resolution={self.index['load_raw_resolution']}"
+        else:
+            self.index = {"resolution": list(resolution), "load_raw_resolution": load_raw_resolution, "shards": [], "videos": {}}
+
+        # drop frames of an interrupted run that did not make it into the index
+        for shard in self.index["shards"]:
+            path = self.root / shard["file"]
+            if path.exists() and path.stat().st_size > shard["num_frames"] * self.frame_bytes:
+                os.truncate(path, shard["num_frames"] * self.frame_bytes)
+        self._pending = 0
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.index["videos"]
+
+    def add(self, name: str, frames: np.ndarray, fps: float, resized_hw: Tuple[int, int], **extra):
+        """ Appends the F x H x W x 3 uint8 frames of a video, extra json serializable fields are stored in its entry """
+        assert frames.dtype == np.uint8 and frames.shape[1:] == (*self.index["resolution"], 3), f"Invalid frames {frames.shape}, {frames.dtype}"
+        shards = self.index["shards"]
+        if len(shards) == 0 or (shards[-1]["num_frames"] > 0 and shards[-1]["num_frames"] + frames.shape[0] > self.shard_frames):
+            shards.append({"file": SHARD_FILE.format(len(shards)), "num_frames": 0})
+        shard = shards[-1]
+
+        # a new shard may exist from an interrupted run that never made it into the index
+        with open(self.root / shard["file"], "ab" if shard["num_frames"] > 0 else "wb") as f:
+            f.write(np.ascontiguousarray(frames).tobytes())
+        self.index["videos"][name] = {
+            "shard": len(shards) - 1,
+            "offset": shard["num_frames"],
+            "num_frames": int(frames.shape[0]),
+            "fps": float(fps),
+            "resized_hw": [int(resized_hw[0]), int(resized_hw[1])],
+            **extra,
+        }
+        shard["num_frames"] += int(frames.shape[0])
+
+        self._pending += 1
+        if self._pending >= self.flush_every:
+            self.flush()
+
+    def flush(self):
+        tmp_path = self.root / (INDEX_FILE + ".tmp")
+        with open(tmp_path, "w") as f:
+            json.dump(self.index, f)
+        os.replace(tmp_path, self.root / INDEX_FILE)
+        self._pending = 0
+
+
+def preprocess_video(args):
+    """ Decodes, resizes and crops a video to uint8 frames, returns None if the video can not be read """
+    video_path, resolution, load_raw_resolution, decode_batch_size = args
+    from decord import VideoReader, cpu
+
+    try:
+        if load_raw_resolution:
+            video_reader = VideoReader(str(video_path), ctx=cpu(0))
+        else:
+            video_reader = VideoReader(str(video_path), ctx=cpu(0), width=530, height=300)
+        fps = video_reader.get_avg_fps()
+
+        chunks, resized_hw = [], None
+        for start in range(0, len(video_reader), decode_batch_size):
+            indices = list(range(start, min(start + decode_batch_size, len(video_reader))))
+            frames = torch.from_numpy(video_reader.get_batch(indices).asnumpy()).permute(3, 0, 1, 2).float()  # [c,t,h,w]
+            frames, resized_H, resized_W = resize_center_crop(frames, resolution[0], resolution[1])
+            resized_hw = (resized_H, resized_W)
+            chunks.append(frames.round().clamp(0, 255).to(torch.uint8).permute(1, 2, 3, 0).numpy())  # [t,h,w,c]
+        del video_reader
+    except Exception as e:
+        return video_path, None, str(e)
+
+    if len(chunks) == 0:
+        return video_path, None, "empty video"
+    return video_path, (np.concatenate(chunks, axis=0), fps, resized_hw), None
+
+
+def _init_worker():
+    # parallelism comes from the pool, avoid oversubscription by the intra-op thread pools
+    torch.set_num_threads(1)
+
+
+def build_frame_store(video_dir: str,
+                      out_dir: str,
+                      resolution: List[int] = [256, 256],
+                      load_raw_resolution: bool = True,
+                      names: List[str] = None,
+                      num_workers: int = 8,
+                      shard_size_gb: float = 4.0,
+                      decode_batch_size: int = 64,
+                      ):
+    """ Adds all videos of video_dir (or the given names) that are not in the store yet """
+    writer = FrameStoreWriter(out_dir, resolution, load_raw_resolution, shard_size_gb=shard_size_gb)
+    if names is None:
+        names = sorted(path.stem for path in Path(video_dir).glob("*.mp4"))
+    todo = [name for name in names if name not in writer]
+    mainlogger.info(f"Frame store {out_dir}: {len(names) - len(todo)} videos done, {len(todo)} remaining")
+
+    jobs = [(Path(video_dir) / f"{name}.mp4", resolution, load_raw_resolution, decode_batch_size) for name in todo]
+    failed = 0
+    with Pool(num_workers, initializer=_init_worker) as pool:
+        for i, (video_path, result, error) in enumerate(pool.imap(preprocess_video, jobs)):
+            if result is None:
+                failed += 1
+                mainlogger.warning(f"Skipping {video_path}: {error}")
+                continue
+            writer.add(Path(video_path).stem, *result)
+            if (i + 1) % 100 == 0:
+                mainlogger.info(f"Processed {i + 1}/{len(jobs)} videos")
+    writer.flush()
+    mainlogger.info(f"Frame store {out_dir} contains {len(writer.index['videos'])} videos ({failed} failed)")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Preprocess videos into a memory-mapped frame store")
+    parser.add_argument("--video-dir", type=str, required=True)
+    parser.add_argument("--out-dir", type=str, required=True)
+    parser.add_argument("--resolution", type=int, nargs=2, default=[256, 256], help="Target resolution H W")
+    parser.add_argument("--meta-list", type=str, default=None, help="Optional list of video names to include")
+    parser.add_argument("--no-raw-resolution", action="store_true", help="Decode at 530x300 (load_raw_resolution=False)")
+    parser.add_argument("--num-workers", type=int, default=8)
+    parser.add_argument("--shard-size-gb", type=float, default=4.0)
+    parser.add_argument("--decode-batch-size", type=int, default=64)
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO)
+    names = None
+    if args.meta_list is not None:
+        with open(args.meta_list, "r") as f:
+            names = [line.strip() for line in f.readlines() if line.strip()]
+    build_frame_store(args.video_dir, args.out_dir, args.resolution, not args.no_raw_resolution, names,
+                      num_workers=args.num_workers, shard_size_gb=args.shard_size_gb, decode_batch_size=args.decode_batch_size)
@@ -11,6 +11,9 @@ from torch.utils.data import Dataset
 from torch.utils.data.dataloader import default_collate
 from torchvision import transforms
 
+from data.frame_store import FrameStore, resize_center_crop
+from data.camera_index import CameraIndex
+
 mainlogger = logging.getLogger('mainlogger')
 
 
@@ -38,6 +41,9 @@ class RealEstate10K(Dataset):
     spatial_transform: spatial transformation, ["random_crop", "resize_center_crop"]
     count_globalsteps: whether to count global steps
     bs_per_gpu: batch size per gpu, used to count global steps
+    frame_store: optional path to a preprocessed frame store (data/frame_store.py) at the training resolution,
+                 frames are then sliced from memory-mapped shards instead of being decoded from data_dir
+    camera_index: optional path to a binary camera metadata index (data/camera_index.py) replacing the txt files in meta_path
 
     """
 
@@ -62,7 +68,9 @@ class RealEstate10K(Dataset):
                  additional_cond_frames: Literal['none', 'random', 'last', "random_true", "random_offset", "random_full"]='none',
                  num_additional_cond_frames: Union[List[int], int]=0,
                  exclude_samples: List[str] = [],
-                 adaptive_sampling_range: Tuple[int,int] = None
+                 adaptive_sampling_range: Tuple[int,int] = None,
+                 frame_store: str = None,
+                 camera_index: str = None,
                  ):
         self.meta_path = meta_path
         self.data_dir = data_dir
@@ -84,6 +92,21 @@ class RealEstate10K(Dataset):
         self.load_raw_resolution = load_raw_resolution
         self.camera_pose_sections = camera_pose_sections
 
+        self.frame_store = None
+        if frame_store is not None:
+            self.frame_store = FrameStore(frame_store)
+            assert list(self.frame_store.resolution) == list(self.resolution), \
+                f"Frame store resolution {self.frame_store.resolution} does not match the dataset resolution {self.resolution}"
+            if self.frame_store.load_raw_resolution != self.load_raw_resolution:
+                mainlogger.warning(f"Frame store was built with load_raw_resolution={self.frame_store.load_raw_resolution}")
+            mainlogger.info(f"Using frame store {frame_store} with {len(self.frame_store)} videos")
+
+        self.camera_index = None
+        if camera_index is not None:
+            self.camera_index = CameraIndex(camera_index)
+            mainlogger.info(f"Using camera index {camera_index} with {len(self.camera_index)} videos")
+        self._index_by_name = None
+
         self.metadata = []
         with open(meta_list, 'r') as f:
             # self.metadata = [line.strip() for line in f.readlines()]
@@ -116,35 +139,21 @@ class RealEstate10K(Dataset):
         :param image_size: H,W
         :return: frames: C,F,crop_H,crop_W;  camera_intrinsics: F,3,3
         '''
-        ori_H, ori_W = frames.shape[-2:]
-        if ori_W / ori_H > W / H:
-            frames = transforms.functional.resize(
-                frames,
-                size=[H, int(ori_W * H / ori_H)],
-            )
-        else:
-            frames = transforms.functional.resize(
-                frames,
-                size=[int(ori_H * W / ori_W), W],
-            )
+        frames, resized_H, resized_W = resize_center_crop(frames, H, W)
+        camera_intrinsics = self._rectangle_crop_intrinsics(H, W, resized_H, resized_W, fx, fy, cx, cy)
 
-        resized_H, resized_W = frames.shape[2], frames.shape[3]
-        frames = frames.squeeze(0)
-
-        delta_H = resized_H - H
-        delta_W = resized_W - W
-
-        top, left = delta_H // 2, delta_W // 2
-        frames = transforms.functional.crop(frames, top=top, left=left, height=H, width=W)
+        return frames, camera_intrinsics, resized_H, resized_W
 
+    def _rectangle_crop_intrinsics(self, H, W, resized_H, resized_W, fx, fy, cx, cy):
+        '''
+        :return: camera_intrinsics: F,3,3 of the normalized intrinsics after resizing to resized_H, resized_W and cropping to H, W
+        '''
         fx = fx * resized_W
         fy = fy * resized_H
         cx = cx * W
         cy = cy * H
         _1, _0 = torch.ones_like(fx), torch.zeros_like(fx)
-        camera_intrinsics = torch.hstack([fx, _0, cx, _0, fy, cy, _0, _0, _1]).reshape(-1, 3, 3)  # [F, 3, 3]
-
-        return frames, camera_intrinsics, resized_H, resized_W
+        return torch.hstack([fx, _0, cx, _0, fy, cy, _0, _0, _1]).reshape(-1, 3, 3)  # [F, 3, 3]
 
     def __getitem__(self, index):
         
@@ -155,8 +164,16 @@ class RealEstate10K(Dataset):
         sample_name = self.metadata[index].decode('utf-8')
         if sample_name in self.invalid_samples:
             return self.__getitem__(random.randint(0, len(self)))
-        with open(f"{self.meta_path}/{sample_name}.txt", 'r') as f:
-            lines = f.readlines()
+        if self.camera_index is not None:
+            if sample_name not in self.camera_index:
+                self.invalid_samples.add(sample_name)
+                mainlogger.warning(f"Invalid sample {sample_name} (Total: {len(self.invalid_samples)}): Not in camera index.")
+                return self.__getitem__(random.randint(0, len(self)))
+            camera_rows = self.camera_index[sample_name]  # [frames, 19] view into the memory-mapped index
+        else:
+            with open(f"{self.meta_path}/{sample_name}.txt", 'r') as f:
+                lines = f.readlines()
+            camera_rows = None
         
         cap_name = f"{sample_name}.mp4"
         if cap_name not in self.captions:
@@ -166,11 +183,20 @@ class RealEstate10K(Dataset):
         else:
             caption = self.captions[cap_name][0]
         video_path = os.path.join(self.data_dir, f'{sample_name}.mp4')
-        if not os.path.exists(video_path):
+        if self.frame_store is not None:
+            if sample_name not in self.frame_store:
+                self.invalid_samples.add(sample_name)
+                mainlogger.warning(f"Invalid sample {sample_name} (Total: {len(self.invalid_samples)}): Not in frame store.")
+                return self.__getitem__(random.randint(0, len(self)))
+        elif not os.path.exists(video_path):
             return self.__getitem__(random.randint(0, len(self)))
         
         try:
-            if self.load_raw_resolution:
+            if self.frame_store is not None:
+                # frames are already resized and cropped, no decoding required
+                video_reader = self.frame_store.open(sample_name)
+                stored_resized_hw = video_reader.resized_hw
+            elif self.load_raw_resolution:
                 video_reader = VideoReader(video_path, ctx=cpu(0))
             else:
                 video_reader = VideoReader(video_path, ctx=cpu(0), width=530, height=300)
@@ -180,8 +206,10 @@ class RealEstate10K(Dataset):
             return self.__getitem__(random.randint(0, len(self)))
 
         fps_ori = video_reader.get_avg_fps()
-        lines = lines[1:]
-        frame_num = len(lines)
+        if camera_rows is None:
+            # parsed once for the clip and the context frames
+            camera_rows = np.loadtxt(lines[1:], ndmin=2)
+        frame_num = camera_rows.shape[0]
 
         frame_stride_drop = 0
         while True:
@@ -215,12 +243,13 @@ class RealEstate10K(Dataset):
             frame_indices = list(range(frame_num))
             frame_indices = frame_indices[::frame_stride]
 
-        camera_data = torch.from_numpy(np.loadtxt(lines))[frame_indices].float()  # [t, ]
+        camera_data = torch.from_numpy(np.asarray(camera_rows[frame_indices])).float()  # [t, ]
         fx, fy, cx, cy = camera_data[:, 1:5].chunk(4, dim=-1)  # [t,4]
         camera_pose_3x4 = camera_data[:, 7:].reshape(-1, 3, 4)  # [t, 3, 4]
         camera_pose_4x4 = torch.cat([camera_pose_3x4, torch.tensor([[[0.0, 0.0, 0.0, 1.0]]] * len(frame_indices))], dim=1)  # [t, 4, 4]
 
         camera_pose_4x4_cond = torch.zeros(1)
+        context_indices = []
         try:
             frames = video_reader.get_batch(frame_indices)
 
@@ -233,7 +262,7 @@ class RealEstate10K(Dataset):
                 )
                 add_cond_frames = video_reader.get_batch(context_indices)
                 frames = np.concatenate([frames.asnumpy(), add_cond_frames.asnumpy()], axis=0)
-                camera_data_cond = torch.from_numpy(np.loadtxt(lines))[context_indices].float()  # [t, ]
+                camera_data_cond = torch.from_numpy(np.asarray(camera_rows[context_indices])).float()  # [t, ]
                 camera_pose_3x4_cond = camera_data_cond[:, 7:].reshape(-1, 3, 4)  # [t, 3, 4]
                 camera_pose_4x4_cond = torch.cat([camera_pose_3x4_cond, torch.tensor([[[0.0, 0.0, 0.0, 1.0]]] * len(context_indices))], dim=1)  # [t, 4, 4]
             
@@ -258,11 +287,18 @@ class RealEstate10K(Dataset):
 
         ## spatial transformations
         if self.spatial_transform_type == 'resize_center_crop':
-            frames, camera_intrinsics, resized_H, resized_W = self._resize_for_rectangle_crop(
-                frames,
-                self.resolution[0], self.resolution[1],  # H, W
-                fx, fy, cx, cy
-            )
+            if self.frame_store is not None:
+                resized_H, resized_W = stored_resized_hw
+                camera_intrinsics = self._rectangle_crop_intrinsics(
+                    self.resolution[0], self.resolution[1],  # H, W
+                    resized_H, resized_W, fx, fy, cx, cy
+                )
+            else:
+                frames, camera_intrinsics, resized_H, resized_W = self._resize_for_rectangle_crop(
+                    frames,
+                    self.resolution[0], self.resolution[1],  # H, W
+                    fx, fy, cx, cy
+                )
             camera_data[:, 1:5] = torch.stack(
                 [
                     camera_intrinsics[:, 0, 0],  # fx
@@ -303,6 +339,9 @@ class RealEstate10K(Dataset):
             'cond_frames': add_cond_frames,
             'RT_cond': camera_pose_4x4_cond,
             'all_frames': all_frames,
+            # source frames of the clip in clip order and of the context frames, key of the ground truth artifacts
+            'frame_indices': torch.tensor(frame_indices[::-1] if to_inverse else frame_indices, dtype=torch.long),
+            'context_indices': torch.tensor(list(context_indices), dtype=torch.long),
             # 'trajs': torch.zeros(2, self.video_length, frames.shape[2], frames.shape[3])
         }
 
@@ -365,6 +404,8 @@ class RealEstate10K(Dataset):
             for sample in batch:
                 sample['cond_frames'] = sample['cond_frames'][:num_cond_frames]
                 sample['RT_cond'] = sample['RT_cond'][:num_cond_frames]
+                # the context indices identify the context frames of the sample, e.g. in the ground truth store
+                sample['context_indices'] = sample['context_indices'][:num_cond_frames]
 
         return default_collate(batch)
     
@@ -372,9 +413,9 @@ class RealEstate10K(Dataset):
         return [self.metadata[i].decode('utf-8') for i in range(len(self.metadata))]
     
     def get_index_by_name(self, name):
-        for i in range(len(self.metadata)):
-            if self.metadata[i].decode('utf-8') == name:
-                return i
+        if self._index_by_name is None:
+            self._index_by_name = {self.metadata[i].decode('utf-8'): i for i in range(len(self.metadata))}
+        return self._index_by_name.get(name, None)
 
     def __len__(self):
         return len(self.metadata)
@@ -1,3 +1,4 @@
+import contextlib
 import math
 from inspect import isfunction
 import torch
@@ -15,13 +16,62 @@ def gather_data(data, return_np=True):
 
 def autocast(f):
     def do_autocast(*args, **kwargs):
-        with torch.cuda.amp.autocast(enabled=True,
+        if torch.is_autocast_cpu_enabled():
+            # cpu inference, keep the autocast dtype selected by the caller
+            with torch.autocast("cpu", enabled=True,
+                                dtype=torch.get_autocast_cpu_dtype(),
+                                cache_enabled=torch.is_autocast_cache_enabled()):
+                return f(*args, **kwargs)
+        with torch.cuda.amp.autocast(enabled=torch.cuda.is_available(),
                                      dtype=torch.get_autocast_gpu_dtype(),
                                      cache_enabled=torch.is_autocast_cache_enabled()):
             return f(*args, **kwargs)
     return do_autocast
 
 
+@contextlib.contextmanager
+def disable_autocast():
+    """ Runs the enclosed region in full precision on any device, usable as context manager and decorator """
+    with torch.autocast("cuda", enabled=False), torch.autocast("cpu", enabled=False):
+        yield
+
+
+def get_autocast_dtype(device, precision="auto"):
+    """
+        Resolves the autocast dtype for inference on device. Returns None if autocast should be disabled.
+        precision: "auto" selects fp16 on cuda and bf16 on cpus with native bf16 support, fp32 otherwise
+    """
+    device = torch.device(device)
+    if precision == "auto":
+        if device.type == "cuda":
+            precision = "fp16"
+        else:
+            precision = "bf16" if _cpu_supports_bf16() else "fp32"
+    dtypes = {"fp32": None, "bf16": torch.bfloat16, "fp16": torch.float16}
+    if precision not in dtypes:
+        raise ValueError(f"Unknown precision '{precision}', expected one of auto, {', '.join(dtypes)}")
+    if device.type == "cpu" and precision == "fp16":
+        raise ValueError("fp16 autocast is not supported on cpu, use bf16 or fp32")
+    return dtypes[precision]
+
+
+def inference_autocast(device, precision="auto"):
+    """ Autocast context for inference on device, see get_autocast_dtype for the precision options """
+    device = torch.device(device)
+    dtype = get_autocast_dtype(device, precision)
+    if dtype is None:
+        return disable_autocast()
+    return torch.autocast(device_type=device.type, dtype=dtype)
+
+
+def _cpu_supports_bf16():
+    try:
+        # private op, older torch builds without it are treated as lacking native bf16 kernels
+        return torch.backends.mkldnn.is_available() and torch.ops.mkldnn._is_mkldnn_bf16_supported()
+    except (AttributeError, RuntimeError):
+        return False
+
+
 def extract_into_tensor(a, t, x_shape):
     b, *_ = t.shape
     out = a.gather(-1, t)
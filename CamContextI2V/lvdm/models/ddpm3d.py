@@ -15,6 +15,7 @@ from einops import rearrange, repeat
 import logging
 mainlogger = logging.getLogger('mainlogger')
 import random
+import time
 import torch
 import torch.nn as nn
 from torch.optim.lr_scheduler import LambdaLR, CosineAnnealingLR
@@ -490,6 +491,8 @@ class LatentDiffusion(DDPM):
                  logdir=None,
                  rand_cond_frame=False,
                  en_and_decode_n_samples_a_time=None,
+                 first_stage_memory_budget_mb=None,
+                 first_stage_profile=False,
                  *args, **kwargs):
         self.num_timesteps_cond = default(num_timesteps_cond, 1)
         self.scale_by_std = scale_by_std
@@ -510,7 +513,12 @@ class LatentDiffusion(DDPM):
 
         self.logdir = logdir
         self.rand_cond_frame = rand_cond_frame
+        ## first stage micro-batching: a fixed number of frames per chunk or a memory budget in MB
         self.en_and_decode_n_samples_a_time = en_and_decode_n_samples_a_time
+        self.first_stage_memory_budget_mb = first_stage_memory_budget_mb
+        self.first_stage_profile = first_stage_profile
+        self.first_stage_sample_bytes = {}
+        self.first_stage_stats = {}
 
         try:
             self.num_downs = len(first_stage_config.params.ddconfig.ch_mult) - 1
@@ -628,17 +636,8 @@ class LatentDiffusion(DDPM):
         else:
             reshape_back = False
         
-        ## consume more GPU memory but faster
-        if not self.perframe_ae:
-            encoder_posterior = self.first_stage_model.encode(x)
-            results = self.get_first_stage_encoding(encoder_posterior).detach()
-        else:  ## consume less GPU memory but slower
-            results = []
-            for index in range(x.shape[0]):
-                frame_batch = self.first_stage_model.encode(x[index:index+1,:,:,:])
-                frame_result = self.get_first_stage_encoding(frame_batch).detach()
-                results.append(frame_result)
-            results = torch.cat(results, dim=0)
+        encode = lambda x_chunk: self.get_first_stage_encoding(self.first_stage_model.encode(x_chunk)).detach()
+        results = self.run_first_stage_chunked(encode, x, mode="encode")
 
         if reshape_back:
             results = rearrange(results, '(b t) c h w -> b c t h w', b=b,t=t)
@@ -653,21 +652,105 @@ class LatentDiffusion(DDPM):
         else:
             reshape_back = False
             
-        if not self.perframe_ae:    
-            z = 1. / self.scale_factor * z
-            results = self.first_stage_model.decode(z, **kwargs)
-        else:
-            results = []
-            for index in range(z.shape[0]):
-                frame_z = 1. / self.scale_factor * z[index:index+1,:,:,:]
-                frame_result = self.first_stage_model.decode(frame_z, **kwargs)
-                results.append(frame_result)
-            results = torch.cat(results, dim=0)
+        decode = lambda z_chunk: self.first_stage_model.decode(1. / self.scale_factor * z_chunk, **kwargs)
+        results = self.run_first_stage_chunked(decode, z, mode="decode")
 
         if reshape_back:
             results = rearrange(results, '(b t) c h w -> b c t h w', b=b,t=t)
         return results
 
+    def run_first_stage_chunked(self, func, x, mode):
+        """
+            Applies the first stage function to x in micro-batches along the first dimension. The chunk size is
+            1 with perframe_ae, en_and_decode_n_samples_a_time if set, derived from first_stage_memory_budget_mb
+            if set and the whole batch otherwise. Without gradients, chunk outputs are written into a preallocated
+            output tensor instead of being concatenated at the end.
+        """
+        n = x.shape[0]
+        chunk_size = self.get_first_stage_chunk_size(x, mode)
+        stats = {"chunk_size": chunk_size, "num_chunks": 0, "chunk_times": []}
+        self.first_stage_stats[mode] = stats
+
+        results, chunks, index = None, [], 0
+        while index < n:
+            if chunk_size is None:
+                # the memory footprint of a sample is measured once on a single sample
+                chunk, elapsed = self._run_first_stage_chunk(func, x[:1], mode, probe=True)
+                chunk_size = stats["chunk_size"] = self.get_first_stage_chunk_size(x, mode)
+            else:
+                chunk, elapsed = self._run_first_stage_chunk(func, x[index:index + chunk_size], mode)
+            stats["num_chunks"] += 1
+            if elapsed is not None:
+                stats["chunk_times"].append(elapsed)
+
+            if index == 0 and chunk.shape[0] == n:
+                return chunk
+            if torch.is_grad_enabled():
+                chunks.append(chunk)
+            else:
+                if results is None:
+                    results = chunk.new_empty((n, *chunk.shape[1:]))
+                results[index:index + chunk.shape[0]] = chunk
+            index += chunk.shape[0]
+
+        return torch.cat(chunks, dim=0) if torch.is_grad_enabled() else results
+
+    def get_first_stage_chunk_size(self, x, mode):
+        """ Number of samples per first stage call, None if the memory footprint of a sample is not known yet """
+        n = x.shape[0]
+        if self.perframe_ae:
+            return 1
+        if self.en_and_decode_n_samples_a_time is not None:
+            return max(1, min(n, self.en_and_decode_n_samples_a_time))
+        if self.first_stage_memory_budget_mb is None:
+            return n
+        sample_bytes = self.first_stage_sample_bytes.get(self._first_stage_key(x, mode), None)
+        if sample_bytes is None:
+            if x.is_cuda:
+                return None
+            sample_bytes = self._estimate_first_stage_sample_bytes(x, mode)
+        return max(1, min(n, int(self.first_stage_memory_budget_mb * 2**20 // sample_bytes)))
+
+    def _run_first_stage_chunk(self, func, x, mode, probe=False):
+        profile = self.first_stage_profile or probe
+        if profile and x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        if probe:
+            # the peak statistics are not reset, callers (e.g. LongVideoGenerator) measure their own peaks
+            base_bytes = torch.cuda.memory_allocated(x.device)
+            prior_peak_bytes = torch.cuda.max_memory_allocated(x.device)
+        start = time.perf_counter()
+
+        result = func(x)
+
+        if profile and x.is_cuda:
+            torch.cuda.synchronize(x.device)
+        elapsed = time.perf_counter() - start if profile else None
+        if probe:
+            # exact if the probe raised the peak, otherwise the earlier peak bounds the footprint of the probe
+            peak_bytes = torch.cuda.max_memory_allocated(x.device)
+            sample_bytes = peak_bytes - base_bytes
+            self.first_stage_sample_bytes[self._first_stage_key(x, mode)] = max(sample_bytes, 1)
+            bound = "" if peak_bytes > prior_peak_bytes else " (upper bound)"
+            mainlogger.debug(f"first stage {mode} probe: {sample_bytes / 2**20:.1f} MB per sample{bound}")
+        return result, elapsed
+
+    def _first_stage_key(self, x, mode):
+        return (mode, tuple(x.shape[1:]), x.dtype, x.device, torch.is_grad_enabled())
+
+    def _estimate_first_stage_sample_bytes(self, x, mode):
+        # without allocator statistics: a few full resolution feature maps of the widest full resolution block
+        try:
+            ddconfig = self.first_stage_config.params.ddconfig
+            channels = ddconfig.ch * ddconfig.ch_mult[0]
+        except Exception:
+            channels = 128
+        height, width = x.shape[-2:]
+        if mode == "decode":
+            height, width = height * 2**self.num_downs, width * 2**self.num_downs
+        factor = 8 if torch.is_grad_enabled() else 4
+        return factor * channels * height * width * x.element_size()
+
     @torch.no_grad()
     def decode_first_stage(self, z, **kwargs):
         return self.decode_core(z, **kwargs)
@@ -989,10 +1072,17 @@ class LatentDiffusion(DDPM):
                                   verbose=verbose, timesteps=timesteps,
                                   mask=mask, x0=x0, **kwargs)
 
+    def get_ddim_sampler(self):
+        """ The sampler is kept across calls, such that its ddim schedules are computed once per configuration """
+        if getattr(self, "_ddim_sampler", None) is None:
+            # bypass nn.Module attribute registration, the sampler is not part of the model state
+            object.__setattr__(self, "_ddim_sampler", DDIMSampler(self))
+        return self._ddim_sampler
+
     @torch.no_grad()
     def sample_log(self, cond, batch_size, ddim, ddim_steps, **kwargs):
         if ddim:
-            ddim_sampler = DDIMSampler(self)
+            ddim_sampler = self.get_ddim_sampler()
             shape = (self.channels, self.temporal_length, *self.image_size)
             samples, intermediates = ddim_sampler.sample(ddim_steps, batch_size, shape, cond, verbose=False, **kwargs)
 
@@ -4,8 +4,47 @@ import torch
 from lvdm.models.utils_diffusion import make_ddim_sampling_parameters, make_ddim_timesteps, rescale_noise_cfg
 from lvdm.common import noise_like
 from lvdm.common import extract_into_tensor
+from lvdm.modules.attention import ContextKVCache, set_context_kv_cache
 import copy
 import math
+import time
+from collections.abc import Mapping
+
+def concat_batch(values):
+    """ Concatenates (nested) conditioning values of several branches along the batch dimension """
+    value = values[0]
+    if value is None:
+        return None
+    if isinstance(value, torch.Tensor):
+        return torch.cat(values, dim=0)
+    if isinstance(value, (list, tuple)):
+        return type(value)(concat_batch([v[i] for v in values]) for i in range(len(value)))
+    if isinstance(value, Mapping):
+        return {key: concat_batch([v[key] for v in values]) for key in value}
+    if hasattr(type(value), "cat"):
+        return type(value).cat(values)
+    return value
+
+
+def count_tensors(value) -> int:
+    """ Number of tensors in a (nested) conditioning value """
+    if isinstance(value, torch.Tensor) or hasattr(type(value), "cat"):
+        return 1
+    if isinstance(value, (list, tuple)):
+        return sum(count_tensors(v) for v in value)
+    if isinstance(value, Mapping):
+        return sum(count_tensors(v) for v in value.values())
+    return 0
+
+
+def context_sources(cond):
+    """ Tensors the cross-attention context of a conditioning branch is computed from """
+    if isinstance(cond, torch.Tensor):
+        return [cond]
+    if isinstance(cond, Mapping):
+        return [value for value in cond.get("c_crossattn", []) if isinstance(value, torch.Tensor)]
+    return []
+
 
 class DDIMSampler(object):
     def __init__(self, model, schedule="linear", **kwargs):
@@ -14,23 +53,56 @@ class DDIMSampler(object):
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
         self.counter = 0
+        # ddim schedules per (steps, spacing, eta, device), the model's noise schedule is fixed
+        self._schedule_cache = {}
+        self._schedule_key = None
+        self._schedule_buffers = {}
+        # number of camera condition tensors copied while sampling: deep copies of mutable containers and the
+        # concatenation of batched guidance, which is made once per sampling session
+        self.camera_condition_copies = 0
+        # cross-attention context K/V cache of the running sampling session
+        self.kv_cache = None
+        # batched conditioning of the guidance branches of the running sampling session, see batched_condition
+        self._batched_cond = None
+        # per-step instrumentation of the last sampling session
+        self.step_stats = []
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            # follow the device of the model, buffers are kept in float32
+            if attr.device != self.model.device:
+                attr = attr.to(self.model.device)
         setattr(self, name, attr)
+        self._schedule_buffers[name] = attr
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        """ Computes the ddim schedule, results are cached per (steps, spacing, eta, device) """
+        # the storage of alphas_cumprod identifies the noise schedule, it changes on model.register_schedule
+        key = (ddim_num_steps, ddim_discretize, float(ddim_eta), self.model.device, self.model.alphas_cumprod.data_ptr())
+        if key == self._schedule_key:
+            return
+        if key in self._schedule_cache:
+            for name, attr in self._schedule_cache[key].items():
+                setattr(self, name, attr)
+            self._schedule_key = key
+            return
+
+        self._schedule_buffers = {}
+        self._compute_schedule(ddim_num_steps, ddim_discretize, ddim_eta, verbose)
+        self._schedule_cache[key] = self._schedule_buffers
+        self._schedule_key = key
+
+    def _compute_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
         self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
                                                   num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
         alphas_cumprod = self.model.alphas_cumprod
         assert alphas_cumprod.shape[0] == self.ddpm_num_timesteps, 'alphas have to be defined for each timestep'
         to_torch = lambda x: x.clone().detach().to(torch.float32).to(self.model.device)
 
+        self._schedule_buffers['ddim_timesteps'] = self.ddim_timesteps
         if self.model.use_dynamic_rescale:
-            self.ddim_scale_arr = self.model.scale_arr[self.ddim_timesteps]
-            self.ddim_scale_arr_prev = torch.cat([self.ddim_scale_arr[0:1], self.ddim_scale_arr[:-1]])
+            self.register_buffer('ddim_scale_arr', self.model.scale_arr[self.ddim_timesteps])
+            self.register_buffer('ddim_scale_arr_prev', torch.cat([self.ddim_scale_arr[0:1], self.ddim_scale_arr[:-1]]))
 
         self.register_buffer('betas', to_torch(self.model.betas))
         self.register_buffer('alphas_cumprod', to_torch(alphas_cumprod))
@@ -131,18 +203,39 @@ class DDIMSampler(object):
         return samples, intermediates
 
     @torch.no_grad()
-    def ddim_sampling(self, cond, shape,
+    def ddim_sampling(self, cond, shape, kv_cache=True, **kwargs):
+        """
+            Runs the denoising loop within a sampling session. With kv_cache, the key/value projections
+            of the cross-attention context are computed on the first step and reused afterwards. With
+            preview_callback, preview_callback(pred_x0, i, total_steps) is called every preview_every steps.
+            With noise_generators, one torch.Generator per sample, the initial and per-step noise of every sample
+            is drawn from its own generator.
+        """
+        self.kv_cache = ContextKVCache() if kv_cache else None
+        self.step_stats = []
+        set_context_kv_cache(self.kv_cache)
+        try:
+            return self._ddim_sampling(cond, shape, **kwargs)
+        finally:
+            set_context_kv_cache(None)
+            self._batched_cond = None
+            if self.kv_cache is not None:
+                self.kv_cache.clear()
+                self.kv_cache = None
+
+    def _ddim_sampling(self, cond, shape,
                       x_T=None, ddim_use_original_steps=False,
                       callback=None, timesteps=None, quantize_denoised=False,
                       mask=None, x0=None, img_callback=None, log_every_t=100,
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
                       unconditional_guidance_scale=1., unconditional_conditioning=None, verbose=True,precision=None,fs=None,guidance_rescale=0.0,
                       latents_dir=None, latent_save_iteration: int = None,
+                      preview_callback=None, preview_every: int = 0, noise_generators=None,
                       **kwargs):
         device = self.model.betas.device        
         b = shape[0]
         if x_T is None:
-            img = torch.randn(shape, device=device)
+            img = torch.randn(shape, device=device) if noise_generators is None else self.per_sample_noise(shape, noise_generators, device)
         else:
             img = x_T
         if precision is not None:
@@ -164,9 +257,12 @@ class DDIMSampler(object):
             iterator = time_range
 
         clean_cond = kwargs.pop("clean_cond", False)
+        batched_guidance = kwargs.pop("batched_guidance", False)
         
         # cond_copy, unconditional_conditioning_copy = copy.deepcopy(cond), copy.deepcopy(unconditional_conditioning)
         for i, step in enumerate(iterator):
+            step_start = time.perf_counter()
+            kv_hits, kv_time_saved = (self.kv_cache.hits, self.kv_cache.time_saved) if self.kv_cache is not None else (0, 0.0)
             index = total_steps - i - 1
             ts = torch.full((b,), step, device=device, dtype=torch.long)
 
@@ -176,15 +272,17 @@ class DDIMSampler(object):
                 if clean_cond:
                     img_orig = x0
                 else:
-                    img_orig = self.model.q_sample(x0, ts)  # TODO: deterministic forward pass? <ddim inversion>
+                    img_orig = self.model.q_sample(x0, ts, noise=self.per_sample_noise(x0.shape, noise_generators, device, x0.dtype))  # TODO: deterministic forward pass? <ddim inversion>
                 img = img_orig * mask + (1. - mask) * img # keep original & modify use img
 
             if "paste_overlap_frames" in kwargs and kwargs["paste_overlap_frames"] and "num_overlap" in kwargs and kwargs["num_overlap"] > 0:
                 num_overlap = kwargs['num_overlap']
                 img = img.clone()
+                origin_z_0 = cond["origin_z_0"][:, :, :num_overlap, :, :]  # b,c,t,h,w
                 img[:, :, :num_overlap, :, :] = self.model.q_sample(
-                    cond["origin_z_0"][:, :, :num_overlap, :, :],  # b,c,t,h,w
+                    origin_z_0,
                     ts,
+                    noise=self.per_sample_noise(origin_z_0.shape, noise_generators, device, origin_z_0.dtype),
                 )
 
             if "noise_shaping" in kwargs and kwargs['noise_shaping'] and step >= kwargs['noise_shaping_minimum_timesteps']:
@@ -207,12 +305,22 @@ class DDIMSampler(object):
                                       unconditional_guidance_scale=unconditional_guidance_scale,
                                       unconditional_conditioning=unconditional_conditioning,
                                       mask=mask,x0=x0,fs=fs,guidance_rescale=guidance_rescale,
+                                      batched_guidance=batched_guidance, noise_generators=noise_generators,
                                       **kwargs)
             
 
             img, pred_x0 = outs
+            self.step_stats.append({
+                "step": int(step),
+                "time": time.perf_counter() - step_start,
+                "kv_cache_hits": self.kv_cache.hits - kv_hits if self.kv_cache is not None else 0,
+                "kv_cache_time_saved": self.kv_cache.time_saved - kv_time_saved if self.kv_cache is not None else 0.0,
+            })
             if callback: callback(i)
             if img_callback: img_callback(pred_x0, i)
+            # streaming previews of the denoised latents, the last step is decoded by the caller
+            if preview_callback is not None and preview_every > 0 and (i + 1) % preview_every == 0 and i + 1 < total_steps:
+                preview_callback(pred_x0, i, total_steps)
 
             if index % log_every_t == 0 or index == total_steps - 1:
                 intermediates['x_inter'].append(img)
@@ -242,6 +350,7 @@ class DDIMSampler(object):
                       temperature=1., noise_dropout=0., score_corrector=None, corrector_kwargs=None,
                       unconditional_guidance_scale=1., unconditional_conditioning=None,
                       uc_type=None, conditional_guidance_scale_temporal=None,mask=None,x0=None,guidance_rescale=0.0,
+                      batched_guidance=False, noise_generators=None,
                       **kwargs):
         
         b, *_, device = *x.shape, x.device
@@ -251,26 +360,40 @@ class DDIMSampler(object):
             is_video = False
 
         if unconditional_conditioning is None or unconditional_guidance_scale == 1.:
-            model_output = self.model.apply_model(x, t, c, **kwargs) # unet denoiser
+            model_output = self.apply_model(x, t, c, "cond", **kwargs) # unet denoiser
         else:
             ### do_classifier_free_guidance
-            if isinstance(c, torch.Tensor) or isinstance(c, dict):
-                if "enable_camera_condition" in kwargs and kwargs["enable_camera_condition"]:
-                    unconditional_conditioning["camera_condition"] = copy.deepcopy(c["camera_condition"])
-                    unconditional_conditioning["camera_condition"]["is_uc"] = True
-
-                e_t_cond = self.model.apply_model(x, t, c, **kwargs)
-                e_t_uncond = self.model.apply_model(x, t, unconditional_conditioning, **kwargs)
+            enable_camera_condition = "enable_camera_condition" in kwargs and kwargs["enable_camera_condition"]
+            camera_cfg = 1.0 if "camera_cfg" not in kwargs else kwargs["camera_cfg"]
+            e_t_cond_without_camera = None
+            if batched_guidance and isinstance(c, dict):
+                ## all guidance branches in a single forward pass of the denoiser
+                branches = [c, unconditional_conditioning]
+                if enable_camera_condition:
+                    branches[1] = {**unconditional_conditioning, "camera_condition": c["camera_condition"]}
+                    if camera_cfg != 1.0 and getattr(self.model, "supports_camera_mask", False):
+                        branches.append({key: value for key, value in c.items() if key != "camera_condition"})
+                e_t_branches = self.batched_apply_model(x, t, branches, **kwargs)
+                e_t_cond, e_t_uncond = e_t_branches[0], e_t_branches[1]
+                if len(e_t_branches) > 2:
+                    e_t_cond_without_camera = e_t_branches[2]
+            elif isinstance(c, torch.Tensor) or isinstance(c, dict):
+                if enable_camera_condition:
+                    unconditional_conditioning["camera_condition"] = self.get_uc_camera_condition(c["camera_condition"])
+
+                e_t_cond = self.apply_model(x, t, c, "cond", **kwargs)
+                e_t_uncond = self.apply_model(x, t, unconditional_conditioning, "uncond", **kwargs)
             else:
                 raise NotImplementedError
 
             model_output = e_t_uncond + unconditional_guidance_scale * (e_t_cond - e_t_uncond)
-            if "enable_camera_condition" in kwargs and kwargs["enable_camera_condition"]:
-                camera_cfg = 1.0 if "camera_cfg" not in kwargs else kwargs["camera_cfg"]
+            if enable_camera_condition:
                 camera_cfg_scheduler = "constant" if "camera_cfg_scheduler" not in kwargs else kwargs["camera_cfg_scheduler"]
                 if camera_cfg != 1.0:
-                    c_without_camera_condition = {key: value for key, value in c.items() if key != "camera_condition"}
-                    e_t_cond_without_camera = self.model.apply_model(x, t, c_without_camera_condition, **kwargs)
+                    if e_t_cond_without_camera is None:
+                        c_without_camera_condition = {key: value for key, value in c.items() if key != "camera_condition"}
+                        # shares the cross-attention context (and its cached projections) with the conditional branch
+                        e_t_cond_without_camera = self.apply_model(x, t, c_without_camera_condition, "cond", **kwargs)
                     if camera_cfg_scheduler == "constant":
                         scheduler_weight = 1.0
                     elif camera_cfg_scheduler == "cosine":
@@ -337,7 +460,10 @@ class DDIMSampler(object):
         # direction pointing to x_t
         dir_xt = (1. - a_prev - sigma_t**2).clamp(min=0).sqrt() * e_t
 
-        noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
+        if noise_generators is None:
+            noise = sigma_t * noise_like(x.shape, device, repeat_noise) * temperature
+        else:
+            noise = sigma_t * self.per_sample_noise(x.shape, noise_generators, device, x.dtype, repeat_noise) * temperature
         if noise_dropout > 0.:
             noise = torch.nn.functional.dropout(noise, p=noise_dropout)
     
@@ -345,6 +471,97 @@ class DDIMSampler(object):
 
         return x_prev, pred_x0
 
+    @staticmethod
+    def per_sample_noise(shape, generators, device, dtype=torch.float32, repeat=False):
+        """
+            Gaussian noise drawn sample by sample from generators, one torch.Generator per element of the batch,
+            hence the noise of a sample does not depend on the other samples of the batch. None without generators.
+        """
+        if generators is None:
+            return None
+        assert len(generators) == shape[0], f"Got {len(generators)} noise generators for a batch of {shape[0]}"
+        if repeat:
+            generators = generators[:1]
+        noise = torch.stack([torch.randn(shape[1:], generator=generator, device=generator.device) for generator in generators])
+        if repeat:
+            noise = noise.repeat(shape[0], *((1,) * (len(shape) - 1)))
+        return noise.to(device=device, dtype=dtype)
+
+    def get_uc_camera_condition(self, camera_condition):
+        """ Camera condition of the unconditional guidance branch """
+        if hasattr(camera_condition, "replace"):
+            # immutable container, the view shares all tensors
+            return camera_condition.replace(is_uc=True)
+        self.camera_condition_copies += count_tensors(camera_condition)
+        uc_camera_condition = copy.deepcopy(camera_condition)
+        uc_camera_condition["is_uc"] = True
+        return uc_camera_condition
+
+    def apply_model(self, x, t, cond, branch, sources=None, **kwargs):
+        """
+            Forward pass of the denoiser, branch identifies the guidance branch for the context K/V cache and
+            sources the tensors its context is computed from, by default the c_crossattn of cond.
+        """
+        if self.kv_cache is not None:
+            self.kv_cache.begin(branch, context_sources(cond) if sources is None else sources)
+        return self.model.apply_model(x, t, cond, **kwargs)
+
+    @torch.no_grad()
+    def batched_condition(self, conds, b, device):
+        """
+            Concatenation of the conditioning branches along the batch dimension. p_sample_ddim rebuilds the branch
+            dicts in every step from the same values, the concatenation is therefore cached on the identity of the
+            values and computed once per sampling session. The values must not be modified in place.
+        """
+        cache_key = (b, device, tuple(tuple((name, id(value)) for name, value in cond.items()) for cond in conds))
+        if self._batched_cond is not None and self._batched_cond[0] == cache_key:
+            return self._batched_cond[2]
+        # the entry references the values, their ids can not be reused while it is alive
+        values = [list(cond.values()) for cond in conds]
+
+        camera_conditions = [cond.get("camera_condition", None) for cond in conds]
+        shared_camera_condition = next((cc for cc in camera_conditions if cc is not None), None)
+        if shared_camera_condition is not None and any(cc is None for cc in camera_conditions):
+            conds = [
+                {**cond, "camera_condition": {
+                    **(cc if cc is not None else shared_camera_condition),
+                    "camera_mask": torch.full((b,), float(cc is not None), device=device),
+                }}
+                for cond, cc in zip(conds, camera_conditions)
+            ]
+
+        ## only keys shared by all branches are passed to the denoiser
+        keys = [key for key in conds[0] if all(key in cond for cond in conds)]
+        batched_cond = {key: concat_batch([cond[key] for cond in conds]) for key in keys}
+        self.camera_condition_copies += count_tensors(batched_cond.get("camera_condition", None))
+        self._batched_cond = (cache_key, values, batched_cond)
+        return batched_cond
+
+    @torch.no_grad()
+    def batched_apply_model(self, x, t, conds, **kwargs):
+        """
+            Runs the denoiser once on the concatenation of all conditioning branches along the batch
+            dimension and returns the per-branch outputs. Branches without camera condition share the
+            camera condition tensors of the other branches with the camera injection masked out.
+        """
+        n, b = len(conds), x.shape[0]
+        camera_conditions = [cond.get("camera_condition", None) for cond in conds]
+        if any(cc is not None for cc in camera_conditions) and any(cc is None for cc in camera_conditions):
+            if not getattr(self.model, "supports_camera_mask", False):
+                return [self.apply_model(x, t, cond, f"branch_{i}", **kwargs) for i, cond in enumerate(conds)]
+
+        batched_cond = self.batched_condition(conds, b, x.device)
+        batched_kwargs = {
+            key: value.repeat(n, *([1] * (value.dim() - 1))) if isinstance(value, torch.Tensor) and value.dim() > 0 and value.shape[0] == b else value
+            for key, value in kwargs.items()
+        }
+
+        # the K/V cache is validated on the context of the individual branches
+        sources = [source for cond in conds for source in context_sources(cond)]
+        model_output = self.apply_model(x.repeat(n, *([1] * (x.dim() - 1))), t.repeat(n), batched_cond, f"batched_{n}",
+                                        sources=sources, **batched_kwargs)
+        return model_output.chunk(n, dim=0)
+
     @torch.no_grad()
     def decode(self, x_latent, cond, t_start, unconditional_guidance_scale=1.0, unconditional_conditioning=None,
                use_original_steps=False, callback=None):
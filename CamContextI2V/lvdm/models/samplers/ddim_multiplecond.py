@@ -14,23 +14,47 @@ class DDIMSampler(object):
         self.ddpm_num_timesteps = model.num_timesteps
         self.schedule = schedule
         self.counter = 0
+        # ddim schedules per (steps, spacing, eta, device), the model's noise schedule is fixed
+        self._schedule_cache = {}
+        self._schedule_key = None
+        self._schedule_buffers = {}
 
     def register_buffer(self, name, attr):
         if type(attr) == torch.Tensor:
-            if attr.device != torch.device("cuda"):
-                attr = attr.to(torch.device("cuda"))
+            # follow the device of the model, buffers are kept in float32
+            if attr.device != self.model.device:
+                attr = attr.to(self.model.device)
         setattr(self, name, attr)
+        self._schedule_buffers[name] = attr
 
     def make_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
+        """ Computes the ddim schedule, results are cached per (steps, spacing, eta, device) """
+        # the storage of alphas_cumprod identifies the noise schedule, it changes on model.register_schedule
+        key = (ddim_num_steps, ddim_discretize, float(ddim_eta), self.model.device, self.model.alphas_cumprod.data_ptr())
+        if key == self._schedule_key:
+            return
+        if key in self._schedule_cache:
+            for name, attr in self._schedule_cache[key].items():
+                setattr(self, name, attr)
+            self._schedule_key = key
+            return
+
+        self._schedule_buffers = {}
+        self._compute_schedule(ddim_num_steps, ddim_discretize, ddim_eta, verbose)
+        self._schedule_cache[key] = self._schedule_buffers
+        self._schedule_key = key
+
+    def _compute_schedule(self, ddim_num_steps, ddim_discretize="uniform", ddim_eta=0., verbose=True):
         self.ddim_timesteps = make_ddim_timesteps(ddim_discr_method=ddim_discretize, num_ddim_timesteps=ddim_num_steps,
                                                   num_ddpm_timesteps=self.ddpm_num_timesteps,verbose=verbose)
         alphas_cumprod = self.model.alphas_cumprod
         assert alphas_cumprod.shape[0] == self.ddpm_num_timesteps, 'alphas have to be defined for each timestep'
         to_torch = lambda x: x.clone().detach().to(torch.float32).to(self.model.device)
 
+        self._schedule_buffers['ddim_timesteps'] = self.ddim_timesteps
         if self.model.use_dynamic_rescale:
-            self.ddim_scale_arr = self.model.scale_arr[self.ddim_timesteps]
-            self.ddim_scale_arr_prev = torch.cat([self.ddim_scale_arr[0:1], self.ddim_scale_arr[:-1]])
+            self.register_buffer('ddim_scale_arr', self.model.scale_arr[self.ddim_timesteps])
+            self.register_buffer('ddim_scale_arr_prev', torch.cat([self.ddim_scale_arr[0:1], self.ddim_scale_arr[:-1]]))
 
         self.register_buffer('betas', to_torch(self.model.betas))
         self.register_buffer('alphas_cumprod', to_torch(alphas_cumprod))
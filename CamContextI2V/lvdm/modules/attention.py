@@ -1,3 +1,5 @@
+import time
+
 import torch
 from torch import nn, einsum
 import torch.nn.functional as F
@@ -19,6 +21,84 @@ from lvdm.common import (
 from lvdm.basics import zero_module
 
 
+class ContextKVCache:
+    """
+        Caches the key/value projections of the cross-attention context (text and image prompt
+        tokens) within one sampling session. The context does not change between denoising steps,
+        hence the projections are computed on the first step and reused afterwards.
+        Entries are identified by the attention module, the projection, the guidance branch set via
+        begin() and the call order of the module within one forward pass of the denoiser. The entries
+        of a branch are dropped when its context is computed from other tensors than before or the
+        tensors were modified in place since.
+    """
+
+    def __init__(self):
+        self.entries = {}
+        self.branch = None
+        self._calls = {}
+        # branch -> (identity and version of the source tensors, the tensors), the references keep the ids unique
+        self._sources = {}
+        self.hits = 0
+        self.misses = 0
+        self.invalidations = 0
+        self.time_saved = 0.0
+
+    def begin(self, branch, sources=()):
+        """
+            Called before every forward pass of the denoiser, sources are the tensors the cross-attention
+            context of the branch is computed from (e.g. c_crossattn).
+        """
+        self.branch = branch
+        self._calls = {}
+        stamp = tuple((id(source), source._version) for source in sources)
+        if branch in self._sources and self._sources[branch][0] != stamp:
+            self.invalidations += 1
+            self.entries = {key: entry for key, entry in self.entries.items() if key[2] != branch}
+        self._sources[branch] = (stamp, list(sources))
+
+    def project(self, module, name, context, *projections):
+        call_key = (id(module), name)
+        call_index = self._calls.get(call_key, 0)
+        self._calls[call_key] = call_index + 1
+        key = (id(module), name, self.branch, call_index)
+
+        entry = self.entries.get(key, None)
+        if entry is not None and entry[0] == (context.shape, context.dtype, context.device):
+            self.hits += 1
+            self.time_saved += entry[1]
+            return entry[2]
+
+        self.misses += 1
+        if context.is_cuda:
+            torch.cuda.synchronize(context.device)
+        start = time.perf_counter()
+        outputs = [projection(context) for projection in projections]
+        if context.is_cuda:
+            torch.cuda.synchronize(context.device)
+        self.entries[key] = ((context.shape, context.dtype, context.device), time.perf_counter() - start, outputs)
+        return outputs
+
+    def clear(self):
+        self.entries.clear()
+        self._sources.clear()
+        self._calls = {}
+
+
+_context_kv_cache = None
+
+
+def set_context_kv_cache(cache: ContextKVCache = None):
+    global _context_kv_cache
+    _context_kv_cache = cache
+
+
+def project_context(module, name, context, *projections):
+    """ Applies the key/value projections to the context, served from the active ContextKVCache if any """
+    if _context_kv_cache is None or torch.is_grad_enabled():
+        return [projection(context) for projection in projections]
+    return _context_kv_cache.project(module, name, context, *projections)
+
+
 class RelativePosition(nn.Module):
     """ https://github.com/evelinehong/Transformer_Relative_Position_PyTorch/blob/master/relative_position.py """
 
@@ -92,13 +172,12 @@ class CrossAttention(nn.Module):
 
         if self.image_cross_attention and not spatial_self_attn:
             context, context_image = context[:, :self.text_context_len, :], context[:, self.text_context_len:, :]
-            k = self.to_k(context)
-            v = self.to_v(context)
-            k_ip = self.to_k_ip(context_image)
-            v_ip = self.to_v_ip(context_image)
+            k, v = project_context(self, "text", context, self.to_k, self.to_v)
+            k_ip, v_ip = project_context(self, "image", context_image, self.to_k_ip, self.to_v_ip)
+        elif not spatial_self_attn:
+            context = context[:, :self.text_context_len, :]
+            k, v = project_context(self, "text", context, self.to_k, self.to_v)
         else:
-            if not spatial_self_attn:
-                context = context[:, :self.text_context_len, :]
             k = self.to_k(context)
             v = self.to_v(context)
 
@@ -154,13 +233,12 @@ class CrossAttention(nn.Module):
 
         if self.image_cross_attention and not spatial_self_attn:
             context, context_image = context[:, :self.text_context_len, :], context[:, self.text_context_len:, :]
-            k = self.to_k(context)
-            v = self.to_v(context)
-            k_ip = self.to_k_ip(context_image)
-            v_ip = self.to_v_ip(context_image)
+            k, v = project_context(self, "text", context, self.to_k, self.to_v)
+            k_ip, v_ip = project_context(self, "image", context_image, self.to_k_ip, self.to_v_ip)
+        elif not spatial_self_attn:
+            context = context[:, :self.text_context_len, :]
+            k, v = project_context(self, "text", context, self.to_k, self.to_v)
         else:
-            if not spatial_self_attn:
-                context = context[:, :self.text_context_len, :]
             k = self.to_k(context)
             v = self.to_v(context)
 
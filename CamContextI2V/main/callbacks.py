@@ -27,6 +27,9 @@ from pytorch_lightning.callbacks import Callback
 from pytorch_lightning.utilities import rank_zero_only
 from pytorch_lightning.utilities import rank_zero_info
 from utils.save_video import log_local, prepare_to_log, log_evaluation
+from utils.media_writer import MediaWriterPool
+from utils.raw_store import RawSampleWriter
+from utils.gt_store import GTArtifactStore, batch_gt_keys
 from utils_train import move_tensors_to_cpu
 import pdb
 
@@ -59,7 +62,12 @@ class ImageLogger(Callback):
                     image_directory: str = 'images',
                     test_directory: str = None,
                     keys_to_log = ['image_condition','gt_video','samples'],
-                    save_suffix=''):
+                    save_suffix='',
+                    media_writer_workers: int = 0,
+                    media_writer_max_pending: int = 16,
+                    raw_output: bool = False,
+                    save_videos: bool = True,
+                    gt_store: str = None):
         super().__init__()
         self.rescale = rescale
         self.batch_freq = train_batch_frequency
@@ -78,6 +86,16 @@ class ImageLogger(Callback):
         self._cur_log_cnt = 0
         self._cur_mode: Literal["train", "val", "test"] = "none"
         self._log_first_mode = log_first_iteration
+        ## background processes encoding the test results, 0 writes synchronously
+        self.media_writer_workers = media_writer_workers
+        self.media_writer_max_pending = media_writer_max_pending
+        self.media_writer = None
+        ## lossless uint8 test results read by the evaluation instead of the videos
+        self.raw_output = raw_output
+        self.save_videos = save_videos
+        self.raw_writer = None
+        ## ground truth artifacts shared by all runs
+        self.gt_store = GTArtifactStore(gt_store) if gt_store is not None else None
 
         self.test_save_dir = test_directory if test_directory is not None else self.save_dir / "test"
         
@@ -174,10 +192,17 @@ class ImageLogger(Callback):
             pl_module.global_rank
         )
         
+        gt_keys, log_kwargs = None, {}
+        if split == "test" and self.to_local and self.gt_store is not None:
+            # test results are saved as mp4 at 7 fps, see log_evaluation below
+            gt_keys = batch_gt_keys(batch, video_format="mp4" if self.save_videos else "none", fps=7)
+            if self.gt_store.contains_all(gt_keys):
+                log_kwargs["reconstruct"] = False
+
         torch.cuda.empty_cache()
         with torch.no_grad():
             log_func = pl_module.log_images
-            batch_logs = log_func(batch, split=split, **self.log_images_kwargs)
+            batch_logs = log_func(batch, split=split, **self.log_images_kwargs, **log_kwargs)
 
         ## process: move to CPU and clamp
         batch_logs = prepare_to_log(batch_logs, self.images_per_batch, self.clamp)
@@ -186,7 +211,11 @@ class ImageLogger(Callback):
         if self.to_local:
             if split == "test":
                 save_dir = self.save_dir / split if split != "test" else self.test_save_dir
-                log_evaluation(batch_logs, save_dir, save_fps=7, rescale=True, print_out=True)
+                if gt_keys is not None:
+                    gt_keys = gt_keys[:len(batch_logs["video_path"])]
+                log_evaluation(batch_logs, save_dir, save_fps=7, rescale=True, print_out=True, writer=self.get_media_writer(),
+                               raw_writer=self.get_raw_writer(pl_module.global_rank), save_videos=self.save_videos,
+                               gt_store=self.gt_store, gt_keys=gt_keys)
             else:
                 save_dir = self.save_dir / split / f"step_{str(pl_module.global_step).zfill(6)}" / f"batch_{str(self._cur_log_cnt).zfill(4)}"
                 if os.path.exists(save_dir):
@@ -210,6 +239,29 @@ class ImageLogger(Callback):
         if is_train:
             pl_module.train()
 
+    def get_media_writer(self):
+        if self.media_writer is None and self.media_writer_workers > 0:
+            self.media_writer = MediaWriterPool(self.media_writer_workers, self.media_writer_max_pending)
+        return self.media_writer
+
+    def get_raw_writer(self, rank: int = 0):
+        if self.raw_writer is None and self.raw_output:
+            self.raw_writer = RawSampleWriter(self.test_save_dir, rank)
+        return self.raw_writer
+
+    def on_test_end(self, trainer, pl_module):
+        if self.media_writer is not None:
+            self.media_writer.flush()
+            mainlogger.info(f"[rank {pl_module.global_rank}] Media writer: {self.media_writer.written} samples written, {self.media_writer.failed} failed")
+        if self.raw_writer is not None:
+            self.raw_writer.flush()
+            mainlogger.info(f"[rank {pl_module.global_rank}] Raw output: {self.raw_writer.written} samples written")
+
+    def teardown(self, trainer, pl_module, stage):
+        if self.media_writer is not None:
+            self.media_writer.close()
+            self.media_writer = None
+
     def on_train_batch_start(self, trainer, pl_module, batch, batch_idx, dataloader_idx=None):
         if trainer.train_dataloader.dataset.additional_cond_frames in ["random", "random_true"]:
             trainer.train_dataloader.dataset.additional_cond_frames = "random_v2"
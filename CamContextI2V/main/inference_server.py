@@ -0,0 +1,255 @@
+"""
+    Request-batching inference service around Image2Video.
+
+    Requests are queued and served by a single worker thread that owns the models. The worker takes the oldest
+    request, waits up to max_wait_ms for compatible requests (same model and sampler settings, see batch_key) and
+    samples up to max_batch_size of them in one batch. The samples are split per request, every request receives the
+    return value of Image2Video.get_image. The initial and per-step noise of the sampler are drawn from the seed of each
+    request, a result does not depend on the other requests of its batch.
+
+    In-process:
+        server = InferenceServer(image2video, max_batch_size=4)
+        video_path, trace_path = server.get_image("CamContextI2V", ref_img, caption, ...)  # blocking
+        video_path, trace_path = await server.generate(model_name="CamContextI2V", ref_img=ref_img, ...)
+        server.stats()  # queue depth, batch sizes, latency percentiles
+
+    Local http, the json body holds the arguments of get_image, ref_img and ref_img2 are image paths:
+        python -m main.inference_server --port 7861
+        POST /generate, GET /stats
+"""
+import argparse
+import asyncio
+import json
+import threading
+import time
+from collections import Counter, deque
+from concurrent.futures import Future
+from dataclasses import dataclass, field
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import List, Sequence
+
+from main.runtime import Image2Video, batch_key
+
+
+def percentiles(values: Sequence[float], qs: Sequence[int] = (50, 90, 99)) -> dict:
+    """ Nearest-rank percentiles, None without values """
+    values = sorted(values)
+    if len(values) == 0:
+        return {f"p{q}": None for q in qs}
+    return {f"p{q}": values[min(len(values) - 1, int(round(q / 100 * (len(values) - 1))))] for q in qs}
+
+
+@dataclass
+class _Request:
+    arguments: dict
+    key: tuple
+    arrival: float
+    future: Future = field(default_factory=Future)
+
+
+class InferenceServer:
+    """
+        Batches compatible get_image requests of concurrent users.
+
+        Parameters:
+            image2video (Image2Video): Models of the demo, only used by the worker thread of the server.
+            max_batch_size (int): Maximum number of requests sampled in one batch.
+            max_wait_ms (float): Time the oldest request waits for compatible requests.
+            stats_window (int): Number of recent requests and batches the statistics are computed on.
+    """
+
+    def __init__(self, image2video: Image2Video, max_batch_size: int = 4, max_wait_ms: float = 50.0,
+                 stats_window: int = 1000):
+        self.image2video = image2video
+        self.max_batch_size = max(1, max_batch_size)
+        self.max_wait = max_wait_ms / 1000
+        self._pending: List[_Request] = []
+        self._condition = threading.Condition()
+        self._closed = False
+
+        self._latencies = deque(maxlen=stats_window)
+        self._queue_waits = deque(maxlen=stats_window)
+        self._batch_sizes = deque(maxlen=stats_window)
+        self._served = 0
+        self._failed = 0
+        self._stats_lock = threading.Lock()
+
+        self._worker = threading.Thread(target=self._serve, name="inference-server", daemon=True)
+        self._worker.start()
+
+    def submit(self, *args, **kwargs) -> Future:
+        """ Queues a request with the arguments of Image2Video.get_image, the future holds its result """
+        arguments = self.image2video.request_arguments(*args, **kwargs)
+        request = _Request(arguments, batch_key(arguments), time.perf_counter())
+        with self._condition:
+            if self._closed:
+                raise RuntimeError("The inference server is closed")
+            self._pending.append(request)
+            self._condition.notify()
+        return request.future
+
+    def get_image(self, *args, **kwargs):
+        """ Blocking drop-in for Image2Video.get_image """
+        return self.submit(*args, **kwargs).result()
+
+    async def generate(self, *args, **kwargs):
+        return await asyncio.wrap_future(self.submit(*args, **kwargs))
+
+    def queue_depth(self) -> int:
+        with self._condition:
+            return len(self._pending)
+
+    def stats(self) -> dict:
+        with self._stats_lock:
+            batch_sizes = list(self._batch_sizes)
+            stats = {
+                "queue_depth": self.queue_depth(),
+                "served": self._served,
+                "failed": self._failed,
+                "batches": len(batch_sizes),
+                "mean_batch_size": sum(batch_sizes) / len(batch_sizes) if len(batch_sizes) > 0 else None,
+                "batch_sizes": dict(sorted(Counter(batch_sizes).items())),
+                "latency_s": percentiles(self._latencies),
+                "queue_wait_s": percentiles(self._queue_waits),
+            }
+        return stats
+
+    def close(self):
+        """ Serves the queued requests and stops the worker """
+        with self._condition:
+            self._closed = True
+            self._condition.notify_all()
+        self._worker.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def _next_batch(self) -> List[_Request]:
+        with self._condition:
+            while len(self._pending) == 0:
+                if self._closed:
+                    return None
+                self._condition.wait()
+            first = self._pending[0]
+            deadline = first.arrival + self.max_wait
+            while True:
+                batch = [request for request in self._pending if request.key == first.key][:self.max_batch_size]
+                remaining = deadline - time.perf_counter()
+                if len(batch) >= self.max_batch_size or remaining <= 0 or self._closed:
+                    break
+                self._condition.wait(remaining)
+            for request in batch:
+                self._pending.remove(request)
+        # requests cancelled by their callers are dropped
+        return [request for request in batch if request.future.set_running_or_notify_cancel()]
+
+    def _serve(self):
+        while True:
+            batch = self._next_batch()
+            if batch is None:
+                return
+            if len(batch) == 0:
+                continue
+            start = time.perf_counter()
+            try:
+                results = self.image2video.get_image_batch([request.arguments for request in batch])
+            except Exception as e:
+                for request in batch:
+                    request.future.set_exception(e)
+                self._record(batch, start, failed=True)
+                continue
+            for request, result in zip(batch, results):
+                request.future.set_result(result)
+            self._record(batch, start, failed=False)
+
+    def _record(self, batch: List[_Request], start: float, failed: bool):
+        end = time.perf_counter()
+        with self._stats_lock:
+            self._batch_sizes.append(len(batch))
+            for request in batch:
+                self._latencies.append(end - request.arrival)
+                self._queue_waits.append(start - request.arrival)
+            if failed:
+                self._failed += len(batch)
+            else:
+                self._served += len(batch)
+
+
+def load_image(path: str):
+    import numpy as np
+    from PIL import Image
+    return np.array(Image.open(path).convert("RGB"))
+
+
+def make_http_server(server: InferenceServer, host: str = "127.0.0.1", port: int = 7861) -> ThreadingHTTPServer:
+    """ Local json api of an inference server, every http request is handled by its own thread """
+
+    class Handler(BaseHTTPRequestHandler):
+        def _reply(self, status: int, body: dict):
+            data = json.dumps(body).encode()
+            self.send_response(status)
+            self.send_header("Content-Type", "application/json")
+            self.send_header("Content-Length", str(len(data)))
+            self.end_headers()
+            self.wfile.write(data)
+
+        def do_GET(self):
+            if self.path != "/stats":
+                self._reply(404, {"error": f"Unknown path {self.path}"})
+                return
+            self._reply(200, server.stats())
+
+        def do_POST(self):
+            if self.path != "/generate":
+                self._reply(404, {"error": f"Unknown path {self.path}"})
+                return
+            try:
+                arguments = json.loads(self.rfile.read(int(self.headers.get("Content-Length", 0))))
+                for name in ("ref_img", "ref_img2"):
+                    if arguments.get(name) is not None:
+                        arguments[name] = load_image(arguments[name])
+                future = server.submit(**arguments)
+            except (ValueError, TypeError, OSError) as e:
+                self._reply(400, {"error": str(e)})
+                return
+            try:
+                outputs = future.result()
+            except Exception as e:
+                self._reply(500, {"error": str(e)})
+                return
+            self._reply(200, {"outputs": outputs})
+
+    return ThreadingHTTPServer((host, port), Handler)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Local request-batching inference server")
+    parser.add_argument("--device", type=str, default="cuda")
+    parser.add_argument("--precision", type=str, default="auto", choices=["auto", "fp16", "bf16", "fp32"])
+    parser.add_argument("--result_dir", type=str, default="./results/demo")
+    parser.add_argument("--model_meta_path", type=str, default="./configs/demo/models.json")
+    parser.add_argument("--camera_pose_meta_path", type=str, default="./configs/demo/camera_poses.json")
+    parser.add_argument("--host", type=str, default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=7861)
+    parser.add_argument("--max-batch-size", type=int, default=4)
+    parser.add_argument("--max-wait-ms", type=float, default=50.0)
+    args = parser.parse_args()
+
+    image2video = Image2Video(args.result_dir, args.model_meta_path, args.camera_pose_meta_path, device=args.device,
+                              precision=args.precision)
+    with InferenceServer(image2video, args.max_batch_size, args.max_wait_ms) as server:
+        http_server = make_http_server(server, args.host, args.port)
+        print(f"Serving on http://{args.host}:{args.port} (POST /generate, GET /stats)")
+        try:
+            http_server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            http_server.server_close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,187 @@
+"""
+    Autoregressive long-video generation with latent continuity.
+
+    A long video is sampled in chunks of video_length frames. Instead of decoding every chunk, re-encoding its last
+    frame and rebuilding the batch, the engine keeps the sampler state in latent space:
+        - the first stage encoding of the first chunk (and of the context frames of CamContextI2V) is computed once,
+        - the text and image embeddings of the first chunk are reused by all chunks,
+        - chunk k starts from the last num_overlap latent frames of chunk k-1, which are pasted into the sample at
+          every denoising step (paste_overlap_frames of ddim_sampling) and also condition the chunk,
+        - only the camera condition (poses of the chunk, epipolar masks against the fixed context frames) is
+          recomputed per chunk.
+    Every frame is decoded once, either per chunk right after sampling (streaming) or at the end.
+"""
+import time
+from dataclasses import asdict, dataclass
+from typing import Callable, List
+
+import torch
+from einops import repeat
+from torch import Tensor
+
+
+@dataclass
+class ChunkStats:
+    chunk: int
+    frames: int  # total number of frames generated so far
+    condition_time: float
+    sampling_time: float
+    decode_time: float
+    peak_memory_mb: float = None
+
+
+class LongVideoGenerator:
+    """
+        Parameters:
+            model: CameraControlLVDM model (CamContextI2V, CamI2V, CameraCtrl or MotionCtrl).
+            num_overlap (int): Latent frames shared by consecutive chunks, 0 continues from the last frame.
+            decode_chunks (bool): Decode every chunk after sampling, otherwise decode the whole video at the end.
+    """
+
+    def __init__(self, model, num_overlap: int = 1, decode_chunks: bool = True):
+        self.model = model
+        self.num_overlap = num_overlap
+        self.decode_chunks = decode_chunks
+        self.stats: List[ChunkStats] = []
+
+    def chunk_frame_indices(self, chunk: int, video_length: int) -> List[int]:
+        """ Indices of the frames of a chunk in the long video """
+        stride = video_length - self.num_overlap if self.num_overlap > 0 else video_length
+        return list(range(chunk * stride, chunk * stride + video_length))
+
+    def _unconditional_crossattn(self, c_crossattn: Tensor, x: Tensor, negative_prompt: str = None) -> Tensor:
+        """ Unconditional text and image embeddings for classifier-free guidance, as in log_images """
+        model = self.model
+        N = x.shape[0]
+        if model.uncond_type == "empty_seq":
+            uc_prompt = model.get_learned_conditioning(N * [""])
+        elif model.uncond_type == "zero_embed":
+            uc_prompt = torch.zeros_like(c_crossattn)
+        elif model.uncond_type == "negative_prompt":
+            uc_prompt = model.get_learned_conditioning(N * [negative_prompt])
+        uc_img = model.image_proj_model(model.embedder(torch.zeros_like(x[:, :, 0])))
+        return torch.cat([uc_prompt, uc_img], dim=1)
+
+    def _reuse_embeddings(self) -> bool:
+        # the pose-guided semantic branch depends on the camera poses of the chunk
+        return getattr(self.model, "multi_cond_strategy", None) != "pose_agent_enc"
+
+    @torch.no_grad()
+    def generate(self, input: dict, chunk_poses: List[Tensor], ddim_steps: int = 25, ddim_eta: float = 1.0,
+                 unconditional_guidance_scale: float = 1.0, enable_camera_condition: bool = True,
+                 trace_scale_factor: float = 1.0, cond_frame_index: Tensor = None, negative_prompt: str = None,
+                 chunk_kwargs: Callable[[int], dict] = None, on_chunk: Callable[[int, Tensor], None] = None,
+                 **kwargs) -> Tensor:
+        """
+            Samples len(chunk_poses) chunks, chunk k uses the world-to-camera poses chunk_poses[k] (b x t x 4 x 4),
+            the first chunk those of input. chunk_kwargs(k) returns additional sampler arguments of a chunk (e.g. x_T),
+            on_chunk(k, video) receives the decoded new frames of a chunk if decode_chunks. The remaining kwargs are
+            passed to the sampler. Returns the decoded video, b x c x frames x h x w in [-1, 1].
+        """
+        model = self.model
+        self.stats = []
+        T = input["video"].shape[2]
+        n = self.num_overlap
+        assert 0 <= n < T, f"num_overlap must be in [0, {T})"
+
+        start = time.perf_counter()
+        latents = model.encode_batch_latents(input)
+        # context frames of CamContextI2V follow the video frames, they are shared by all chunks
+        z, z_context = latents[:, :, :T], latents[:, :, T:]
+        encode_time = time.perf_counter() - start
+
+        c_crossattn, uc_crossattn, prev = None, None, None
+        new_latents, videos, num_frames = [], [], 0
+        for k, RT in enumerate(chunk_poses):
+            if torch.cuda.is_available():
+                torch.cuda.reset_peak_memory_stats()
+            start = time.perf_counter()
+            batch = input
+            if k > 0:
+                batch = {**input, "RT": RT}
+                cond_latent = prev[:, :, T - n] if n > 0 else prev[:, :, -1]
+                z = repeat(cond_latent, "b c h w -> b c t h w", t=T).clone()
+                if n > 0:
+                    z[:, :, :n] = prev[:, :, T - n:]
+                # the chunk is conditioned on its first frame, the last frame of the previous chunk
+                cond_frame_index = torch.zeros_like(cond_frame_index) if cond_frame_index is not None else None
+
+            z, c, fs, chunk_cond_frame_index, x = model.get_batch_input(
+                batch,
+                random_uncond=False,
+                return_fs=True,
+                return_cond_frame_index=True,
+                return_original_input=True,
+                rand_cond_frame=False,
+                enable_camera_condition=enable_camera_condition,
+                trace_scale_factor=trace_scale_factor,
+                cond_frame_index=cond_frame_index,
+                latents=torch.cat([z, z_context], dim=2),
+                c_crossattn=c_crossattn,
+            )
+            if self._reuse_embeddings():
+                c_crossattn = c["c_crossattn"][0]
+
+            uc = None
+            if unconditional_guidance_scale != 1.0:
+                if uc_crossattn is None:
+                    uc_crossattn = self._unconditional_crossattn(c["c_crossattn"][0], x, negative_prompt)
+                uc = {"c_concat": [c["c_concat"][0]], "c_crossattn": [uc_crossattn]} if "c_concat" in c else uc_crossattn
+
+            sample_kwargs = dict(kwargs, fs=fs.long(), negative_prompt=negative_prompt)
+            if k > 0 and n > 0:
+                sample_kwargs.update(paste_overlap_frames=True, num_overlap=n)
+            if chunk_kwargs is not None:
+                sample_kwargs.update(chunk_kwargs(k))
+            pre_process_log, pre_process_kwargs = model.log_images_sample_log_pre_process(
+                batch, z, x, chunk_cond_frame_index, trace_scale_factor, **sample_kwargs
+            )
+            sample_kwargs.update(pre_process_kwargs)
+            condition_time = time.perf_counter() - start + (encode_time if k == 0 else 0.0)
+
+            start = time.perf_counter()
+            with model.ema_scope("Plotting"):
+                samples, _ = model.sample_log(cond=c, batch_size=z.shape[0], ddim=True, ddim_steps=ddim_steps,
+                                              eta=ddim_eta, unconditional_guidance_scale=unconditional_guidance_scale,
+                                              unconditional_conditioning=uc, x0=z,
+                                              enable_camera_condition=enable_camera_condition, **sample_kwargs)
+            sampling_time = time.perf_counter() - start
+            prev = samples
+            # the overlapping frames are part of the previous chunk
+            new = samples if k == 0 else samples[:, :, n:]
+            num_frames += new.shape[2]
+
+            start = time.perf_counter()
+            if self.decode_chunks:
+                video = model.decode_first_stage(new)
+                videos.append(video)
+                if on_chunk is not None:
+                    on_chunk(k, video)
+            else:
+                new_latents.append(new)
+            decode_time = time.perf_counter() - start
+
+            self.stats.append(ChunkStats(
+                chunk=k, frames=num_frames, condition_time=condition_time, sampling_time=sampling_time,
+                decode_time=decode_time,
+                peak_memory_mb=torch.cuda.max_memory_allocated() / 2**20 if torch.cuda.is_available() else None,
+            ))
+
+        if not self.decode_chunks:
+            start = time.perf_counter()
+            videos = [model.decode_first_stage(torch.cat(new_latents, dim=2))]
+            self.stats[-1].decode_time += time.perf_counter() - start
+            if torch.cuda.is_available():
+                self.stats[-1].peak_memory_mb = max(self.stats[-1].peak_memory_mb, torch.cuda.max_memory_allocated() / 2**20)
+        return torch.cat(videos, dim=2)
+
+    def stats_dicts(self) -> List[dict]:
+        return [asdict(stats) for stats in self.stats]
+
+    def summary(self) -> str:
+        lines = ["chunk  frames  condition[s]  sampling[s]  decode[s]  peak memory[MiB]"]
+        for s in self.stats:
+            peak = f"{s.peak_memory_mb:.0f}" if s.peak_memory_mb is not None else "-"
+            lines.append(f"{s.chunk:5d}  {s.frames:6d}  {s.condition_time:12.2f}  {s.sampling_time:11.2f}  "
+                         f"{s.decode_time:9.2f}  {peak:>16}")
+        return "\n".join(lines)
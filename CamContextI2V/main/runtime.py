@@ -1,5 +1,9 @@
+import inspect
 import json
 import os
+import queue
+import threading
+import time
 from uuid import uuid4
 import shutil
 import numpy as np
@@ -25,6 +29,11 @@ from model.camcontexti2v import CamContextI2V
 from data.single_image_for_inference import SingleImageForInference
 from data.utils import camera_pose_lerp, create_line_point_cloud, relative_pose
 from utils.utils import instantiate_from_config
+from utils.checkpoint import build_model
+from lvdm.common import get_autocast_dtype, inference_autocast
+from utils.weight_pool import WeightPool
+from utils.preview import LatentPreview
+from main.long_video import LongVideoGenerator
 
 
 def default(a, b):
@@ -56,6 +65,64 @@ def camera_pose_lerp_bezier(c2w: Tensor, target_frames: int, coef_a: float, coef
     return torch.lerp(c2w[left_indices], c2w[right_indices], y_weights.unsqueeze(-1).unsqueeze(-1).frac())
 
 
+# sampler settings shared by all requests of a batch, the resolution is given by the model
+BATCH_PARAMETERS = ("model_name", "steps", "eta", "cfg_scale", "camera_cfg", "enable_camera_condition",
+                    "trace_scale_factor", "negative_prompt", "auto_reg_steps", "cond_frame_index")
+
+
+def batch_key(request: dict) -> tuple:
+    """ Requests (dicts of get_image arguments) with the same key can be sampled in one batch """
+    key = tuple(request.get(name) for name in BATCH_PARAMETERS)
+    batch = request.get("batch")
+    if batch is not None:
+        # number of additional condition frames of dataset samples
+        cond_frames = batch.get("cond_frames")
+        key += (tuple(cond_frames.shape) if cond_frames is not None else None,)
+    return key
+
+
+def collate_inputs(inputs: list[dict]) -> dict:
+    """ Concatenates the batch size 1 model inputs of several requests """
+    if len(inputs) == 1:
+        return inputs[0]
+    collated = {}
+    for key, value in inputs[0].items():
+        values = [input[key] for input in inputs]
+        if isinstance(value, Tensor):
+            collated[key] = torch.cat(values, dim=0)
+        elif isinstance(value, list):
+            collated[key] = [v for vs in values for v in vs]
+        else:
+            collated[key] = value
+    return collated
+
+
+def stream_image(get_image, *args, **kwargs):
+    """
+        Runs get_image (of Image2Video or InferenceServer) in a thread, yields ("preview", video_path) for the preview
+        videos during sampling and ("result", outputs) at the end. The thread keeps running if the generator is
+        closed early, concurrent callers (e.g. gradio events) must use InferenceServer.get_image, whose single worker
+        serializes the requests on the shared models.
+    """
+    updates = queue.Queue()
+
+    def run():
+        try:
+            outputs = get_image(*args, preview_callback=lambda path, step, total: updates.put(("preview", path)), **kwargs)
+            updates.put(("result", outputs))
+        except Exception as e:
+            updates.put(("error", e))
+
+    threading.Thread(target=run, daemon=True).start()
+    while True:
+        kind, value = updates.get()
+        if kind == "error":
+            raise value
+        yield kind, value
+        if kind == "result":
+            return
+
+
 class Image2Video:
     def __init__(
         self,
@@ -67,6 +134,12 @@ class Image2Video:
         save_fps: int = 10,
         device: str = "cuda",
         model_meta_data = None,
+        precision: str = "auto",
+        share_weights: bool = True,
+        preview_every: int = 5,
+        preview_mode: str = "latent_rgb",
+        latent_continuity: bool = True,
+        overlap_frames: int = 1,
     ):
         self.result_dir = result_dir
         self.model_meta_file = model_meta_path
@@ -76,16 +149,39 @@ class Image2Video:
         self.save_fps = save_fps
         self.model_meta_data = model_meta_data
         self.device = torch.device(device)
+        # autocast precision: auto (fp16 on cuda, bf16 on cpus with native support, fp32 otherwise), fp16, bf16 or fp32
+        self.precision = precision
+        get_autocast_dtype(self.device, self.precision)  # fail early on unsupported combinations
 
         os.makedirs(self.result_dir, exist_ok=True)
 
         self.models: dict[str, MotionCtrl | CameraCtrl | CamI2V | CamContextI2V] = {}
         self.single_image_processors: dict[str, SingleImageForInference] = {}
-
-    def load_model(self, config_file: str, ckpt_path: str, width: int, height: int):
+        # frozen backbone shared by all models, only the camera modules are moved on a model switch
+        self.weight_pool = WeightPool() if share_weights else None
+        # sampling steps between two previews of requests with a preview callback, 0 disables previews
+        self.preview_every = preview_every
+        self.preview_mode = preview_mode
+        # auto-regressive steps continue from the latents of the previous step instead of its last decoded frame
+        self.latent_continuity = latent_continuity
+        self.overlap_frames = overlap_frames
+
+    def _offload(self, model):
+        if self.weight_pool is not None:
+            self.weight_pool.offload(model)
+            return model
+        return model.cpu()
+
+    def load_model(self, config_file: str, ckpt_path: str, width: int, height: int, epipolar_mask_cache_mb: float = 0):
         config = OmegaConf.load(config_file)
-        config.model.params.perframe_ae = True
-        model: MotionCtrl | CameraCtrl | CamI2V = instantiate_from_config(config.model)
+        if epipolar_mask_cache_mb > 0 and config.model.params.get("epipolar_config", None) is not None:
+            # repeated demo trajectories are served from the epipolar mask cache
+            config.model.params.epipolar_config.mask_cache_max_mb = epipolar_mask_cache_mb
+        if config.model.params.get("first_stage_memory_budget_mb", None) is None:
+            # without a memory budget fall back to the frame-by-frame first stage
+            config.model.params.perframe_ae = True
+        # constructed on the meta device and materialized in fp32 from the memory-mapped checkpoint
+        model: MotionCtrl | CameraCtrl | CamI2V = build_model(config.model, ckpt_path or None, dtype=torch.float32)
         if model.rescale_betas_zero_snr:
             model.register_schedule(
                 given_betas=model.given_betas,
@@ -100,22 +196,7 @@ class Image2Video:
         for n, p in model.named_parameters():
             p.requires_grad = False
 
-        if ckpt_path:
-            state_dict = torch.load(ckpt_path, map_location="cpu", weights_only=False)
-            if "module" in state_dict:  # deepspeed checkpoint
-                state_dict = state_dict["module"]
-            elif "state_dict" in state_dict:  # lightning checkpoint
-                state_dict = state_dict["state_dict"]
-            state_dict = {k.replace("framestride_embed", "fps_embedding"): v for k, v in state_dict.items()}
-            try:
-                model.load_state_dict(state_dict, strict=True)
-                print(f"successfully loaded checkpoint {ckpt_path}")
-            except Exception as e:
-                print(e)
-                model.load_state_dict(state_dict, strict=False)
-
         model.uncond_type = "negative_prompt"
-        model = model.to(dtype=torch.float32)
         # print("model dtype", model.dtype)
 
         single_image_processor = SingleImageForInference(
@@ -129,7 +210,7 @@ class Image2Video:
 
     def offload_cpu(self):
         for k, v in self.models.items():
-            self.models[k] = v.cpu()
+            self.models[k] = self._offload(v)
         torch.cuda.empty_cache()
 
     def to(self, device: str):
@@ -137,8 +218,23 @@ class Image2Video:
             self.models[k] = v.to(device)
 
     @torch.no_grad
-    @torch.autocast("cuda", enabled=True)
-    def get_image(
+    def get_image(self, *args, **kwargs):
+        with inference_autocast(self.device, self.precision):
+            return self._get_image(*args, **kwargs)
+
+    @torch.no_grad
+    def get_image_batch(self, requests: list[dict]) -> list[list]:
+        """ Samples compatible requests (see batch_key) in one batch, requests are dicts of get_image arguments """
+        with inference_autocast(self.device, self.precision):
+            return self._generate([self.request_arguments(**request) for request in requests])
+
+    def request_arguments(self, *args, **kwargs) -> dict:
+        """ Arguments of get_image as a dict, with the defaults applied """
+        arguments = inspect.signature(self._get_image).bind(*args, **kwargs)
+        arguments.apply_defaults()
+        return dict(arguments.arguments)
+
+    def _get_image(
         self,
         model_name: str,
         ref_img: Image.Image = None,
@@ -162,12 +258,17 @@ class Image2Video:
         eta: float = 1.0,
         ref_img2: Image.Image = None,
         batch = None,
+        preview_callback = None,
     ):
-        if ref_img is None:
-            assert batch is not None, "Please provide either ref_img or batch as input"
-        if camera_pose_type != 'original':
+        """ preview_callback(video_path, step, total_steps) receives preview videos during sampling """
+        request = {k: v for k, v in locals().items() if k != "self"}
+        return self._generate([request])[0]
+
+    def _camera_trajectory(self, request: dict) -> tuple[Tensor, Tensor]:
+        """ World-to-camera poses of all generation steps and the camera trace of a request """
+        if request["camera_pose_type"] != 'original':
             with open(self.camera_pose_meta_path, "r", encoding="utf-8") as f:
-                camera_pose_file_path = json.load(f)[camera_pose_type]
+                camera_pose_file_path = json.load(f)[request["camera_pose_type"]]
 
             camera_data = torch.from_numpy(np.loadtxt(camera_pose_file_path, comments="https"))  # t, -1
             w2cs_3x4 = camera_data[:, 7:].reshape(-1, 3, 4)  # [t, 3, 4]
@@ -176,16 +277,16 @@ class Image2Video:
                 [w2cs_3x4, torch.tensor([[[0, 0, 0, 1]]] * w2cs_3x4.shape[0], device=w2cs_3x4.device)], dim=1
             )  # [t, 4, 4]
         else:
-            w2cs_4x4 = batch['RT']
+            w2cs_4x4 = request["batch"]['RT']
 
-        c2ws_4x4 = w2cs_4x4.inverse()[: max(2, int(0.5 + w2cs_4x4.shape[0] * trace_extract_ratio))]  # [t, 4, 4]
-        if use_bezier_curve:
-            c2ws_4x4 = camera_pose_lerp_bezier(c2ws_4x4, c2ws_4x4.shape[0], bezier_coef_a, bezier_coef_b)
-        if loop:
+        c2ws_4x4 = w2cs_4x4.inverse()[: max(2, int(0.5 + w2cs_4x4.shape[0] * request["trace_extract_ratio"]))]  # [t, 4, 4]
+        if request["use_bezier_curve"]:
+            c2ws_4x4 = camera_pose_lerp_bezier(c2ws_4x4, c2ws_4x4.shape[0], request["bezier_coef_a"], request["bezier_coef_b"])
+        if request["loop"]:
             c2ws_4x4 = torch.cat([c2ws_4x4, c2ws_4x4.flip(0)], dim=0)
         c2ws_lerp_4x4 = camera_pose_lerp(c2ws_4x4, self.video_length)  # [video_length, 4, 4]
         t = c2ws_lerp_4x4.shape[0]
-        ratio_t = self.video_length*(auto_reg_steps+1) / t
+        ratio_t = self.video_length*(request["auto_reg_steps"]+1) / t
         if ratio_t > 1.0:
             num_repeats = np.ceil(ratio_t).astype(np.int32)
             poses = [c2ws_lerp_4x4]
@@ -197,12 +298,12 @@ class Image2Video:
             c2ws_lerp_4x4 = torch.cat(poses, dim=0)
         w2cs_lerp_4x4 = c2ws_lerp_4x4.inverse()  # [video_length, 4, 4]
 
-        rel_c2ws_lerp_4x4 = relative_pose(c2ws_lerp_4x4, mode="left", ref_index=cond_frame_index).clone()
-        rel_c2ws_lerp_4x4[:, :3, 3] = rel_c2ws_lerp_4x4[:, :3, 3] * trace_scale_factor
+        rel_c2ws_lerp_4x4 = relative_pose(c2ws_lerp_4x4, mode="left", ref_index=request["cond_frame_index"]).clone()
+        rel_c2ws_lerp_4x4[:, :3, 3] = rel_c2ws_lerp_4x4[:, :3, 3] * request["trace_scale_factor"]
+        return w2cs_lerp_4x4, rel_c2ws_lerp_4x4
 
-        for k, v in filter(lambda x: x[0] != model_name, self.models.items()):
-            self.models[k] = v.cpu()
-        torch.cuda.empty_cache()
+    def _activate_model(self, model_name: str):
+        # a new model joins the weight pool before the others are offloaded, the shared backbone stays on the device
         if model_name not in self.models:
             if self.model_meta_data is None:
                 with open(self.model_meta_file, "r", encoding="utf-8") as f:
@@ -211,139 +312,274 @@ class Image2Video:
                 model_metadata = self.model_meta_data[model_name]
             print(f"loading model {model_name}, metadata:", model_metadata)
             model, single_image_preprocessor = self.load_model(**model_metadata)
+            if self.weight_pool is not None:
+                self.weight_pool.share(model_name, model)
+                shared_bytes, private_bytes = self.weight_pool.nbytes()
+                print(f"weight pool: {shared_bytes / 2**30:.2f} GiB shared, {private_bytes / 2**30:.2f} GiB per-model")
 
             self.models[model_name] = model
             self.single_image_processors[model_name] = single_image_preprocessor
             print("models loaded:", list(self.models.keys()))
 
+        for k, v in filter(lambda x: x[0] != model_name, self.models.items()):
+            self.models[k] = self._offload(v)
+        torch.cuda.empty_cache()
         model = self.models[model_name].to(self.device)
-        single_image_preprocessor = self.single_image_processors[model_name]
         print("using", model_name)
+        return model, self.single_image_processors[model_name]
+
+    def _save_dir(self, model_name: str, batch, taken: list[str]) -> str:
+        if batch is not None:
+            save_dir = f"{self.result_dir}/{model_name}/{Path(batch['video_path']).stem}"
+        else:
+            save_dir = f"{self.result_dir}/{model_name}/{datetime.now().strftime('%d_%m_%Y_%H_%M_%S')}"
+        if save_dir in taken:
+            # several requests of a batch for the same video or within the same second
+            save_dir = f"{save_dir}_{len(taken)}"
+        if os.path.exists(save_dir):
+            shutil.rmtree(save_dir)
+        os.makedirs(save_dir)
+        return save_dir
+
+    def _step_input(self, single_image_preprocessor, request: dict, ref_img: np.ndarray, w2cs_lerp_4x4: Tensor,
+                    frame_indices: list[int], next_autoreg_first_cond: Tensor, save_dir: str, step: int) -> dict:
+        """ Model input of a request for one generation step, batch size 1 """
+        batch = request["batch"]
+        if batch is None:
+            return single_image_preprocessor.get_batch_input(
+                ref_img,
+                "4K resolution, cinematic shot, photorealistic, detailed fur, smooth motion; " + request["caption"],
+                w2cs_lerp_4x4[frame_indices, :3], request["frame_stride"], ref_img2=request["ref_img2"]
+            )
 
-        seed_everything(seed)
+        input = copy.deepcopy(batch)
+        if not np.any(np.array(frame_indices)>= input['video'].shape[1]):
+            input['video'] = input['video'][:,frame_indices]
+            input['RT'] = input['RT'][frame_indices]
+            input['camera_intrinsics'] = input['camera_intrinsics'][frame_indices]
+        if next_autoreg_first_cond is not None:
+            input['video'][:,0] = next_autoreg_first_cond
+        #input['video'] = input['video'].half()
+        input['caption'] = "4K resolution, cinematic shot, photorealistic, detailed fur, smooth motion; " + input['caption']
+        if request["camera_pose_type"] != "original":
+            batch["RT"] = rt34_to_44(w2cs_lerp_4x4[frame_indices, :3]).to(device=self.device)
+
+        input['video'] = input['video'].unsqueeze(0).to(self.device)
+        input['caption'] = [input['caption']]
+        input['video_path'] = [input['video_path']]
+        input['RT'] = input['RT'].unsqueeze(0).to(self.device)
+        input['RT_cond'] = input['RT_cond'].unsqueeze(0).to(self.device)
+        input['frame_stride'] = torch.Tensor([input['frame_stride']]).to(self.device)
+        input['fps'] = torch.Tensor([input['fps']]).to(self.device)
+        input['camera_intrinsics'] = input['camera_intrinsics'].unsqueeze(0).to(self.device)
+        if len(input['cond_frames'].shape) > 1:
+            
+            input['cond_frames'] = input['cond_frames'].unsqueeze(0).to(self.device)
+            input['cond_frames'] = input['cond_frames'].permute(0,2,1,3,4)
+            for j in range(input['cond_frames'].shape[1]):
+                cond_frame = input['cond_frames'][0,j]
+                cond_frame = (cond_frame + 1.0) / 2.0
+                cond_frame = (cond_frame * 255).to(torch.uint8)
+                torchvision.io.write_png(cond_frame.detach().cpu(), f"{save_dir}/add_cond_step{step+1}_{j+1}.png")
+        return input
+
+    def _preview_callback(self, preview: LatentPreview, callbacks: list, save_dirs: list[str], chunk: int,
+                          num_chunks: int):
+        """ Sampler callback writing the previews of the requests of a batch, emit.times holds the preview times """
+        def emit(pred_x0: Tensor, i: int, total_steps: int):
+            start = time.perf_counter()
+            videos = preview(pred_x0)
+            for j, callback in enumerate(callbacks):
+                if callback is not None:
+                    path = self.save_video(videos[j:j+1], f"{save_dirs[j]}/preview_step{chunk+1}_{i+1:03d}.mp4")
+                    callback(path, chunk * total_steps + i + 1, num_chunks * total_steps)
+            emit.times.append(time.perf_counter() - start)
+        emit.times = []
+        return emit
+
+    def _generate_long(self, model, single_image_preprocessor, requests: list[dict], trajectories: list,
+                       ref_imgs: list, save_dirs: list[str], log_images_kwargs: dict, noise_shape: tuple,
+                       preview: LatentPreview, callbacks: list):
+        """ Auto-regressive steps with latent continuity, every frame is decoded once, see LongVideoGenerator """
+        auto_reg_steps = requests[0]["auto_reg_steps"]
+        generator = LongVideoGenerator(model, num_overlap=self.overlap_frames)
+        frame_indices = generator.chunk_frame_indices(0, self.video_length)
+        print(f"{auto_reg_steps+1} generation steps with latent continuity, {self.overlap_frames} overlapping frames")
+        inputs = []
+        for j, request in enumerate(requests):
+            Image.fromarray(ref_imgs[j]).save(f"{save_dirs[j]}/cond_step1.png")
+            inputs.append(self._step_input(single_image_preprocessor, request, ref_imgs[j], trajectories[j][0],
+                                           frame_indices, None, save_dirs[j], 0))
+        input = collate_inputs(inputs)
+        input["cond_frame_index"] = torch.tensor(
+            [requests[0]["cond_frame_index"]] * input["video"].shape[0], device=input["video"].device, dtype=torch.long
+        )
+        # the following steps continue the interpolated trajectory of each request
+        chunk_poses = [input["RT"]] + [
+            torch.stack([
+                rt34_to_44(w2cs_lerp_4x4[generator.chunk_frame_indices(k, self.video_length), :3])
+                for w2cs_lerp_4x4, _ in trajectories
+            ]).to(self.device)
+            for k in range(1, auto_reg_steps + 1)
+        ]
+
+        def chunk_kwargs(k: int) -> dict:
+            kwargs = self._noise_kwargs(requests, noise_shape, k)
+            if preview is not None:
+                kwargs["preview_every"] = self.preview_every
+                kwargs["preview_callback"] = self._preview_callback(preview, callbacks, save_dirs, k, auto_reg_steps+1)
+            return kwargs
+
+        full_clips = [[] for _ in requests]
+
+        def on_chunk(k: int, video: Tensor):
+            video_clips = video.clamp(-1.0, 1.0).float().cpu()  # b, c, f, h, w
+            for j in range(len(requests)):
+                self.save_video(video_clips[j:j+1], f"{save_dirs[j]}/step{k+1}.mp4")
+                full_clips[j].append(video_clips[j:j+1])
+
+        generator.generate(input, chunk_poses, cond_frame_index=input["cond_frame_index"], chunk_kwargs=chunk_kwargs,
+                           on_chunk=on_chunk, **log_images_kwargs)
+        print(generator.summary())
+        for save_dir in save_dirs:
+            with open(f"{save_dir}/long_video_stats.json", 'w') as f:
+                json.dump(generator.stats_dicts(), f, indent=4)
+        return full_clips, inputs, generator.chunk_frame_indices(auto_reg_steps, self.video_length)
+
+    def _noise_kwargs(self, requests: list[dict], noise_shape: tuple, step: int) -> dict:
+        """ Sampler noise of a generation step, every request draws its initial and per-step noise from its own seed """
+        generators = [torch.Generator().manual_seed(request["seed"] + step) for request in requests]
+        x_T = torch.stack([torch.randn(noise_shape, generator=generator) for generator in generators])
+        return {"x_T": x_T.to(self.device), "noise_generators": generators}
+
+    def _generate(self, requests: list[dict]) -> list[list]:
+        shared = requests[0]
+        key = batch_key(shared)
+        for request in requests:
+            if request["ref_img"] is None:
+                assert request["batch"] is not None, "Please provide either ref_img or batch as input"
+            if batch_key(request) != key:
+                raise ValueError("Requests of a batch must use the same model and sampler settings")
+        model_name, auto_reg_steps, cond_frame_index = shared["model_name"], shared["auto_reg_steps"], shared["cond_frame_index"]
+        trajectories = [self._camera_trajectory(request) for request in requests]
+
+        model, single_image_preprocessor = self._activate_model(model_name)
+
+        seed_everything(shared["seed"])
         log_images_kwargs = {
-            "ddim_steps": steps,
-            "ddim_eta": eta,
-            "unconditional_guidance_scale": cfg_scale,
+            "ddim_steps": shared["steps"],
+            "ddim_eta": shared["eta"],
+            "unconditional_guidance_scale": shared["cfg_scale"],
             "timestep_spacing": "uniform_trailing",
             "guidance_rescale": 0.7,
-            "camera_cfg": camera_cfg,
+            "camera_cfg": shared["camera_cfg"],
             "camera_cfg_scheduler": "constant",
-            "enable_camera_condition": enable_camera_condition,
-            "trace_scale_factor": trace_scale_factor,
+            "enable_camera_condition": shared["enable_camera_condition"],
+            "trace_scale_factor": shared["trace_scale_factor"],
             "result_dir": self.result_dir,
-            "negative_prompt": negative_prompt,
+            "negative_prompt": shared["negative_prompt"],
             "auto_regressive_steps": auto_reg_steps
         }
-        curr_time = datetime.now()
-        formatted_time = curr_time.strftime("%d_%m_%Y_%H_%M_%S")
         os.makedirs(f"{self.result_dir}/{model_name}", exist_ok=True)
-        if batch is not None:
-            video_name = str(Path(batch["video_path"]).stem)
-            save_dir = f"{self.result_dir}/{model_name}/{video_name}"
-        else:
-            save_dir = f"{self.result_dir}/{model_name}/{formatted_time}"
-        if os.path.exists(save_dir):
-            shutil.rmtree(save_dir)
-        os.makedirs(save_dir)
-        with open(f"{save_dir}/config.txt", 'w') as f:
-            f.write(json.dumps(log_images_kwargs, indent=4))
-
-        full_clip = []
+        save_dirs = []
+        for request in requests:
+            save_dir = self._save_dir(model_name, request["batch"], save_dirs)
+            with open(f"{save_dir}/config.txt", 'w') as f:
+                f.write(json.dumps({**log_images_kwargs, "seed": request["seed"]}, indent=4))
+            save_dirs.append(save_dir)
+
+        ref_imgs = []
         #initial_ref_img = np.copy(ref_img)
-        if batch is not None:
-            ref_img = batch["video"][:,0].cpu().numpy()
-            ref_img = np.clip((ref_img + 1.) / 2., 0., 1.)
-            ref_img = (np.transpose(ref_img, (1,2,0))*255).astype(np.uint8)
-
-        next_autoreg_first_cond = None
-        for i in range(auto_reg_steps+1):
-            frame_indices = list(range(i*self.video_length, (i+1)*self.video_length))
-            print(f"{i+1}. generation step")
-            img_save = Image.fromarray(ref_img)
-            img_save.save(f"{save_dir}/cond_step{i+1}.png")
-
-            #if ref_img2 is None and i > 0:
-            #    ref_img2 = initial_ref_img
-            if batch is None:
-                input = single_image_preprocessor.get_batch_input(
-                    ref_img,
-                    "4K resolution, cinematic shot, photorealistic, detailed fur, smooth motion; " + caption,
-                    w2cs_lerp_4x4[frame_indices, :3], frame_stride, ref_img2=ref_img2
-                )
-            else:
-                input = copy.deepcopy(batch)
-                if not np.any(np.array(frame_indices)>= input['video'].shape[1]):
-                    input['video'] = input['video'][:,frame_indices]
-                    input['RT'] = input['RT'][frame_indices]
-                    input['camera_intrinsics'] = input['camera_intrinsics'][frame_indices]
-                if next_autoreg_first_cond is not None:
-                    input['video'][:,0] = next_autoreg_first_cond
-                #input['video'] = input['video'].half()
-                input['caption'] = "4K resolution, cinematic shot, photorealistic, detailed fur, smooth motion; " + input['caption']
-                if camera_pose_type != "original":
-                    batch["RT"] = rt34_to_44(w2cs_lerp_4x4[frame_indices, :3]).to(device=self.device)
-
-                input['video'] = input['video'].unsqueeze(0).to(self.device)
-                input['caption'] = [input['caption']]
-                input['video_path'] = [input['video_path']]
-                input['RT'] = input['RT'].unsqueeze(0).to(self.device)
-                input['RT_cond'] = input['RT_cond'].unsqueeze(0).to(self.device)
-                input['frame_stride'] = torch.Tensor([input['frame_stride']]).to(self.device)
-                input['fps'] = torch.Tensor([input['fps']]).to(self.device)
-                input['camera_intrinsics'] = input['camera_intrinsics'].unsqueeze(0).to(self.device)
-                if len(input['cond_frames'].shape) > 1:
-                    
-                    input['cond_frames'] = input['cond_frames'].unsqueeze(0).to(self.device)
-                    input['cond_frames'] = input['cond_frames'].permute(0,2,1,3,4)
-                    for j in range(input['cond_frames'].shape[1]):
-                        cond_frame = input['cond_frames'][0,j]
-                        cond_frame = (cond_frame + 1.0) / 2.0
-                        cond_frame = (cond_frame * 255).to(torch.uint8)
-                        torchvision.io.write_png(cond_frame.detach().cpu(), f"{save_dir}/add_cond_step{i+1}_{j+1}.png")
-
-            input["cond_frame_index"] = torch.tensor(
-                [cond_frame_index] * input["video"].shape[0], device=input["video"].device, dtype=torch.long
+        for request in requests:
+            ref_img = request["ref_img"]
+            if request["batch"] is not None:
+                ref_img = request["batch"]["video"][:,0].cpu().numpy()
+                ref_img = np.clip((ref_img + 1.) / 2., 0., 1.)
+                ref_img = (np.transpose(ref_img, (1,2,0))*255).astype(np.uint8)
+            ref_imgs.append(ref_img)
+
+        # initial and per-step noise from the seed of each request, independent of the other requests of the batch
+        noise_shape = (model.channels, model.temporal_length, *model.image_size)
+        callbacks = [request.get("preview_callback") for request in requests]
+        preview = None
+        if self.preview_every > 0 and any(callback is not None for callback in callbacks):
+            preview = LatentPreview(model, self.preview_mode)
+        if auto_reg_steps > 0 and self.latent_continuity:
+            full_clips, inputs, frame_indices = self._generate_long(
+                model, single_image_preprocessor, requests, trajectories, ref_imgs, save_dirs, log_images_kwargs,
+                noise_shape, preview, callbacks,
             )
-            log_images_kwargs["cond_frame_index"] = input["cond_frame_index"].clone()
-
-            output = model.log_images(input, **log_images_kwargs)
-            video_clip = output["samples"].clamp(-1.0, 1.0).cpu()  # b, c, f, h, w
-
-            next_autoreg_first_cond = video_clip[0,:,-1]
-            
-
-            ref_img = video_clip[0,:,-1]
-            ref_img = (ref_img + 1.0) / 2.0
-            ref_img = (ref_img * 255).to(torch.uint8)
-            #torchvision.io.write_png(ref_img.detach().cpu(), f"{save_dir}/cond_step{i+1}.png")
-            ref_img = ref_img.permute(1,2,0)
-            ref_img = ref_img.numpy()
-
-            video_path = f"{save_dir}/step{i+1}.mp4"
-            self.save_video(video_clip, video_path)
-
-            full_clip.append(video_clip)
-
-        if len(full_clip) == 1:
-            video_clip = full_clip[0]
         else:
-            video_clip = torch.cat(full_clip, dim=2)
-        
-        print(f"video clip shape: {video_clip.shape}")
-
-        video_path = f"{save_dir}/generated.mp4"
-        self.save_video(video_clip, video_path)
-        gt_path = f"{save_dir}/ground_truth.mp4"
-        self.save_video(input['video'].detach().cpu(), gt_path)
-        return_list = [video_path]
-
-        if self.return_camera_trace:
-            points, colors = self.get_camera_trace(rel_c2ws_lerp_4x4[frame_indices, :3])
-            scene_with_camera_path = self.save_pcd("output_with_cam", points, colors)
-            return_list.append(scene_with_camera_path)
-
-        return return_list
+            full_clips = [[] for _ in requests]
+            next_autoreg_first_conds = [None] * len(requests)
+            for i in range(auto_reg_steps+1):
+                frame_indices = list(range(i*self.video_length, (i+1)*self.video_length))
+                print(f"{i+1}. generation step")
+                inputs = []
+                for j, request in enumerate(requests):
+                    img_save = Image.fromarray(ref_imgs[j])
+                    img_save.save(f"{save_dirs[j]}/cond_step{i+1}.png")
+                    inputs.append(self._step_input(single_image_preprocessor, request, ref_imgs[j], trajectories[j][0],
+                                                   frame_indices, next_autoreg_first_conds[j], save_dirs[j], i))
+                input = collate_inputs(inputs)
+
+                input["cond_frame_index"] = torch.tensor(
+                    [cond_frame_index] * input["video"].shape[0], device=input["video"].device, dtype=torch.long
+                )
+                log_images_kwargs["cond_frame_index"] = input["cond_frame_index"].clone()
+                log_images_kwargs.update(self._noise_kwargs(requests, noise_shape, i))
+
+                preview_kwargs = {}
+                if preview is not None:
+                    preview_kwargs = {
+                        "preview_every": self.preview_every,
+                        "preview_callback": self._preview_callback(preview, callbacks, save_dirs, i, auto_reg_steps+1),
+                    }
+                start = time.perf_counter()
+                output = model.log_images(input, sampled_img_num=len(requests), **log_images_kwargs, **preview_kwargs)
+                total_time = time.perf_counter() - start
+                # the previews are timed outside of the sampling steps
+                sampling_time = sum(stats["time"] for stats in model.get_ddim_sampler().step_stats)
+                preview_time = sum(preview_kwargs["preview_callback"].times) if preview is not None else 0.0
+                if preview is not None:
+                    print(f"previews: {preview.summary()}")
+                print(f"sampling {sampling_time:.2f}s, previews {preview_time:.2f}s, "
+                      f"decode and conditioning {total_time - sampling_time - preview_time:.2f}s")
+                video_clips = output["samples"].clamp(-1.0, 1.0).cpu()  # b, c, f, h, w
+
+                for j in range(len(requests)):
+                    video_clip = video_clips[j:j+1]
+                    next_autoreg_first_conds[j] = video_clip[0,:,-1]
+
+                    ref_img = video_clip[0,:,-1]
+                    ref_img = (ref_img + 1.0) / 2.0
+                    ref_img = (ref_img * 255).to(torch.uint8)
+                    #torchvision.io.write_png(ref_img.detach().cpu(), f"{save_dir}/cond_step{i+1}.png")
+                    ref_img = ref_img.permute(1,2,0)
+                    ref_imgs[j] = ref_img.numpy()
+
+                    self.save_video(video_clip, f"{save_dirs[j]}/step{i+1}.mp4")
+                    full_clips[j].append(video_clip)
+
+        results = []
+        for j, full_clip in enumerate(full_clips):
+            video_clip = full_clip[0] if len(full_clip) == 1 else torch.cat(full_clip, dim=2)
+            print(f"video clip shape: {video_clip.shape}")
+
+            video_path = f"{save_dirs[j]}/generated.mp4"
+            self.save_video(video_clip, video_path)
+            gt_path = f"{save_dirs[j]}/ground_truth.mp4"
+            self.save_video(inputs[j]['video'].detach().cpu(), gt_path)
+            return_list = [video_path]
+
+            if self.return_camera_trace:
+                points, colors = self.get_camera_trace(trajectories[j][1][frame_indices, :3])
+                name = "output_with_cam" if len(requests) == 1 else f"output_with_cam_{Path(save_dirs[j]).name}"
+                scene_with_camera_path = self.save_pcd(name, points, colors)
+                return_list.append(scene_with_camera_path)
+            results.append(return_list)
+
+        return results
 
     def get_camera_trace(self, rel_c2ws: Tensor):
         points, colors = [], []
@@ -9,7 +9,7 @@ sys.path.insert(1, os.path.join(sys.path[0], '..'))
 sys.path.insert(2, os.path.join(sys.path[0], '../DynDepth-Anything-V2/metric_depth'))
 from utils.utils import instantiate_from_config
 from utils_train import get_trainer_callbacks, get_trainer_logger, get_trainer_strategy
-from utils_train import init_workspace, load_checkpoints, setup_logger, cleanup_logging, save_model_summary
+from utils_train import init_workspace, instantiate_with_checkpoint, load_checkpoints, setup_logger, cleanup_logging, save_model_summary
 import pdb
 torch.backends.cuda.matmul.allow_tf32 = True
 torch.backends.cudnn.allow_tf32 = True
@@ -77,14 +77,15 @@ if __name__ == "__main__":
     ## MODEL CONFIG >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
     logger.info("***** Configing Model *****")
     config.model.params.logdir = workdir
-    model = instantiate_from_config(config.model)
-    cleanup_logging()
-    # print(model)
     ## load checkpoints
     if args.load_from_checkpoint == "":
-        model = load_checkpoints(model, config.model)
+        # constructed on the meta device if the checkpoint covers the whole model (test runs)
+        model = instantiate_with_checkpoint(config.model)
     else:
+        model = instantiate_from_config(config.model)
         logger.info('Do not load pretrained model')
+    cleanup_logging()
+    # print(model)
 
     ## register_schedule again to make ZTSNR work
     if model.rescale_betas_zero_snr:
@@ -13,6 +13,9 @@ from pathlib import Path
 
 from pytorch_lightning.utilities.model_summary import ModelSummary
 
+from utils.utils import instantiate_from_config
+from utils.checkpoint import build_model, load_weights
+
 def init_workspace(logdir, model_config, lightning_config, rank=0):
     ckptdir = os.path.join(logdir, "checkpoints")
     cfgdir = os.path.join(logdir, "configs")
@@ -167,52 +170,25 @@ def load_checkpoints(model, model_cfg):
         pretrained_ckpt = model_cfg.pretrained_checkpoint
         assert os.path.exists(pretrained_ckpt), "Error: Pre-trained checkpoint NOT found at:%s"%pretrained_ckpt
         mainlogger.info(">>> Load weights from pretrained checkpoint")
-        pl_sd = torch.load(pretrained_ckpt, map_location="cpu")
-        try:
-            if 'state_dict' in pl_sd.keys():  # ddp
-                try:
-                    model.load_state_dict(pl_sd["state_dict"], strict=True)
-                except:
-                    ## rename the keys for 256x256 model
-                    new_pl_sd = OrderedDict()
-                    for k, v in pl_sd["state_dict"].items():
-                        new_pl_sd[k] = v
-
-                    for k in list(new_pl_sd.keys()):
-                        if "framestride_embed" in k:
-                            new_key = k.replace("framestride_embed", "fps_embedding")
-                            new_pl_sd[new_key] = new_pl_sd[k]
-                            del new_pl_sd[k]
-                    try:
-                        model.load_state_dict(new_pl_sd, strict=True)
-                        print('ddp load mode strict=True succeeded')
-                    except:
-                        model.load_state_dict(new_pl_sd, strict=False)
-                        print('ddp load mode strict=False succeeded')
-                    del new_pl_sd
-
-                mainlogger.info(">>> Loaded weights from pretrained checkpoint: %s"%pretrained_ckpt)
-            else:  # deepspeed
-                new_pl_sd = OrderedDict()
-                for key in pl_sd['module'].keys():
-                    # new_pl_sd[key[16:]]=pl_sd['module'][key]
-                    new_pl_sd[key]=pl_sd['module'][key]
-                try:
-                    model.load_state_dict(new_pl_sd, strict=True)
-                    print('deepspeed load mode strict=True succeeded')
-                except:
-                    model.load_state_dict(new_pl_sd, strict=False)
-                    print('deepspeed load mode strict=False succeeded')
-        except:
-            model.load_state_dict(pl_sd, strict=False)
-            print('ddp & deepload load failed, plain load succeeded')
-
-        del pl_sd
+        # lightning, deepspeed and plain checkpoints are converted once and read memory-mapped
+        report = load_weights(model, pretrained_ckpt)
+        report.log(pretrained_ckpt)
     else:
         mainlogger.info(">>> Start training from scratch")
 
     return model
 
+def instantiate_with_checkpoint(model_cfg):
+    """ Instantiates the model and loads the pretrained checkpoint """
+    if not check_config_attribute(model_cfg, "pretrained_checkpoint"):
+        mainlogger.info(">>> Start training from scratch")
+        return instantiate_from_config(model_cfg)
+    pretrained_ckpt = model_cfg.pretrained_checkpoint
+    assert os.path.exists(pretrained_ckpt), "Error: Pre-trained checkpoint NOT found at:%s"%pretrained_ckpt
+    # the pretrained checkpoint (the DynamiCrafter base) does not cover the camera modules, the model is constructed
+    # regularly instead of trying the meta device first
+    return build_model(model_cfg, pretrained_ckpt, lazy=False)
+
 #def set_logger(logfile, name='mainlogger'):
 #    logger = logging.getLogger(name)
 #    logger.setLevel(logging.INFO)
@@ -11,6 +11,7 @@ import os
 
 from utils.transforms import resample_poses_slerp
 from lvdm.models.samplers.ddim import DDIMSampler
+from lvdm.common import disable_autocast
 from model.dynamicrafter import DynamiCrafter
 from utils.utils import instantiate_from_config
 
@@ -18,6 +19,9 @@ mainlogger = logging.getLogger('mainlogger')
 
 
 class CameraControlLVDM(DynamiCrafter):
+    # whether the modified UNet forwards honor camera_condition["camera_mask"], required to batch guidance branches without camera condition
+    supports_camera_mask = False
+
     def __init__(self,
                  diffusion_model_trainable_param_list=[],
                  pose_encoder_trainable=True,
@@ -110,7 +114,7 @@ class CameraControlLVDM(DynamiCrafter):
         return optimizer
 
     @torch.no_grad()
-    @torch.autocast(device_type="cuda", enabled=False)
+    @disable_autocast()
     def ray_condition(self, K, c2w, H, W, device, flip_flag=None):
         # c2w: B, V, 4, 4
         # K: B, V, 3, 3
@@ -173,7 +177,7 @@ class CameraControlLVDM(DynamiCrafter):
         plucker = rearrange(plucker, "b f h w c -> b c f h w")  # [b, 6, f, h, w]
         return plucker
 
-    @torch.autocast(device_type="cuda", enabled=False)
+    @disable_autocast()
     def get_relative_pose(self, RT_4x4: Tensor, cond_frame_index: Tensor, mode='left', normalize_T0=False):
         '''
         :param
@@ -234,10 +238,19 @@ class CameraControlLVDM(DynamiCrafter):
         return prepared_batch
 
 
+    @torch.no_grad()
+    def encode_batch_latents(self, batch):
+        """ First stage encoding of the video of a batch, see the latents argument of get_batch_input """
+        return self.encode_first_stage(super().get_input(batch, self.first_stage_key))
+
     def get_batch_input(self, batch, random_uncond, return_first_stage_outputs=False, return_original_cond=False, return_fs=False,
                         return_cond_frame_index=False, return_cond_frame=False, return_original_input=False, rand_cond_frame=None,
                         enable_camera_condition=True, return_camera_data=False, return_video_path=False, return_depth_scale=False,
-                        trace_scale_factor=1.0, cond_frame_index=None, **kwargs):
+                        trace_scale_factor=1.0, cond_frame_index=None, latents=None, c_crossattn=None, **kwargs):
+        """
+            latents: first stage encoding of the batch (encode_batch_latents), replaces the encoding of the video
+            c_crossattn: text and image embeddings of a previous call, replaces their computation
+        """
         ## x: b c t h w
         
         x = super().get_input(batch, self.first_stage_key)
@@ -249,15 +262,16 @@ class CameraControlLVDM(DynamiCrafter):
 
 
         ## encode video frames x to z via a 2D encoder
-        z = self.encode_first_stage(x)
+        z = latents if latents is not None else self.encode_first_stage(x)
 
         ## get caption condition
         cond_input = batch[self.cond_stage_key]
 
-        if isinstance(cond_input, dict) or isinstance(cond_input, list):
-            cond_emb = self.get_learned_conditioning(cond_input)
-        else:
-            cond_emb = self.get_learned_conditioning(cond_input.to(self.device))
+        if c_crossattn is None:
+            if isinstance(cond_input, dict) or isinstance(cond_input, list):
+                cond_emb = self.get_learned_conditioning(cond_input)
+            else:
+                cond_emb = self.get_learned_conditioning(cond_input.to(self.device))
 
         cond = {}
         ## to support classifier-free guidance, randomly drop out only text conditioning 5%, only image conditioning 5%, and both 5%.
@@ -268,9 +282,10 @@ class CameraControlLVDM(DynamiCrafter):
         prompt_mask = rearrange(random_num < 2 * self.uncond_prob, "n -> n 1 1")
         input_mask = 1 - rearrange((random_num >= self.uncond_prob).float() * (random_num < 3 * self.uncond_prob).float(), "n -> n 1 1 1")
 
-        if not hasattr(self, "null_prompt"):
-            self.null_prompt = self.get_learned_conditioning([""])
-        prompt_imb = torch.where(prompt_mask, self.null_prompt, cond_emb.detach())
+        if c_crossattn is None:
+            if not hasattr(self, "null_prompt"):
+                self.null_prompt = self.get_learned_conditioning([""])
+            prompt_imb = torch.where(prompt_mask, self.null_prompt, cond_emb.detach())
 
         ## get conditioning frame
         if cond_frame_index is None:
@@ -279,11 +294,13 @@ class CameraControlLVDM(DynamiCrafter):
             if rand_cond_frame:
                 cond_frame_index = torch.randint(0, self.model.diffusion_model.temporal_length, (batch_size,), device=device)
         
-        img = x[torch.arange(batch_size, device=device), :, cond_frame_index, ...]
-        img = input_mask * img
-        ## img: b c h w
-        img_emb = self.embedder(img)  ## b l c
-        img_emb = self.image_proj_model(img_emb)
+        if c_crossattn is None:
+            img = x[torch.arange(batch_size, device=device), :, cond_frame_index, ...]
+            img = input_mask * img
+            ## img: b c h w
+            img_emb = self.embedder(img)  ## b l c
+            img_emb = self.image_proj_model(img_emb)
+            c_crossattn = torch.cat([prompt_imb, img_emb], dim=1)  ## concat in the seq_len dim
 
         if self.model.conditioning_key == 'hybrid':
             if self.interp_mode:
@@ -300,7 +317,7 @@ class CameraControlLVDM(DynamiCrafter):
             cond["c_concat"] = [img_cat_cond]  # b c t h w
             cond["c_cond_frame_index"] = cond_frame_index
             cond["origin_z_0"] = z.clone()
-        cond["c_crossattn"] = [torch.cat([prompt_imb, img_emb], dim=1)]  ## concat in the seq_len dim
+        cond["c_crossattn"] = [c_crossattn]
 
         ########################################### only change here, add camera_condition input ###########################################
         depth_scale = torch.ones((batch_size,), device=device)
@@ -357,6 +374,7 @@ class CameraControlLVDM(DynamiCrafter):
         enable_camera_condition=True,
         trace_scale_factor=1.0,
         cond_frame_index=None,
+        reconstruct=True,
         **kwargs,
     ):
         """ log images for LatentVisualDiffusion """
@@ -380,10 +398,10 @@ class CameraControlLVDM(DynamiCrafter):
         use_ddim = ddim_steps is not None
         log = dict()
         
-        z, c, xrec, xc, fs, cond_frame_index, cond_x, x, camera_data, video_path, depth_scale = self.get_batch_input(
+        batch_input = self.get_batch_input(
             batch_,
             random_uncond=False,
-            return_first_stage_outputs=True,
+            return_first_stage_outputs=reconstruct,
             return_original_cond=True,
             return_fs=True,
             return_cond_frame_index=True,
@@ -397,16 +415,21 @@ class CameraControlLVDM(DynamiCrafter):
             trace_scale_factor=trace_scale_factor,
             cond_frame_index=cond_frame_index,
         )
+        if not reconstruct:
+            # the ground truth artifacts are stored already, no decoding of the first stage outputs
+            batch_input.insert(2, None)
+        z, c, xrec, xc, fs, cond_frame_index, cond_x, x, camera_data, video_path, depth_scale = batch_input
         
 
 
-        N = xrec.shape[0]
+        N = z.shape[0]
         log["depth_scale"] = depth_scale
         log["camera_data"] = camera_data
         log["video_path"] = video_path
         log["gt_video"] = x
         log["image_condition"] = cond_x
-        log["reconst"] = xrec
+        if xrec is not None:
+            log["reconst"] = xrec
         xc_with_fs = []
         for idx, content in enumerate(xc):
             xc_with_fs.append(content + '_fs=' + str(fs[idx].item()))
@@ -433,7 +456,7 @@ class CameraControlLVDM(DynamiCrafter):
                     prompts = N * [kwargs["negative_prompt"]]
                     uc_prompt = self.get_learned_conditioning(prompts)
 
-                img = torch.zeros_like(xrec[:, :, 0])  ## b c h w
+                img = torch.zeros_like(x[:, :, 0])  ## b c h w
                 ## img: b c h w
                 img_emb = self.embedder(img)  ## b l c
                 uc_img = self.image_proj_model(img_emb)
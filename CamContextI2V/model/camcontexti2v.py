@@ -21,9 +21,11 @@ from model.modules.modified_forwards import (
     new_forward_for_cross_attention
 )
 from model.modules.utils import CrossNormalization
-from model.modules.epipolar import Epipolar, pix2coord
+from model.modules.epipolar import Epipolar, get_epipolar_band, pix2coord
+from model.modules.mask_cache import EpipolarMaskCache
+from model.modules.camera_condition import CameraCondition
 from utils.utils import instantiate_from_config, human_readable_number
-from lvdm.common import extract_into_tensor, default
+from lvdm.common import extract_into_tensor, default, disable_autocast
 
 mainlogger = logging.getLogger('mainlogger')
 
@@ -34,6 +36,8 @@ class CamContextI2V(CameraControlLVDM):
         add_type (str): Type of to add the plucker embeddings into the UNet.
         multi_cond_strategy (str): Strategy for combining multiple context condition images.
     """
+    supports_camera_mask = True
+
     def __init__(self,
                     add_type="add_into_temporal_attn",
                     multi_cond_strategy: Literal['max', 'avg', 'token_concat'] = None,
@@ -107,6 +111,24 @@ class CamContextI2V(CameraControlLVDM):
                 self.epipolar_config.pluker_add_type = "add_to_pre_x_only"
             if not hasattr(self.epipolar_config, "add_small_perturbation_on_zero_T"):
                 self.epipolar_config.add_small_perturbation_on_zero_T = False
+            if not hasattr(self.epipolar_config, "sparse_attention"):
+                self.epipolar_config.sparse_attention = False
+            if not hasattr(self.epipolar_config, "mask_cache_max_mb"):
+                # opt-in, the entries live on the device of the model
+                self.epipolar_config.mask_cache_max_mb = 0
+            if self.epipolar_config.sparse_attention and (
+                self.epipolar_config.epipolar_hybrid_attention
+                or self.epipolar_config.epipolar_hybrid_attention_v2
+                or self.epipolar_config.only_self_pixel_on_current_frame
+                or self.epipolar_config.current_frame_as_register_token
+            ):
+                mainlogger.warning("Sparse epipolar attention does not support the selected mask modifications. Falling back to dense epipolar masks.")
+                self.epipolar_config.sparse_attention = False
+
+        # Epipolar masks only depend on the camera parameters, repeated trajectories during inference are served from a cache
+        self.epipolar_mask_cache = None
+        if self.epipolar_config is not None and self.epipolar_config.mask_cache_max_mb > 0:
+            self.epipolar_mask_cache = EpipolarMaskCache(max_bytes=int(self.epipolar_config.mask_cache_max_mb * 2**20))
 
         bound_method = new_forward_for_unet.__get__(
             self.model.diffusion_model,
@@ -170,7 +192,7 @@ class CamContextI2V(CameraControlLVDM):
                         # _module.add_module('norm_epipolar', nn.LayerNorm(_module.attn1.to_k.in_features))
 
     @torch.no_grad()
-    @torch.autocast(device_type="cuda", enabled=False)
+    @disable_autocast()
     def get_relative_c2w_RT_pairs(self, RT: Tensor):
         '''
         :param RT: B, T, 4 4   c2w relative RT
@@ -184,7 +206,7 @@ class CamContextI2V(CameraControlLVDM):
         return relative_RT_pairs  # B,T,T,4,4
 
     @torch.no_grad()
-    @torch.autocast(device_type="cuda", enabled=False)
+    @disable_autocast()
     def get_fundamental_matrix(self, K: Tensor, R: Tensor, t: Tensor) -> Tensor:
         '''
         :param   K: B, 3, 3
@@ -198,7 +220,7 @@ class CamContextI2V(CameraControlLVDM):
         return F
 
     @torch.no_grad()
-    @torch.autocast(device_type="cuda", enabled=False)
+    @disable_autocast()
     def get_epipolar_mask(self, F: Tensor, T: int, H: int, W: int, downsample: int, final_rearrange: bool = True):
         """
         modified to take in batch inputs
@@ -270,6 +292,41 @@ class CamContextI2V(CameraControlLVDM):
         else:
             return mask
 
+    @torch.no_grad()
+    @disable_autocast()
+    def get_epipolar_band(self, F: Tensor, T: int, H: int, W: int, downsample: int, final_rearrange: bool = True):
+        """
+        Sparse alternative to get_epipolar_mask() that never materializes the dense mask.
+
+        Args:
+            F: camera fundamental matrix (B, T1, T2, 3, 3)
+            resolution: feature map resolution H * W
+            downsample: downsample scale
+
+        return: EpipolarBand holding the key indices of every query (B, T1*HW, T2, K)
+        """
+        return get_epipolar_band(F, H, W, downsample)
+
+    def get_epipolar_mask_func(self):
+        if self.epipolar_config is not None and self.epipolar_config.sparse_attention:
+            return self.get_epipolar_band
+        return self.get_epipolar_mask
+
+    def fetch_epipolar_mask(self, mask_func, F: Tensor, T: int, H: int, W: int, downsample: int, K: Tensor, RT: Tensor, *args, tag: str = "unet"):
+        """
+        Returns mask_func(F, T, H, W, downsample, *args), served from the epipolar mask cache during inference.
+
+        Args:
+            K: camera intrinsics the fundamental matrices F are computed from
+            RT: relative c2w poses the fundamental matrices F are computed from
+            tag: distinguishes masks of different consumers with identical camera parameters
+        """
+        compute_func = lambda F_: mask_func(F_, T, H, W, downsample, *args)
+        if self.epipolar_mask_cache is None or self.training:
+            return compute_func(F)
+        keys = self.epipolar_mask_cache.make_keys(K, RT, H, W, downsample, tag, mask_func.__name__, *args, str(F.device))
+        return self.epipolar_mask_cache.fetch(keys, F, compute_func)
+
     def add_small_perturbation(self, t, epsilon=1e-6):
         zero_mask = (t.abs() < epsilon).all(dim=-2, keepdim=True)  # 检查 T 的 x, y, z 是否都接近 0
         perturbation = torch.randn_like(t) * epsilon  # 生成微小扰动
@@ -277,10 +334,24 @@ class CamContextI2V(CameraControlLVDM):
 
         return t
     
+    @torch.no_grad()
+    def encode_batch_latents(self, batch):
+        """ First stage encoding of the video of a batch, followed by the context frames for the latent multi condition """
+        x = super().get_input(batch, self.first_stage_key)
+        if 'cond_frames' in batch and batch['cond_frames'] is not None \
+                and self.multi_cond_strategy in ['token_concat_latent', 'token_concat_latent_epipolar']:
+            cond_frames = super().get_input(batch, 'cond_frames')
+            x = torch.cat([x, rearrange(cond_frames, 'B C D H W -> B D C H W')], dim=2)
+        return self.encode_first_stage(x)
+
     def get_batch_input(self, batch, random_uncond, return_first_stage_outputs=False, return_original_cond=False, return_fs=False,
                     return_cond_frame_index=False, return_cond_frame=False, return_original_input=False, rand_cond_frame=None,
                     enable_camera_condition=True, return_camera_data=False, return_video_path=False, return_depth_scale=False,
-                    trace_scale_factor=1.0, cond_frame_index=None, **kwargs):
+                    trace_scale_factor=1.0, cond_frame_index=None, latents=None, c_crossattn=None, **kwargs):
+        """
+            latents: first stage encoding of the batch (encode_batch_latents), replaces the encoding of the video
+            c_crossattn: text and image embeddings of a previous call, replaces their computation
+        """
         ## x: b c t h w
         x = super().get_input(batch, self.first_stage_key)
         T = x.shape[2]
@@ -317,7 +388,7 @@ class CamContextI2V(CameraControlLVDM):
                 x = torch.cat([x, rearrange(cond_frames, 'B C D H W -> B D C H W')], dim=2)
 
         ## encode video frames x to z via a 2D encoder
-        z = self.encode_first_stage(x)
+        z = latents if latents is not None else self.encode_first_stage(x)
         
         if self.multi_cond_strategy == 'token_concat_latent':
             
@@ -383,62 +454,65 @@ class CamContextI2V(CameraControlLVDM):
         ## get caption condition
         cond_input = batch[self.cond_stage_key]
 
-        if isinstance(cond_input, dict) or isinstance(cond_input, list):
-            cond_emb = self.get_learned_conditioning(cond_input)
-        else:
-            cond_emb = self.get_learned_conditioning(cond_input.to(self.device))
-
         cond = {}
-        ## to support classifier-free guidance, randomly drop out only text conditioning 5%, only image conditioning 5%, and both 5%.
-        if random_uncond:
-            random_num = torch.rand(x.size(0), device=x.device)
-        else:
-            random_num = torch.ones(x.size(0), device=x.device)  ## by doning so, we can get text embedding and complete img emb for inference
-        prompt_mask = rearrange(random_num < 2 * self.uncond_prob, "n -> n 1 1")
-        input_mask = 1 - rearrange((random_num >= self.uncond_prob).float() * (random_num < 3 * self.uncond_prob).float(), "n -> n 1 1 1")
+        if c_crossattn is None:
+            if isinstance(cond_input, dict) or isinstance(cond_input, list):
+                cond_emb = self.get_learned_conditioning(cond_input)
+            else:
+                cond_emb = self.get_learned_conditioning(cond_input.to(self.device))
 
-        if not hasattr(self, "null_prompt"):
-            self.null_prompt = self.get_learned_conditioning([""])
-        prompt_imb = torch.where(prompt_mask, self.null_prompt, cond_emb.detach())
+            ## to support classifier-free guidance, randomly drop out only text conditioning 5%, only image conditioning 5%, and both 5%.
+            if random_uncond:
+                random_num = torch.rand(x.size(0), device=x.device)
+            else:
+                random_num = torch.ones(x.size(0), device=x.device)  ## by doning so, we can get text embedding and complete img emb for inference
+            prompt_mask = rearrange(random_num < 2 * self.uncond_prob, "n -> n 1 1")
+            input_mask = 1 - rearrange((random_num >= self.uncond_prob).float() * (random_num < 3 * self.uncond_prob).float(), "n -> n 1 1 1")
+
+            if not hasattr(self, "null_prompt"):
+                self.null_prompt = self.get_learned_conditioning([""])
+            prompt_imb = torch.where(prompt_mask, self.null_prompt, cond_emb.detach())
         
 
-        ###################################################################################################################################
-        ########################################### only change here, add multi condition input ###########################################
-        batch_size = x.shape[0]
-        img = x[torch.arange(batch_size, device=device), :, cond_frame_index, ...]
-        if self.use_semantic_branch and cond_frames is not None:
-            num_cond_frames = cond_frames.shape[1]
+            ###################################################################################################################################
+            ########################################### only change here, add multi condition input ###########################################
+            batch_size = x.shape[0]
             img = x[torch.arange(batch_size, device=device), :, cond_frame_index, ...]
-            img = torch.concatenate((img.unsqueeze(1), cond_frames), dim=1)
-            img = input_mask.unsqueeze(-1) * img
-            img = rearrange(img, "b t c h w -> (b t) c h w")
-        else:
-            img = input_mask * img
-        ########################################### only change here, add multi condition input ###########################################
-        ###################################################################################################################################
+            if self.use_semantic_branch and cond_frames is not None:
+                num_cond_frames = cond_frames.shape[1]
+                img = x[torch.arange(batch_size, device=device), :, cond_frame_index, ...]
+                img = torch.concatenate((img.unsqueeze(1), cond_frames), dim=1)
+                img = input_mask.unsqueeze(-1) * img
+                img = rearrange(img, "b t c h w -> (b t) c h w")
+            else:
+                img = input_mask * img
+            ########################################### only change here, add multi condition input ###########################################
+            ###################################################################################################################################
 
-        ## img: b c h w
-        ##-- CLIP Embedding --##
+            ## img: b c h w
+            ##-- CLIP Embedding --##
         
-        img_emb = self.embedder(img)  ## b l c
-        img_emb = self.image_proj_model(img_emb)
-        ###################################################################################################################################
-        ########################################### only change here, add multi condition input ###########################################
+            img_emb = self.embedder(img)  ## b l c
+            img_emb = self.image_proj_model(img_emb)
+            ###################################################################################################################################
+            ########################################### only change here, add multi condition input ###########################################
         
-        if self.use_semantic_branch and 'cond_frames' in batch and batch['cond_frames'] is not None:
-            img_emb = img_emb.view(batch_size, num_cond_frames+1, img_emb.shape[-2], img_emb.shape[-1])
-            if self.multi_cond_strategy == 'pose_agent_enc':
-                pose_features = camera_condition_kwargs['camera_condition']['pluker_embedding_features']
-                self.multi_cond_func(
-                    context = img_emb,
-                    pose_embedding = pose_features,
-                    attn_mask =  None # TODO: Implement epipolar masking
-                )
-                img_emb = rearrange(img_emb, "B C N D -> B (C N) D")
-            else:
-                img_emb = self.multi_cond_func(img_emb)
-        ########################################### only change here, add multi condition input ###########################################
-        ###################################################################################################################################
+            if self.use_semantic_branch and 'cond_frames' in batch and batch['cond_frames'] is not None:
+                img_emb = img_emb.view(batch_size, num_cond_frames+1, img_emb.shape[-2], img_emb.shape[-1])
+                if self.multi_cond_strategy == 'pose_agent_enc':
+                    pose_features = camera_condition_kwargs['camera_condition']['pluker_embedding_features']
+                    self.multi_cond_func(
+                        context = img_emb,
+                        pose_embedding = pose_features,
+                        attn_mask =  None # TODO: Implement epipolar masking
+                    )
+                    img_emb = rearrange(img_emb, "B C N D -> B (C N) D")
+                else:
+                    img_emb = self.multi_cond_func(img_emb)
+            ########################################### only change here, add multi condition input ###########################################
+            ###################################################################################################################################
+            c_crossattn = torch.cat([prompt_imb, img_emb], dim=1)  ## concat in the seq_len dim
+
         if self.model.conditioning_key == 'hybrid':
             if self.interp_mode:
                 ## starting frame + (L-2 empty frames) + ending frame
@@ -453,7 +527,7 @@ class CamContextI2V(CameraControlLVDM):
             cond["c_concat"] = [img_cat_cond]  # b c t h w 
             cond["c_cond_frame_index"] = cond_frame_index
             cond["origin_z_0"] = z.clone()
-        cond["c_crossattn"] = [torch.cat([prompt_imb, img_emb], dim=1)]  ## concat in the seq_len dim
+        cond["c_crossattn"] = [c_crossattn]
 
         if return_fs:
             if self.fps_condition_type == 'fs':
@@ -491,7 +565,7 @@ class CamContextI2V(CameraControlLVDM):
         return out
 
     def compute_conditional_epipolar_mask(self, batch, H, W, downsample_factor: int = 8, return_squeezed_tokens: bool = False, cond_frame_indices: Tensor = None):
-        with torch.no_grad(), torch.autocast('cuda', enabled=False):
+        with torch.no_grad(), disable_autocast():
             camera_intrinsics_3x3 = super().get_input(batch, 'camera_intrinsics').float()  # b, t, 3, 3
             w2c_RT_4x4 = super().get_input(batch, 'RT').float()  # b, t, 4, 4
             w2c_RT_4x4_cond = super().get_input(batch, 'RT_cond').float()  # b, c, 4, 4
@@ -516,7 +590,11 @@ class CamContextI2V(CameraControlLVDM):
             F = rearrange(F, 'B (T C) H W -> B T C H W', C=C)
             
             T = c2w_RT_4x4.shape[1]
-            epipolar_mask = self.get_epipolar_mask(F, T, H // downsample_factor, W // downsample_factor, downsample_factor, return_squeezed_tokens)
+            epipolar_mask_func = self.get_epipolar_mask_func() if return_squeezed_tokens else self.get_epipolar_mask
+            epipolar_mask = self.fetch_epipolar_mask(
+                epipolar_mask_func, F, T, H // downsample_factor, W // downsample_factor, downsample_factor,
+                camera_intrinsics_3x3, relative_c2w_RT_4x4, return_squeezed_tokens, tag="conditional"
+            )
 
         return epipolar_mask
 
@@ -526,7 +604,7 @@ class CamContextI2V(CameraControlLVDM):
         return_log = {}
         return_kwargs = {}
         batch_size, num_frames, device, H, W = x.shape[0], x.shape[2], self.model.device, x.shape[3], x.shape[4]
-        with torch.no_grad(), torch.autocast('cuda', enabled=False):
+        with torch.no_grad(), disable_autocast():
             
             camera_intrinsics_3x3 = super().get_input(batch, 'camera_intrinsics').float()  # b, t, 3, 3
             w2c_RT_4x4 = super().get_input(batch, 'RT').float()  # b, t, 4, 4
@@ -549,12 +627,16 @@ class CamContextI2V(CameraControlLVDM):
 
                 F = self.get_fundamental_matrix(K, R, t)
                 
-                sample_locs_dict = {d: self.get_epipolar_mask(F, T, H // d, W // d, d) for d in [int(8 * ds) for ds in self.epipolar_config.attention_resolution]}
+                epipolar_mask_func = self.get_epipolar_mask_func()
+                sample_locs_dict = {
+                    d: self.fetch_epipolar_mask(epipolar_mask_func, F, T, H // d, W // d, d, camera_intrinsics_3x3, relative_c2w_RT_4x4)
+                    for d in [int(8 * ds) for ds in self.epipolar_config.attention_resolution]
+                }
             else:
                 sample_locs_dict = None
 
         if self.pose_encoder is not None:
-            with torch.no_grad(), torch.autocast('cuda', enabled=False):
+            with torch.no_grad(), disable_autocast():
                 pluker_embedding = self.ray_condition(camera_intrinsics_3x3, relative_c2w_RT_4x4, H, W, device, flip_flag=None)  # b, 6, t, H, W
 
             pluker_embedding_features = self.pose_encoder(pluker_embedding)  # bf c h w
@@ -562,12 +644,12 @@ class CamContextI2V(CameraControlLVDM):
         else:
             pluker_embedding_features = None
 
-        return_kwargs["camera_condition"] = {
+        return_kwargs["camera_condition"] = CameraCondition({
             "pluker_embedding_features": pluker_embedding_features,
             "sample_locs_dict": sample_locs_dict,
             "cond_frame_index": cond_frame_index,
             "add_type": self.add_type,
-        }
+        })
 
         return return_log, return_kwargs
     
@@ -657,6 +739,7 @@ class CamContextI2V(CameraControlLVDM):
         enable_camera_condition=True,
         trace_scale_factor=1.0,
         cond_frame_index=None,
+        reconstruct=True,
         **kwargs,
     ):
         # Overwrites functions in parent class
@@ -677,10 +760,10 @@ class CamContextI2V(CameraControlLVDM):
         use_ddim = ddim_steps is not None
         log = dict()
 
-        z, c, xrec, xc, fs, cond_frame_index, cond_x, x, camera_data, video_path, depth_scale = self.get_batch_input(
+        batch_input = self.get_batch_input(
             batch,
             random_uncond=False,
-            return_first_stage_outputs=True,
+            return_first_stage_outputs=reconstruct,
             return_original_cond=True,
             return_fs=True,
             return_cond_frame_index=True,
@@ -694,13 +777,18 @@ class CamContextI2V(CameraControlLVDM):
             trace_scale_factor=trace_scale_factor,
             cond_frame_index=cond_frame_index,
         )
-        N = xrec.shape[0]
+        if not reconstruct:
+            # the ground truth artifacts are stored already, no decoding of the first stage outputs
+            batch_input.insert(2, None)
+        z, c, xrec, xc, fs, cond_frame_index, cond_x, x, camera_data, video_path, depth_scale = batch_input
+        N = z.shape[0]
         log["depth_scale"] = depth_scale
         log["camera_data"] = camera_data
         log["video_path"] = video_path
         log["gt_video"] = x
         log["image_condition"] = cond_x
-        log["reconst"] = xrec
+        if xrec is not None:
+            log["reconst"] = xrec
         if 'cond_frames' in batch.keys():
             log["cond_frames"] = batch["cond_frames"]
         xc_with_fs = []
@@ -730,7 +818,7 @@ class CamContextI2V(CameraControlLVDM):
                     prompts = N * [kwargs["negative_prompt"]]
                     uc_prompt = self.get_learned_conditioning(prompts)
 
-                img = torch.zeros_like(xrec[:, :, 0])  ## b c h w
+                img = torch.zeros_like(x[:, :, 0])  ## b c h w
                 ## img: b c h w
                 img_emb = self.embedder(img)  ## b l c
                 uc_img = self.image_proj_model(img_emb)
@@ -757,6 +845,8 @@ class CamContextI2V(CameraControlLVDM):
                                                          enable_camera_condition=enable_camera_condition, **kwargs)
             x_samples = self.decode_first_stage(samples)
             log["samples"] = x_samples
+            if self.epipolar_mask_cache is not None:
+                mainlogger.debug(f"Epipolar mask cache: {self.epipolar_mask_cache.stats()}")
 
             log.update(self.log_images_sample_log_post_process(x_samples, **pre_process_log))
 
@@ -0,0 +1,33 @@
+class CameraCondition(dict):
+    """
+        Immutable container for the camera condition passed through the UNet (plucker features,
+        epipolar masks, conditioning frame index, ...). Per-branch overrides, e.g. for the
+        unconditional branch of classifier-free guidance, are derived through replace() and
+        share all tensors with the original container instead of copying them.
+    """
+
+    def replace(self, **overrides) -> "CameraCondition":
+        """ Returns a view with the given entries overridden, tensors are shared and never cloned """
+        return CameraCondition({**self, **overrides})
+
+    def _immutable(self, *args, **kwargs):
+        raise TypeError("CameraCondition is immutable, use replace() to derive a modified view")
+
+    __setitem__ = _immutable
+    __delitem__ = _immutable
+    clear = _immutable
+    pop = _immutable
+    popitem = _immutable
+    setdefault = _immutable
+    update = _immutable
+    __ior__ = _immutable
+
+    def __copy__(self):
+        return self
+
+    def __deepcopy__(self, memo):
+        # the container is immutable, copies would only duplicate the (large) condition tensors
+        return self
+
+    def __reduce__(self):
+        return (CameraCondition, (dict(self),))
@@ -1,4 +1,5 @@
 import pdb
+from math import sqrt
 
 import numpy as np
 import torch
@@ -40,6 +41,124 @@ def coord2pix(y, downsample):
     return (y + 0.5 - downsample / 2.0) / downsample
 
 
+class EpipolarBand:
+    """
+    Compact representation of an epipolar attention mask. Instead of the dense
+    B x L1 x (T2 H W) boolean mask, every query stores the positions of the keys
+    lying on its epipolar line in each of the T2 key frames.
+
+    Args:
+        index: B x L1 x T2 x K key positions within a key frame (0 .. H*W-1)
+        valid: B x L1 x T2 x K marks entries of index that lie on the epipolar line
+        tokens_per_frame: number of key tokens per key frame (H*W)
+    """
+
+    def __init__(self, index: Tensor, valid: Tensor, tokens_per_frame: int):
+        self.index = index
+        self.valid = valid
+        self.tokens_per_frame = tokens_per_frame
+
+    @property
+    def shape(self):
+        """ Shape of the equivalent dense mask: B x L1 x L2 """
+        B, L1, T2, _ = self.index.shape
+        return torch.Size((B, L1, T2 * self.tokens_per_frame))
+
+    @property
+    def band_width(self):
+        return self.index.shape[-1]
+
+    @property
+    def nbytes(self):
+        return self.index.numel() * self.index.element_size() + self.valid.numel() * self.valid.element_size()
+
+    def to(self, *args, **kwargs):
+        return EpipolarBand(self.index.to(*args, **kwargs), self.valid.to(*args, **kwargs), self.tokens_per_frame)
+
+    def select_frame(self, frame_index: Tensor):
+        """ Keep only the key frame frame_index (B,) of every sample, keys are then B x L1 x L2=(H W) """
+        batch_index = torch.arange(self.index.shape[0], device=self.index.device)
+        return EpipolarBand(
+            self.index[batch_index, :, frame_index].unsqueeze(2),
+            self.valid[batch_index, :, frame_index].unsqueeze(2),
+            self.tokens_per_frame,
+        )
+
+    def key_index(self):
+        """ Flattened key positions into the (T2 H W) key sequence: B x L1 x (T2 K) """
+        T2 = self.index.shape[2]
+        offsets = torch.arange(T2, device=self.index.device) * self.tokens_per_frame
+        return rearrange(self.index + offsets.view(1, 1, T2, 1), "B L T K -> B L (T K)")
+
+    def __getitem__(self, item):
+        return EpipolarBand(self.index[item], self.valid[item], self.tokens_per_frame)
+
+    @staticmethod
+    def cat(bands: list):
+        """ Concatenates bands along the batch dimension, padding them to a common band width """
+        band_width = max(band.band_width for band in bands)
+        pad = lambda t, value: torch.nn.functional.pad(t, (0, band_width - t.shape[-1]), value=value)
+        return EpipolarBand(
+            torch.cat([pad(band.index, 0) for band in bands], dim=0),
+            torch.cat([pad(band.valid, False) for band in bands], dim=0),
+            bands[0].tokens_per_frame,
+        )
+
+    def to_dense(self):
+        """ Materializes the dense B x L1 x L2 boolean mask, only meant for debugging """
+        B, L1, L2 = self.shape
+        mask = torch.zeros((B, L1, L2), dtype=torch.uint8, device=self.index.device)
+        # padded entries may share their index with a valid key, hence accumulate instead of overwrite
+        mask.scatter_add_(-1, self.key_index(), self.valid.flatten(2).to(torch.uint8))
+        return mask > 0
+
+
+@torch.no_grad()
+def get_epipolar_band(F: Tensor, H: int, W: int, downsample: int, query_chunk_size: int = 1024) -> EpipolarBand:
+    """
+    Sparse counterpart of the dense epipolar mask. Distances between the epipolar
+    lines and the key pixels are only evaluated for query_chunk_size queries at a time
+    and each query keeps the indices of the keys within its band.
+
+    Args:
+        F: camera fundamental matrices (B, T1, T2, 3, 3)
+        H, W: feature map resolution
+        downsample: downsample scale of the feature map
+        query_chunk_size: number of query tokens processed at once
+    Returns:
+        EpipolarBand with B x (T1 H W) x T2 x K key indices
+    """
+    device = F.device
+    F = F.float()
+
+    y = pix2coord(torch.arange(0, H, dtype=torch.float, device=device), downsample)  # H
+    x = pix2coord(torch.arange(0, W, dtype=torch.float, device=device), downsample)  # W
+    grid_y, grid_x = torch.meshgrid(y, x, indexing="ij")  # H * W
+    grid = torch.stack([grid_x, grid_y, torch.ones_like(grid_x)], dim=2).view(-1, 3)  # H*W, 3
+
+    lines = F @ grid.transpose(-1, -2)  # [B, T1, T2, 3, H*W]
+    lines = lines / torch.norm(lines[..., :2, :], dim=-2, keepdim=True)
+    lines = rearrange(lines, "B T1 T2 C HW -> B (T1 HW) T2 C")  # [B, L1, T2, 3]
+    threshold = downsample * sqrt(2) / 2
+
+    index_chunks, valid_chunks = [], []
+    for start in range(0, lines.shape[1], query_chunk_size):
+        dist = (lines[:, start:start + query_chunk_size] @ grid.transpose(-1, -2)).abs()  # [B, l, T2, H*W]
+        in_band = dist < threshold
+        # stable sort moves the keys within the band to the front while keeping their order
+        _, order = torch.sort(in_band.to(torch.uint8), dim=-1, descending=True, stable=True)
+        width = max(int(in_band.sum(dim=-1).max()), 1)
+        order = order[..., :width]
+        index_chunks.append(order)
+        valid_chunks.append(torch.gather(in_band, -1, order))
+
+    band_width = max(chunk.shape[-1] for chunk in index_chunks)
+    index = torch.cat([torch.nn.functional.pad(c, (0, band_width - c.shape[-1]), value=0) for c in index_chunks], dim=1)
+    valid = torch.cat([torch.nn.functional.pad(c, (0, band_width - c.shape[-1]), value=False) for c in valid_chunks], dim=1)
+
+    return EpipolarBand(index, valid, H * W)
+
+
 class EpipolarCrossAttention(nn.Module):
 
     def __init__(self, query_dim, context_dim=None, out_dim=None, heads=8, dim_head=64,
@@ -76,9 +195,11 @@ class EpipolarCrossAttention(nn.Module):
         '''
         :param x:       B,L1,C
         :param context:       B,L2,C
-        :param attn_mask: B,L1,L2
+        :param attn_mask: B,L1,L2 or EpipolarBand
         :return:
         '''
+        if isinstance(attn_mask, EpipolarBand):
+            return self.sparse_forward(x, context, attn_mask)
         # pdb.set_trace()
         q = self.to_q(x)
         B = q.shape[0]
@@ -101,6 +222,60 @@ class EpipolarCrossAttention(nn.Module):
 
         return self.to_out(out)
 
+    def sparse_forward(self, x: Tensor, context: Tensor, band: EpipolarBand, max_pairs_per_chunk: int = 2**18):
+        '''
+        Attends every query only to the keys within its epipolar band (plus the register tokens),
+        so compute and memory scale with the band width instead of L2.
+        :param x:       B,L1,C
+        :param context:       B,L2,C
+        :param band:    EpipolarBand with B,L1,T2,K key indices into context
+        :param max_pairs_per_chunk: upper bound of query-key pairs gathered at once
+        :return:
+        '''
+        q = self.to_q(x)
+        B, L1 = q.shape[:2]
+        k = self.to_k(context)
+        v = self.to_v(context)
+        q = rearrange(q, "B L (H D) -> B H L D", H=self.heads)
+
+        if self.num_register_tokens > 0:
+            k_reg, v_reg = map(
+                lambda t: rearrange(t, "1 R (H D) -> H R D", H=self.heads),
+                (self.to_k(self.register_tokens), self.to_v(self.register_tokens))
+            )
+
+        key_index = band.key_index()  # B, L1, N
+        valid = band.valid.flatten(2)  # B, L1, N
+        num_keys = key_index.shape[-1]
+        chunk_size = max(1, max_pairs_per_chunk // max(num_keys, 1))
+        batch_index = torch.arange(B, device=q.device).view(B, 1, 1)
+
+        out = []
+        for start in range(0, L1, chunk_size):
+            end = min(start + chunk_size, L1)
+            index_chunk = key_index[:, start:end]
+            k_chunk, v_chunk = map(
+                lambda t: rearrange(t[batch_index, index_chunk], "B L N (H D) -> B H L N D", H=self.heads),
+                (k, v)
+            )
+            q_chunk = q[:, :, start:end]
+            sim = torch.einsum("bhld,bhlnd->bhln", q_chunk, k_chunk) * self.scale
+            sim = sim.masked_fill(~valid[:, None, start:end], -torch.finfo(sim.dtype).max)
+            if self.num_register_tokens > 0:
+                sim_reg = torch.einsum("bhld,hrd->bhlr", q_chunk, k_reg) * self.scale
+                sim = torch.cat([sim_reg, sim], dim=-1)
+            attn = sim.softmax(dim=-1)
+            if self.num_register_tokens > 0:
+                attn_reg, attn = attn[..., :self.num_register_tokens], attn[..., self.num_register_tokens:]
+                out_chunk = torch.einsum("bhln,bhlnd->bhld", attn, v_chunk) + torch.einsum("bhlr,hrd->bhld", attn_reg, v_reg)
+            else:
+                out_chunk = torch.einsum("bhln,bhlnd->bhld", attn, v_chunk)
+            out.append(out_chunk)
+
+        out = rearrange(torch.cat(out, dim=2), "B H L D -> B L (H D)")
+
+        return self.to_out(out)
+
 
 class Epipolar(nn.Module):
     def __init__(self, query_dim, context_dim, heads, origin_h=256, origin_w=256,
@@ -129,7 +304,7 @@ class Epipolar(nn.Module):
         """
         Args:
             features: B x T x C x H x W
-            sample_locs_dict: {8, 16, 32, 64} -> B x L1=THW x L2=THW
+            sample_locs_dict: {8, 16, 32, 64} -> B x L1=THW x L2=THW dense mask or EpipolarBand
         """
         B, T1, C, H, W = features.shape
 
@@ -148,7 +323,9 @@ class Epipolar(nn.Module):
                 features[torch.arange(B, device=x.device), cond_frame_index, ...].unsqueeze(1),
                 "B T1 C H W -> B (T1 H W) C"
             )
-            if attn_mask is not None:
+            if isinstance(attn_mask, EpipolarBand):
+                attn_mask = attn_mask.select_frame(cond_frame_index)
+            elif attn_mask is not None:
                 attn_mask = rearrange(attn_mask, "B L1 (T2 H W) -> B L1 T2 (H W)", H=H, W=W)
                 attn_mask = attn_mask[torch.arange(B, device=x.device), :, cond_frame_index, :] # B L1 T2 (H W) -> B L1 L2=(H W)
 
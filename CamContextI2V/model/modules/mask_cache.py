@@ -0,0 +1,147 @@
+import hashlib
+from collections import OrderedDict
+from typing import Callable, List
+
+import numpy as np
+import torch
+from torch import Tensor
+
+from model.modules.epipolar import EpipolarBand
+
+
+class EpipolarMaskCache:
+    """
+        Bounded LRU cache for epipolar masks. A mask is a pure function of the camera
+        intrinsics, the relative camera poses and the feature resolution. Masks are therefore
+        stored per sample (batches as a whole) under a hash of the quantized camera parameters,
+        such that repeated trajectories (demo trajectories, autoregressive continuation) turn the
+        mask construction into a lookup. Dense masks take hundreds of MB per sample, the cache is
+        therefore only enabled for inference, see epipolar_config.mask_cache_max_mb.
+
+        Parameters:
+            max_bytes (int): Upper bound of memory held by the cached masks.
+            max_entries (int): Optional upper bound of the number of cached masks.
+            decimals (int): Number of decimals the camera parameters are rounded to before hashing.
+    """
+
+    def __init__(self,
+                 max_bytes: int = 2**30,
+                 max_entries: int = None,
+                 decimals: int = 4,
+                 ):
+        self.max_bytes = max_bytes
+        self.max_entries = max_entries
+        self.decimals = decimals
+
+        self._entries = OrderedDict()
+        self._bytes = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def make_keys(self, K: Tensor, RT: Tensor, H: int, W: int, downsample: int, *tags) -> List[str]:
+        """
+            Computes the cache key of every sample in the batch.
+
+            Args:
+                K: B x ... x 3 x 3 camera intrinsics
+                RT: B x ... x 4 x 4 relative c2w poses
+                H, W: feature map resolution
+                downsample: downsample scale, defines the epipolar distance threshold
+                tags: additional hashable values distinguishing the mask variant
+        """
+        K = np.round(K.detach().float().cpu().numpy(), self.decimals) + 0.0  # + 0.0 maps -0.0 to 0.0
+        RT = np.round(RT.detach().float().cpu().numpy(), self.decimals) + 0.0
+        suffix = repr((H, W, downsample) + tags).encode()
+
+        keys = []
+        for K_i, RT_i in zip(K, RT):
+            digest = hashlib.sha1(K_i.tobytes())
+            digest.update(RT_i.tobytes())
+            digest.update(suffix)
+            keys.append(digest.hexdigest())
+        return keys
+
+    def fetch(self, keys: List[str], F: Tensor, compute_func: Callable[[Tensor], Tensor]):
+        """
+            Returns the batched masks of all keys, as cached, they must not be modified in place.
+            A batch of several samples is cached as a whole under the key of the batch, such that a
+            hit does not concatenate the masks again. Masks of samples missing from the cache are
+            computed from the corresponding fundamental matrices in F with a single call to
+            compute_func.
+        """
+        if len(keys) == 1:
+            mask = self._lookup(keys[0])
+            if mask is None:
+                mask = compute_func(F)
+                self._insert(keys[0], mask)
+            return mask
+
+        batch_key = hashlib.sha1(":".join(keys).encode()).hexdigest()
+        batched = self._entries.get(batch_key, None)
+        if batched is not None:
+            self._entries.move_to_end(batch_key)
+            self.hits += len(keys)
+            return batched
+
+        # masks cached per sample are reused, the new masks are only cached as part of the batch
+        masks = [self._lookup(key) for key in keys]
+        missing = [i for i, mask in enumerate(masks) if mask is None]
+        if len(missing) == len(keys):
+            batched = compute_func(F)
+        else:
+            if len(missing) > 0:
+                computed = compute_func(F[missing])
+                for j, i in enumerate(missing):
+                    masks[i] = _slice(computed, j)
+            batched = EpipolarBand.cat(masks) if isinstance(masks[0], EpipolarBand) else torch.cat(masks, dim=0)
+        self._insert(batch_key, batched)
+        return batched
+
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / requests if requests > 0 else 0.0,
+            "entries": len(self._entries),
+            "bytes": self._bytes,
+            "max_bytes": self.max_bytes,
+            "evictions": self.evictions,
+        }
+
+    def clear(self):
+        self._entries.clear()
+        self._bytes = 0
+
+    def _lookup(self, key: str):
+        mask = self._entries.get(key, None)
+        if mask is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return mask
+
+    def _insert(self, key: str, mask):
+        size = _nbytes(mask)
+        if size > self.max_bytes or key in self._entries:
+            return
+        self._entries[key] = mask
+        self._bytes += size
+        while self._bytes > self.max_bytes or (self.max_entries is not None and len(self._entries) > self.max_entries):
+            _, evicted = self._entries.popitem(last=False)
+            self._bytes -= _nbytes(evicted)
+            self.evictions += 1
+
+
+def _slice(mask, index: int):
+    if isinstance(mask, EpipolarBand):
+        return EpipolarBand(mask.index[index:index + 1], mask.valid[index:index + 1], mask.tokens_per_frame)
+    return mask[index:index + 1]
+
+
+def _nbytes(mask) -> int:
+    if isinstance(mask, EpipolarBand):
+        return mask.nbytes
+    return mask.numel() * mask.element_size()
@@ -6,7 +6,7 @@ from einops import rearrange, repeat
 from functools import partial
 
 from lvdm.models.utils_diffusion import timestep_embedding
-from lvdm.modules.attention import SpatialTransformer, TemporalTransformer
+from lvdm.modules.attention import SpatialTransformer, TemporalTransformer, project_context
 from lvdm.modules.networks.openaimodel3d import TimestepBlock
 from lvdm.common import (
     checkpoint,
@@ -245,16 +245,15 @@ def new_efficient_forward_for_cross_attention(self, x, context=None, mask=None,
 
     if self.image_cross_attention and not spatial_self_attn:
         context, context_image = context[:, :self.text_context_len, :], context[:, self.text_context_len:, :]
-        k = self.to_k(context)
-        v = self.to_v(context)
+        k, v = project_context(self, "text", context, self.to_k, self.to_v)
         ########################################### only change here, add pose guided cross attention ###########################################
         if image_emb_func is None:
-            k_ip = self.to_k_ip(context_image)
-            v_ip = self.to_v_ip(context_image)
+            k_ip, v_ip = project_context(self, "image", context_image, self.to_k_ip, self.to_v_ip)
         ########################################### only change here, add pose guided cross attention ###########################################
+    elif not spatial_self_attn:
+        context = context[:, :self.text_context_len, :]
+        k, v = project_context(self, "text", context, self.to_k, self.to_v)
     else:
-        if not spatial_self_attn:
-            context = context[:, :self.text_context_len, :]
         k = self.to_k(context)
         v = self.to_v(context)
 
@@ -321,14 +320,13 @@ def new_forward_for_cross_attention(self, x, context=None, mask=None, image_emb_
 
     if self.image_cross_attention and not spatial_self_attn:
         context, context_image = context[:, :self.text_context_len, :], context[:, self.text_context_len:, :]
-        k = self.to_k(context)
-        v = self.to_v(context)
+        k, v = project_context(self, "text", context, self.to_k, self.to_v)
         if image_emb_func is None:
-            k_ip = self.to_k_ip(context_image)
-            v_ip = self.to_v_ip(context_image)
+            k_ip, v_ip = project_context(self, "image", context_image, self.to_k_ip, self.to_v_ip)
+    elif not spatial_self_attn:
+        context = context[:, :self.text_context_len, :]
+        k, v = project_context(self, "text", context, self.to_k, self.to_v)
     else:
-        if not spatial_self_attn:
-            context = context[:, :self.text_context_len, :]
         k = self.to_k(context)
         v = self.to_v(context)
 
@@ -525,6 +523,10 @@ def new__forward_for_BasicTransformerBlock_of_TemporalTransformer(self, x, conte
                     rearrange(normed_x, '(b h w) f c -> b f c h w', h=camera_condition['h'], w=camera_condition['w']),
                     **camera_condition,
                 )  # (b h w) f c
+        if camera_condition.get('camera_mask', None) is not None:
+            # samples of batched guidance branches without camera condition
+            camera_mask = repeat(camera_condition['camera_mask'], 'b -> (b hw) 1 1', hw=camera_condition['h'] * camera_condition['w'])
+            zero_init_x = zero_init_x * camera_mask.to(zero_init_x.dtype)
         if 'add_type' in camera_condition and camera_condition['add_type'] == "add_to_main_branch":
             x = zero_init_x + self.attn1(normed_x, context=context if self.disable_self_attn else None, mask=mask) + x
         else:
@@ -0,0 +1,5 @@
+import sys
+from pathlib import Path
+
+# modules are imported relative to the package root, as in the scripts
+sys.path.insert(0, str(Path(__file__).resolve().parents[1]))
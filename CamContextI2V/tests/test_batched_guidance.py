@@ -0,0 +1,171 @@
+import pytest
+import torch
+from einops import rearrange
+from torch import nn
+
+from baseline.cami2v import cami2v_modified_modules
+from lvdm.models.samplers.ddim import DDIMSampler
+from lvdm.modules.attention import BasicTransformerBlock, CrossAttention
+from model.modules import modified_forwards
+from model.modules.camera_condition import CameraCondition
+
+CHANNELS, CONTEXT_DIM = 8, 6
+
+
+class TinyCameraUNet(nn.Module):
+    """
+        Denoiser with a single cross-attention layer on the context and a temporal transformer block
+        with the camera injection of the given modified forwards module (CamContextI2V or CamI2V).
+    """
+    supports_camera_mask = True
+    parameterization = "eps"
+    use_dynamic_rescale = False
+    num_timesteps = 1000
+
+    def __init__(self, forwards):
+        super().__init__()
+        self.time_embed = nn.Linear(1, CHANNELS)
+        self.cross_attn = CrossAttention(query_dim=CHANNELS, context_dim=CONTEXT_DIM, heads=2, dim_head=4)
+        block = BasicTransformerBlock(CHANNELS, n_heads=2, d_head=4, checkpoint=False)
+        block.forward = forwards.new_forward_for_BasicTransformerBlock_of_TemporalTransformer.__get__(block)
+        block._forward = forwards.new__forward_for_BasicTransformerBlock_of_TemporalTransformer.__get__(block)
+        # non-zero projection, the camera condition has to change the output
+        block.add_module("pluker_projection", nn.Linear(CHANNELS, CHANNELS))
+        self.block = block
+
+    @property
+    def device(self):
+        return torch.device("cpu")
+
+    def apply_model(self, x, t, cond, **kwargs):
+        b, _, _, h, w = x.shape
+        tokens = rearrange(x, "b c t h w -> (b h w) t c")
+        tokens = tokens + self.time_embed(t.float()[:, None] / 1000).repeat_interleave(h * w, dim=0)[:, None]
+        context = cond["c_crossattn"][0].repeat_interleave(h * w, dim=0)
+        tokens = tokens + self.cross_attn(tokens, context=context)
+
+        camera_condition = cond.get("camera_condition", None)
+        if camera_condition is not None:
+            camera_condition = {**camera_condition, "h": h, "w": w}
+        tokens = self.block(tokens, camera_condition=camera_condition)
+        return rearrange(tokens, "(b h w) t c -> b c t h w", b=b, h=h, w=w)
+
+
+def make_inputs(b=2, t=3, h=2, w=2, l=5):
+    x = torch.randn(b, CHANNELS, t, h, w)
+    timesteps = torch.full((b,), 500, dtype=torch.long)
+    c = {
+        "c_crossattn": [torch.randn(b, l, CONTEXT_DIM)],
+        "camera_condition": CameraCondition({"pluker_embedding_features": torch.randn(b, CHANNELS, t, h, w)}),
+    }
+    uc = {"c_crossattn": [torch.randn(b, l, CONTEXT_DIM)]}
+    return x, timesteps, c, uc
+
+
+def make_sampler(model):
+    sampler = DDIMSampler(model)
+    sampler.ddim_alphas = torch.tensor([0.5])
+    sampler.ddim_alphas_prev = torch.tensor([0.9])
+    sampler.ddim_sqrt_one_minus_alphas = (1.0 - sampler.ddim_alphas).sqrt()
+    sampler.ddim_sigmas = torch.zeros(1)
+    return sampler
+
+
+@pytest.fixture(params=[modified_forwards, cami2v_modified_modules], ids=["camcontexti2v", "cami2v"])
+def model(request):
+    torch.manual_seed(0)
+    return TinyCameraUNet(request.param).eval()
+
+
+@torch.no_grad()
+def test_camera_mask_disables_camera_injection(model):
+    x, t, c, _ = make_inputs()
+    without_camera = {"c_crossattn": c["c_crossattn"]}
+    masked = {**c, "camera_condition": c["camera_condition"].replace(camera_mask=torch.zeros(x.shape[0]))}
+    unmasked = {**c, "camera_condition": c["camera_condition"].replace(camera_mask=torch.ones(x.shape[0]))}
+
+    torch.testing.assert_close(model.apply_model(x, t, masked), model.apply_model(x, t, without_camera))
+    torch.testing.assert_close(model.apply_model(x, t, unmasked), model.apply_model(x, t, c))
+    assert not torch.allclose(model.apply_model(x, t, c), model.apply_model(x, t, without_camera))
+
+
+@torch.no_grad()
+def test_batched_apply_model_matches_sequential(model):
+    x, t, c, uc = make_inputs()
+    sampler = make_sampler(model)
+    branches = [c, {**uc, "camera_condition": c["camera_condition"]}, {"c_crossattn": c["c_crossattn"]}]
+
+    batched = sampler.batched_apply_model(x, t, branches)
+    sequential = [sampler.apply_model(x, t, cond, f"branch_{i}") for i, cond in enumerate(branches)]
+    assert len(batched) == len(branches)
+    for e_t_batched, e_t_sequential in zip(batched, sequential):
+        torch.testing.assert_close(e_t_batched, e_t_sequential)
+
+    # the branches are rebuilt in every step, the concatenation is not
+    batched_cond = sampler.batched_condition(branches, x.shape[0], x.device)
+    rebuilt = [dict(cond) for cond in branches]
+    assert sampler.batched_condition(rebuilt, x.shape[0], x.device) is batched_cond
+
+
+@torch.no_grad()
+@pytest.mark.parametrize("camera_cfg", [1.0, 1.5])
+def test_batched_guidance_matches_sequential(model, camera_cfg):
+    x, t, c, uc = make_inputs()
+    sampler = make_sampler(model)
+    kwargs = dict(unconditional_guidance_scale=7.5, enable_camera_condition=True, camera_cfg=camera_cfg)
+
+    x_prev_sequential, pred_x0_sequential = sampler.p_sample_ddim(
+        x, c, t, index=0, unconditional_conditioning=dict(uc), batched_guidance=False, **kwargs)
+    uc_batched = dict(uc)
+    x_prev_batched, pred_x0_batched = sampler.p_sample_ddim(
+        x, c, t, index=0, unconditional_conditioning=uc_batched, batched_guidance=True, **kwargs)
+    copies = sampler.camera_condition_copies
+    # a second step reuses the batched camera condition of the first
+    sampler.p_sample_ddim(x, c, t, index=0, unconditional_conditioning=uc_batched, batched_guidance=True, **kwargs)
+    assert sampler.camera_condition_copies == copies
+
+    torch.testing.assert_close(x_prev_batched, x_prev_sequential)
+    torch.testing.assert_close(pred_x0_batched, pred_x0_sequential)
+
+
+@torch.no_grad()
+def test_sequential_guidance_does_not_copy_camera_condition(model):
+    x, t, c, uc = make_inputs()
+    sampler = make_sampler(model)
+    for _ in range(3):
+        sampler.p_sample_ddim(x, c, t, index=0, unconditional_guidance_scale=7.5, unconditional_conditioning=dict(uc),
+                              batched_guidance=False, enable_camera_condition=True, camera_cfg=1.5)
+    assert sampler.camera_condition_copies == 0
+
+
+@torch.no_grad()
+def test_batched_guidance_copies_camera_condition_once(model):
+    x, t, c, uc = make_inputs()
+    sampler = make_sampler(model)
+    uc = dict(uc)
+    copies = []
+    for _ in range(3):
+        sampler.p_sample_ddim(x, c, t, index=0, unconditional_guidance_scale=7.5, unconditional_conditioning=uc,
+                              batched_guidance=True, enable_camera_condition=True, camera_cfg=1.5)
+        copies.append(sampler.camera_condition_copies)
+    # plucker features and camera mask of the three branches, concatenated in the first step only
+    assert copies == [2, 2, 2]
+
+
+@torch.no_grad()
+def test_per_sample_noise_does_not_depend_on_the_batch(model):
+    x, t, c, uc = make_inputs()
+    sampler = make_sampler(model)
+    sampler.ddim_sigmas = torch.full((1,), 0.3)
+    kwargs = dict(unconditional_guidance_scale=7.5, enable_camera_condition=True, batched_guidance=True)
+
+    generators = [torch.Generator().manual_seed(seed) for seed in (1, 2)]
+    x_prev, _ = sampler.p_sample_ddim(x, c, t, index=0, unconditional_conditioning=dict(uc),
+                                      noise_generators=generators, **kwargs)
+    c_single = {"c_crossattn": [c["c_crossattn"][0][1:]],
+                "camera_condition": c["camera_condition"].replace(
+                    pluker_embedding_features=c["camera_condition"]["pluker_embedding_features"][1:])}
+    x_prev_single, _ = sampler.p_sample_ddim(x[1:], c_single, t[1:], index=0,
+                                             unconditional_conditioning={"c_crossattn": [uc["c_crossattn"][0][1:]]},
+                                             noise_generators=[torch.Generator().manual_seed(2)], **kwargs)
+    torch.testing.assert_close(x_prev[1:], x_prev_single)
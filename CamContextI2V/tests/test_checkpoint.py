@@ -0,0 +1,100 @@
+import logging
+
+import pytest
+import torch
+from torch import nn
+
+from utils import checkpoint
+from utils.checkpoint import build_model, init_empty_parameters, meta_tensors
+
+pytest.importorskip("accelerate")
+pytest.importorskip("safetensors")
+
+
+class PretrainedEncoder(nn.Module):
+    """ Stands in for the OpenCLIP embedders, which move their freshly constructed model to the cpu """
+
+    def __init__(self):
+        super().__init__()
+        self.proj = nn.Linear(4, 4).to(torch.device("cpu"))
+
+
+class TinyModel(nn.Module):
+    def __init__(self, broken: bool = False):
+        super().__init__()
+        self.encoder = PretrainedEncoder()
+        self.layer = nn.Linear(4, 2)
+        self.register_buffer("scale", torch.full((2,), 3.0), persistent=False)
+        if broken:
+            self.layer.weight.detach().cpu()
+
+
+def model_config(broken=False):
+    return {"target": f"{__name__}.TinyModel", "params": {"broken": broken}}
+
+
+@pytest.fixture
+def eager_classes(monkeypatch):
+    monkeypatch.setattr(checkpoint, "eager_module_classes", lambda: [PretrainedEncoder])
+
+
+@pytest.fixture
+def ckpt_path(tmp_path):
+    reference = TinyModel()
+    path = tmp_path / "model.ckpt"
+    torch.save({"state_dict": reference.state_dict()}, path)
+    return str(path), reference
+
+
+def test_init_empty_parameters_keeps_buffers_and_eager_modules():
+    with init_empty_parameters([PretrainedEncoder]):
+        model = TinyModel()
+    assert model.layer.weight.is_meta
+    assert not model.encoder.proj.weight.is_meta
+    assert not model.scale.is_meta
+    # the patched constructor is restored
+    assert not PretrainedEncoder().proj.weight.is_meta
+
+
+def test_build_model_takes_lazy_path(eager_classes, ckpt_path, caplog):
+    path, reference = ckpt_path
+    with caplog.at_level(logging.INFO, logger="mainlogger"):
+        model = build_model(model_config(), path)
+    assert "meta device construction" in caplog.text
+    assert meta_tensors(model) == []
+    for key, value in reference.state_dict().items():
+        assert torch.equal(model.state_dict()[key], value)
+    assert torch.equal(model.scale, torch.full((2,), 3.0))
+
+
+def test_build_model_falls_back_if_meta_construction_fails(eager_classes, ckpt_path, caplog):
+    path, reference = ckpt_path
+    with caplog.at_level(logging.INFO, logger="mainlogger"):
+        model = build_model(model_config(broken=True), path)
+    assert "eager construction" in caplog.text
+    assert torch.equal(model.layer.weight, reference.layer.weight)
+
+
+def test_build_model_checks_coverage_before_reading_tensors(eager_classes, tmp_path, monkeypatch, caplog):
+    reference = TinyModel()
+    state_dict = {key: value for key, value in reference.state_dict().items() if key != "layer.bias"}
+    path = tmp_path / "base.ckpt"
+    torch.save({"state_dict": state_dict}, path)
+
+    calls = []
+    load_weights = checkpoint.load_weights
+    monkeypatch.setattr(checkpoint, "load_weights", lambda *args, **kwargs: calls.append(kwargs.get("assign", False)) or load_weights(*args, **kwargs))
+    with caplog.at_level(logging.INFO, logger="mainlogger"):
+        model = build_model(model_config(), str(path))
+    assert "does not cover 1 tensors" in caplog.text
+    # only the regular construction reads the checkpoint
+    assert calls == [False]
+    assert torch.equal(model.layer.weight, reference.layer.weight)
+
+
+def test_only_rank_zero_converts(ckpt_path, monkeypatch):
+    path, _ = ckpt_path
+    converted = checkpoint.resolve_checkpoint(path)
+    monkeypatch.setenv("RANK", "1")
+    monkeypatch.setattr(checkpoint, "convert_checkpoint", lambda *args: pytest.fail("rank 1 converted the checkpoint"))
+    assert checkpoint.resolve_checkpoint(path) == converted
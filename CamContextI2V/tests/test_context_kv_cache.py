@@ -0,0 +1,69 @@
+import pytest
+import torch
+
+from lvdm.modules.attention import ContextKVCache, CrossAttention, set_context_kv_cache
+
+
+@pytest.fixture
+def cache():
+    cache = ContextKVCache()
+    set_context_kv_cache(cache)
+    yield cache
+    set_context_kv_cache(None)
+
+
+@pytest.fixture
+def attention():
+    torch.manual_seed(0)
+    return CrossAttention(query_dim=8, context_dim=6, heads=2, dim_head=4).eval()
+
+
+@torch.no_grad()
+def test_cached_attention_matches_uncached(cache, attention):
+    x, context = torch.randn(2, 5, 8), torch.randn(2, 7, 6)
+    set_context_kv_cache(None)
+    expected = attention(x, context=context)
+    set_context_kv_cache(cache)
+    outputs = []
+    for _ in range(3):
+        cache.begin("cond", [context])
+        outputs.append(attention(x, context=context))
+    assert cache.misses == 1 and cache.hits == 2
+    for output in outputs:
+        torch.testing.assert_close(output, expected)
+
+
+@torch.no_grad()
+def test_modified_context_invalidates_the_branch(cache, attention):
+    x, context, uc_context = torch.randn(2, 5, 8), torch.randn(2, 7, 6), torch.randn(2, 7, 6)
+    cache.begin("cond", [context])
+    attention(x, context=context)
+    cache.begin("uncond", [uc_context])
+    attention(x, context=uc_context)
+
+    context.add_(1.0)  # same tensor, new content
+    cache.begin("cond", [context])
+    output = attention(x, context=context)
+    assert cache.invalidations == 1 and cache.hits == 0
+
+    set_context_kv_cache(None)
+    torch.testing.assert_close(output, attention(x, context=context))
+    set_context_kv_cache(cache)
+    # the entries of the other branch are kept
+    cache.begin("uncond", [uc_context])
+    attention(x, context=uc_context)
+    assert cache.hits == 1
+
+
+@torch.no_grad()
+def test_other_context_tensor_invalidates_the_branch(cache, attention):
+    x, first_context = torch.randn(2, 5, 8), torch.randn(2, 7, 6)
+    cache.begin("cond", [first_context])
+    attention(x, context=first_context)
+    context = torch.randn(2, 7, 6)  # same shape, dtype and device
+    cache.begin("cond", [context])
+    output = attention(x, context=context)
+    assert cache.hits == 0 and cache.misses == 2
+
+    set_context_kv_cache(None)
+    torch.testing.assert_close(output, attention(x, context=context))
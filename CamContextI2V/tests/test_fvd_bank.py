@@ -0,0 +1,51 @@
+import sys
+import types
+
+import numpy as np
+import pytest
+import torch
+
+from utils.fvd_bank import FVDFeatureBank, _Backend
+
+
+class FakeRawStore:
+    def __init__(self, videos):
+        self.videos = videos
+
+    def resolve(self, path):
+        return (path,) if path in self.videos else None
+
+    def frames(self, name):
+        return self.videos[name]
+
+
+def test_raw_frames_are_scaled_by_source(tmp_path):
+    # a dark video, max() <= 1 must not be mistaken for frames in [0, 1]
+    dark = np.ones((3, 4, 4, 3), dtype=np.uint8)
+    bright = np.full((3, 4, 4, 3), 255, dtype=np.uint8)
+    bank = FVDFeatureBank(tmp_path, methods=("videogpt",), num_frames=2, device="cpu",
+                          raw_store=FakeRawStore({"dark": dark, "bright": bright}))
+
+    videos = bank._load_videos(["dark", "bright"])
+    assert videos.shape == (2, 3, 2, 4, 4)
+    torch.testing.assert_close(videos[0], torch.full((3, 2, 4, 4), 1 / 255))
+    torch.testing.assert_close(videos[1], torch.ones(3, 2, 4, 4))
+
+
+@pytest.mark.parametrize("takes_model_path", [True, False])
+def test_backend_passes_model_path_if_supported(monkeypatch, takes_model_path):
+    calls = []
+    if takes_model_path:
+        def load_i3d_pretrained(device, model_path="ckpts"):
+            calls.append(model_path)
+            return "i3d"
+    else:
+        def load_i3d_pretrained(device):
+            calls.append(None)
+            return "i3d"
+    module = types.SimpleNamespace(load_i3d_pretrained=load_i3d_pretrained, get_fvd_logits=None)
+    monkeypatch.setitem(sys.modules, "fvdcal.videogpt.fvd", module)
+
+    backend = _Backend("videogpt", "my_ckpts", torch.device("cpu"))
+    assert backend.i3d == "i3d"
+    assert calls == ["my_ckpts" if takes_model_path else None]
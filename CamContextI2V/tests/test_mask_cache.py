@@ -0,0 +1,36 @@
+import torch
+
+from model.modules.mask_cache import EpipolarMaskCache
+
+
+def compute_masks(F):
+    return F.sum(dim=(-1, -2)) > 0
+
+
+def test_single_mask_is_returned_without_copy():
+    cache = EpipolarMaskCache()
+    F = torch.randn(1, 2, 2, 3, 3)
+    keys = cache.make_keys(torch.eye(3).expand(1, 2, 3, 3), torch.eye(4).expand(1, 2, 4, 4), 4, 4, 8)
+
+    computed = cache.fetch(keys, F, compute_masks)
+    cached = cache.fetch(keys, F, compute_masks)
+    assert cached is computed
+    assert cache.hits == 1 and cache.misses == 1
+
+
+def test_batched_masks_are_concatenated():
+    cache = EpipolarMaskCache()
+    F = torch.randn(3, 2, 2, 3, 3)
+    K = torch.eye(3).expand(3, 2, 3, 3)
+    RT = torch.eye(4).repeat(3, 2, 1, 1)
+    RT[:, :, 0, 3] = torch.arange(3.0)[:, None]
+    keys = cache.make_keys(K, RT, 4, 4, 8)
+
+    cache.fetch(keys[1:2], F[1:2], compute_masks)
+    masks = cache.fetch(keys, F, compute_masks)
+    assert torch.equal(masks, compute_masks(F))
+    assert cache.hits == 1 and cache.misses == 3
+
+    # the batch is cached as a whole, a hit does not concatenate again
+    assert cache.fetch(keys, F, compute_masks) is masks
+    assert cache.hits == 4 and cache.misses == 3
@@ -0,0 +1,33 @@
+import json
+
+import numpy as np
+
+from data.frame_store import INDEX_FILE
+from utils.raw_store import RawSampleStore, RawSampleWriter
+
+
+def indexed_samples(writer: RawSampleWriter) -> int:
+    index_path = writer.root / "generated" / INDEX_FILE
+    if not index_path.exists():
+        return 0
+    with open(index_path) as f:
+        return len(json.load(f)["videos"])
+
+
+def test_index_is_written_every_flush_every_samples(tmp_path):
+    writer = RawSampleWriter(tmp_path, flush_every=2)
+    frames = {kind: np.zeros((2, 4, 6, 3), dtype=np.uint8) for kind in ("generated", "ground_truth")}
+    camera_data = np.eye(4)[None].repeat(2, axis=0)
+
+    writer.add("sample_0", frames, fps=8, camera_data=camera_data)
+    assert indexed_samples(writer) == 0
+    writer.add("sample_1", frames, fps=8, camera_data=camera_data)
+    assert indexed_samples(writer) == 2
+    writer.add("sample_2", frames, fps=8, camera_data=camera_data)
+    assert indexed_samples(writer) == 2
+
+    writer.flush()
+    store = RawSampleStore(tmp_path)
+    assert store.names() == ["sample_0", "sample_1", "sample_2"]
+    assert store.frames("sample_2", "ground_truth").shape == (2, 4, 6, 3)
+    np.testing.assert_array_equal(store.camera_data("sample_1"), camera_data.astype(np.float32))
@@ -0,0 +1,21 @@
+from utils.result_store import ResultStore
+
+STAGE = "pose[glomap,trials=5,average]"
+
+
+def test_failed_samples_are_recorded_per_input_hash(tmp_path):
+    store = ResultStore(str(tmp_path / "evaluation.db"))
+    store.put_sample("run", STAGE, "ok", "a", {"CamMC": 1.0, "Trials": 5}, {"CamMC": [1.0] * 5})
+    store.put_failure("run", STAGE, "broken", "b")
+
+    hashes = {"ok": "a", "broken": "b"}
+    assert store.completed("run", STAGE, hashes) == {"ok", "broken"}
+    assert store.failed("run", STAGE, hashes) == {"broken"}
+    # the failure row is only valid for the inputs it was computed from
+    assert store.failed("run", STAGE, {"broken": "c"}) == set()
+    assert "broken" not in store.values("run", STAGE).get("CamMC", {})
+
+    # a later success replaces the failure row
+    store.put_sample("run", STAGE, "broken", "b", {"CamMC": 2.0, "Trials": 1})
+    assert store.failed("run", STAGE, hashes) == set()
+    store.close()
@@ -0,0 +1,309 @@
+"""
+    Fast model construction from memory-mapped checkpoints.
+
+    Lightning (.ckpt, "state_dict") and DeepSpeed ("module") checkpoints are converted once to a safetensors file next
+    to the checkpoint (or below ~/.cache/camcontexti2v if the directory is read-only), with the legacy key renames
+    applied. In multi-process jobs only rank 0 converts, the other ranks wait for the converted file. The converted
+    file is memory-mapped, every tensor is read once, directly in the dtype and on the device of the model.
+
+    build_model constructs the parameters of the model on the meta device, without random initialization, and assigns
+    the checkpoint tensors. Buffers are constructed regularly, non-persistent buffers are not part of checkpoints.
+    Encoders loading their own pretrained weights in their constructor (OpenCLIP, HF transformers) are constructed
+    regularly as well. If the checkpoint does not cover all parameters (e.g. new camera modules on top of
+    DynamiCrafter), which is checked on the safetensors header before any tensor is read, or the meta construction
+    fails, the model is constructed regularly and the checkpoint is loaded into it. Missing and unexpected keys are
+    reported in a single pass. Callers that know the checkpoint does not cover the model (training from the
+    DynamiCrafter base) pass lazy=False.
+
+    Convert ahead of time, e.g. before a multi-gpu job:
+        python -m utils.checkpoint <checkpoint.ckpt> [...]
+"""
+import functools
+import hashlib
+import logging
+import os
+import time
+from contextlib import contextmanager
+from dataclasses import dataclass, field
+from pathlib import Path
+from typing import Dict, List
+
+import torch
+from torch import nn
+
+from utils.utils import instantiate_from_config
+
+mainlogger = logging.getLogger('mainlogger')
+
+CONVERTED_SUFFIX = ".safetensors"
+CACHE_DIRECTORY = Path("~/.cache/camcontexti2v").expanduser()
+# seconds ranks > 0 wait for rank 0 to convert a checkpoint
+CONVERSION_TIMEOUT = 3600
+# legacy parameter names of the 256x256 models
+KEY_RENAMES = (("framestride_embed", "fps_embedding"),)
+
+
+@dataclass
+class LoadReport:
+    missing: List[str] = field(default_factory=list)
+    unexpected: List[str] = field(default_factory=list)
+    lazy: bool = False
+    seconds: float = 0.0
+
+    def log(self, ckpt_path: str):
+        mainlogger.info(f">>> Loaded {ckpt_path} in {self.seconds:.1f}s ({'meta device' if self.lazy else 'eager'} construction), "
+                        f"{len(self.missing)} missing, {len(self.unexpected)} unexpected keys")
+        if len(self.missing) > 0:
+            mainlogger.info(f"Missing keys: {self.missing}")
+        if len(self.unexpected) > 0:
+            mainlogger.info(f"Unexpected keys: {self.unexpected}")
+
+
+def extract_state_dict(checkpoint: dict) -> Dict[str, torch.Tensor]:
+    """ State dict of a lightning, deepspeed or plain checkpoint with the legacy keys renamed """
+    if "module" in checkpoint:  # deepspeed
+        checkpoint = checkpoint["module"]
+    elif "state_dict" in checkpoint:  # lightning
+        checkpoint = checkpoint["state_dict"]
+    state_dict = {}
+    for key, value in checkpoint.items():
+        if not isinstance(value, torch.Tensor):
+            continue
+        for old, new in KEY_RENAMES:
+            key = key.replace(old, new)
+        state_dict[key] = value
+    return state_dict
+
+
+def converted_path(ckpt_path: str) -> Path:
+    """ Location of the converted checkpoint, next to the checkpoint if the directory is writable """
+    ckpt_path = Path(ckpt_path).resolve()
+    if os.access(ckpt_path.parent, os.W_OK):
+        return ckpt_path.with_name(ckpt_path.name + CONVERTED_SUFFIX)
+    digest = hashlib.sha1(str(ckpt_path).encode()).hexdigest()[:16]
+    return CACHE_DIRECTORY / f"{ckpt_path.stem}_{digest}{CONVERTED_SUFFIX}"
+
+
+def convert_checkpoint(ckpt_path: str, output_path: str = None) -> Path:
+    """ Converts a .ckpt/deepspeed checkpoint to a safetensors file, returns its path """
+    from safetensors.torch import save_file
+
+    output_path = Path(output_path) if output_path is not None else converted_path(ckpt_path)
+    if output_path.parent == CACHE_DIRECTORY:
+        mainlogger.warning(f"Directory of {ckpt_path} is not writable, writing a {os.path.getsize(ckpt_path) / 2**30:.1f} GiB "
+                           f"converted copy to {output_path}. Convert ahead of time with python -m utils.checkpoint "
+                           f"-o <path> to place it elsewhere.")
+    start = time.perf_counter()
+    state_dict = extract_state_dict(torch.load(ckpt_path, map_location="cpu", weights_only=False))
+    # safetensors stores every tensor separately, views of a shared storage are copied
+    storages = set()
+    for key, value in state_dict.items():
+        ptr = value.untyped_storage().data_ptr()
+        state_dict[key] = value.contiguous() if ptr not in storages else value.clone().contiguous()
+        storages.add(ptr)
+    os.makedirs(output_path.parent, exist_ok=True)
+    tmp_path = output_path.with_name(output_path.name + f".{os.getpid()}.tmp")
+    save_file(state_dict, str(tmp_path), metadata={"source": str(Path(ckpt_path).resolve())})
+    os.replace(tmp_path, output_path)
+    mainlogger.info(f">>> Converted {ckpt_path} to {output_path} in {time.perf_counter() - start:.1f}s")
+    return output_path
+
+
+def process_rank() -> int:
+    """ Global rank of the process, also before the process group is initialized (torchrun, slurm, lightning) """
+    if torch.distributed.is_available() and torch.distributed.is_initialized():
+        return torch.distributed.get_rank()
+    for name in ("RANK", "SLURM_PROCID", "LOCAL_RANK"):
+        if name in os.environ:
+            return int(os.environ[name])
+    return 0
+
+
+def resolve_checkpoint(ckpt_path: str) -> Path:
+    """
+        Memory-mappable version of a checkpoint, converted on first use or if the checkpoint changed. Only rank 0
+        converts, the other ranks wait for it (at a barrier if the process group is initialized).
+    """
+    if str(ckpt_path).endswith(CONVERTED_SUFFIX):
+        return Path(ckpt_path)
+    output_path = converted_path(ckpt_path)
+
+    def is_current() -> bool:
+        return output_path.exists() and output_path.stat().st_mtime >= Path(ckpt_path).stat().st_mtime
+
+    distributed = torch.distributed.is_available() and torch.distributed.is_initialized()
+    if process_rank() == 0:
+        if not is_current():
+            convert_checkpoint(ckpt_path, output_path)
+        if distributed:
+            torch.distributed.barrier()
+        return output_path
+
+    if distributed:
+        torch.distributed.barrier()
+    else:
+        # the converted file is moved into place once complete
+        deadline = time.monotonic() + CONVERSION_TIMEOUT
+        while not is_current() and time.monotonic() < deadline:
+            time.sleep(5)
+    if not is_current():
+        mainlogger.warning(f"Rank {process_rank()} did not find the converted {ckpt_path}, converting it itself")
+        convert_checkpoint(ckpt_path, output_path)
+    return output_path
+
+
+def checkpoint_keys(ckpt_path: str) -> List[str]:
+    """ Tensor names of a checkpoint, read from the header of the converted file """
+    from safetensors import safe_open
+    with safe_open(str(resolve_checkpoint(ckpt_path)), framework="pt", device="cpu") as f:
+        return list(f.keys())
+
+
+def _target_dtype(reference: torch.Tensor, value: torch.Tensor, dtype: torch.dtype = None) -> torch.dtype:
+    if not value.is_floating_point():
+        return value.dtype
+    if dtype is not None:
+        return dtype
+    return reference.dtype if reference is not None else value.dtype
+
+
+@torch.no_grad()
+def load_weights(model: nn.Module, ckpt_path: str, device: str = "cpu", dtype: torch.dtype = None,
+                 assign: bool = False) -> LoadReport:
+    """
+        Loads a checkpoint into a model tensor by tensor from the memory-mapped converted file. Floating point
+        tensors are cast to dtype, or to the dtype of the model tensor. With assign, the checkpoint tensors replace the
+        model tensors, which is required for models on the meta device.
+    """
+    from safetensors import safe_open
+
+    start = time.perf_counter()
+    expected = model.state_dict(keep_vars=True)
+    state_dict = {}
+    unexpected = []
+    with safe_open(str(resolve_checkpoint(ckpt_path)), framework="pt", device="cpu") as f:
+        for key in f.keys():
+            if key not in expected:
+                unexpected.append(key)
+                continue
+            value = f.get_tensor(key)
+            state_dict[key] = value.to(device=device, dtype=_target_dtype(expected[key], value, dtype))
+    missing = [key for key in expected if key not in state_dict]
+    model.load_state_dict(state_dict, strict=False, assign=assign)
+    return LoadReport(missing=missing, unexpected=unexpected, lazy=assign, seconds=time.perf_counter() - start)
+
+
+def eager_module_classes() -> List[type]:
+    """ Module classes that load pretrained weights in their constructor and must not be constructed on meta """
+    from lvdm.modules.encoders import condition
+    classes = [cls for cls in vars(condition).values()
+               if isinstance(cls, type) and issubclass(cls, nn.Module) and cls is not condition.AbstractEncoder
+               and (issubclass(cls, condition.AbstractEncoder) or cls is condition.ClipImageEmbedder)]
+    return classes
+
+
+@contextmanager
+def init_empty_parameters(eager_classes=()):
+    """
+        Parameters registered within the context are created on the meta device (accelerate's init_empty_weights
+        without buffers), except within the constructors of eager_classes.
+    """
+    from accelerate import init_empty_weights
+
+    def eager_init(init):
+        @functools.wraps(init)
+        def __init__(self, *args, **kwargs):
+            # accelerate patches nn.Module.register_parameter, restore the regular one within the constructor
+            patched = nn.Module.register_parameter
+            nn.Module.register_parameter = _register_parameter
+            try:
+                init(self, *args, **kwargs)
+            finally:
+                nn.Module.register_parameter = patched
+        return __init__
+
+    _register_parameter = nn.Module.register_parameter
+    inits = {cls: cls.__dict__["__init__"] for cls in eager_classes if "__init__" in cls.__dict__}
+    try:
+        for cls, init in inits.items():
+            cls.__init__ = eager_init(init)
+        with init_empty_weights(include_buffers=False):
+            yield
+    finally:
+        for cls, init in inits.items():
+            cls.__init__ = init
+
+
+def meta_tensors(model: nn.Module) -> List[str]:
+    """ Names of the parameters, buffers and tensor attributes of a model that are still on the meta device """
+    names = [name for name, t in list(model.named_parameters()) + list(model.named_buffers()) if t.is_meta]
+    for module_name, module in model.named_modules():
+        for attr, value in vars(module).items():
+            if isinstance(value, torch.Tensor) and value.is_meta:
+                names.append(f"{module_name}.{attr}" if module_name else attr)
+    return names
+
+
+def build_model(model_config, ckpt_path: str = None, device: str = "cpu", dtype: torch.dtype = None,
+                lazy: bool = True) -> nn.Module:
+    """
+        Instantiates the model of a config and loads the checkpoint. With lazy, the model is constructed on the meta
+        device and materialized from the checkpoint; if the checkpoint does not cover the model, the model is
+        constructed regularly instead.
+    """
+    if ckpt_path is None:
+        model = instantiate_from_config(model_config)
+        return model.to(device=device, dtype=dtype) if dtype is not None else model.to(device)
+
+    if lazy:
+        start = time.perf_counter()
+        model = None
+        try:
+            with init_empty_parameters(eager_module_classes()):
+                model = instantiate_from_config(model_config)
+            keys = set(checkpoint_keys(ckpt_path))
+            uncovered = [key for key, value in model.state_dict(keep_vars=True).items() if value.is_meta and key not in keys]
+            report = None
+            if len(uncovered) == 0:
+                report = load_weights(model, ckpt_path, device=device, dtype=dtype, assign=True)
+        except Exception as e:
+            mainlogger.warning(f"Meta device construction failed ({type(e).__name__}: {e}), constructing the model regularly")
+        else:
+            # an uncovered checkpoint is detected on its header, before any tensor is read
+            uninitialized = meta_tensors(model) if report is not None else uncovered
+            if len(uninitialized) == 0:
+                # parameters of the eager encoders and buffers are not assigned from the checkpoint
+                model = model.to(device=device, dtype=dtype) if dtype is not None else model.to(device)
+                report.seconds = time.perf_counter() - start
+                report.log(ckpt_path)
+                return model
+            mainlogger.info(f"Checkpoint does not cover {len(uninitialized)} tensors (e.g. {uninitialized[:3]}), "
+                            f"constructing the model regularly")
+        del model
+
+    start = time.perf_counter()
+    model = instantiate_from_config(model_config)
+    if dtype is not None:
+        model = model.to(dtype=dtype)
+    report = load_weights(model, ckpt_path, dtype=dtype)
+    model = model.to(device)
+    report.seconds = time.perf_counter() - start
+    report.log(ckpt_path)
+    return model
+
+
+def main():
+    import argparse
+    parser = argparse.ArgumentParser(description="Convert checkpoints to memory-mappable safetensors files")
+    parser.add_argument("checkpoints", nargs="+", type=str)
+    parser.add_argument("-o", "--output", type=str, default=None, help="Output file, only valid for a single checkpoint")
+    args = parser.parse_args()
+    logging.basicConfig(level=logging.INFO)
+    if args.output is not None and len(args.checkpoints) > 1:
+        parser.error("--output requires a single checkpoint")
+    for ckpt_path in args.checkpoints:
+        convert_checkpoint(ckpt_path, args.output)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,219 @@
+"""
+    Vectorized readers and writers of COLMAP image and 3D point files.
+
+    Records are decoded through numpy structured dtypes instead of per-record struct.unpack calls and returned as
+    columnar tables. Variable length fields (the 2D points of an image, the track of a 3D point) are stored
+    concatenated with offsets, the entries of record i are [offsets[i], offsets[i + 1]).
+    The dict of namedtuples API of utils.evaluation is built on top of these tables.
+"""
+from dataclasses import dataclass
+from typing import List
+
+import numpy as np
+
+IMAGE_HEADER_DTYPE = np.dtype([("id", "<i4"), ("qvec", "<f8", 4), ("tvec", "<f8", 3), ("camera_id", "<i4")])
+POINT2D_DTYPE = np.dtype([("xy", "<f8", 2), ("point3D_id", "<i8")])
+POINT3D_HEADER_DTYPE = np.dtype([("id", "<u8"), ("xyz", "<f8", 3), ("rgb", "u1", 3), ("error", "<f8"), ("track_length", "<u8")])
+TRACK_DTYPE = np.dtype([("image_id", "<i4"), ("point2D_idx", "<i4")])
+
+
+@dataclass
+class ImageTable:
+    ids: np.ndarray             # N
+    qvecs: np.ndarray           # N x 4
+    tvecs: np.ndarray           # N x 3
+    camera_ids: np.ndarray      # N
+    names: List[str]
+    xys: np.ndarray             # M x 2, all images
+    point3D_ids: np.ndarray     # M
+    offsets: np.ndarray         # N + 1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def points2D(self, i: int):
+        return self.xys[self.offsets[i]:self.offsets[i + 1]], self.point3D_ids[self.offsets[i]:self.offsets[i + 1]]
+
+
+@dataclass
+class Point3DTable:
+    ids: np.ndarray             # N
+    xyz: np.ndarray             # N x 3
+    rgb: np.ndarray             # N x 3
+    errors: np.ndarray          # N
+    image_ids: np.ndarray       # M, all tracks
+    point2D_idxs: np.ndarray    # M
+    offsets: np.ndarray         # N + 1
+
+    def __len__(self):
+        return len(self.ids)
+
+    def track(self, i: int):
+        return self.image_ids[self.offsets[i]:self.offsets[i + 1]], self.point2D_idxs[self.offsets[i]:self.offsets[i + 1]]
+
+    def lookup(self, point3D_ids: np.ndarray) -> np.ndarray:
+        """ Row indices of the given point ids, -1 for unknown ids """
+        point3D_ids = np.asarray(point3D_ids, dtype=np.int64)
+        order = np.argsort(self.ids)
+        sorted_ids = self.ids[order].astype(np.int64)
+        pos = np.clip(np.searchsorted(sorted_ids, point3D_ids), 0, max(len(sorted_ids) - 1, 0))
+        if len(sorted_ids) == 0:
+            return np.full(point3D_ids.shape, -1, dtype=np.int64)
+        return np.where(sorted_ids[pos] == point3D_ids, order[pos], -1)
+
+
+def _offsets(lengths) -> np.ndarray:
+    offsets = np.zeros(len(lengths) + 1, dtype=np.int64)
+    np.cumsum(lengths, out=offsets[1:])
+    return offsets
+
+
+def _gather_rows(buffer: np.ndarray, starts: np.ndarray, itemsize: int) -> np.ndarray:
+    """ Gathers the itemsize bytes at every start offset into a contiguous N x itemsize array """
+    return buffer[starts[:, None] + np.arange(itemsize)]
+
+
+def _gather_ranges(buffer: np.ndarray, starts: np.ndarray, lengths: np.ndarray, itemsize: int) -> np.ndarray:
+    """ Concatenates the byte ranges [start, start + length * itemsize) into a flat byte array """
+    nbytes = lengths.astype(np.int64) * itemsize
+    total = int(nbytes.sum())
+    if total == 0:
+        return np.zeros(0, dtype=np.uint8)
+    range_offsets = _offsets(nbytes)
+    index = np.arange(total, dtype=np.int64) - np.repeat(range_offsets[:-1] - starts, nbytes)
+    return buffer[index]
+
+
+def read_images_binary_table(path: str) -> ImageTable:
+    with open(path, "rb") as fid:
+        buffer = np.frombuffer(fid.read(), dtype=np.uint8)
+    num_images = int(buffer[:8].view("<u8")[0])
+
+    # only the record boundaries are walked in python, the names and point counts determine the record sizes
+    raw = buffer.tobytes()
+    starts, point_starts, names, num_points = [], [], [], []
+    offset = 8
+    for _ in range(num_images):
+        starts.append(offset)
+        name_start = offset + IMAGE_HEADER_DTYPE.itemsize
+        name_end = raw.index(b"\x00", name_start)
+        names.append(raw[name_start:name_end].decode("utf-8"))
+        n = int.from_bytes(raw[name_end + 1:name_end + 9], "little")
+        point_starts.append(name_end + 9)
+        num_points.append(n)
+        offset = name_end + 9 + n * POINT2D_DTYPE.itemsize
+    starts = np.asarray(starts, dtype=np.int64)
+    point_starts = np.asarray(point_starts, dtype=np.int64)
+    num_points = np.asarray(num_points, dtype=np.int64)
+
+    headers = _gather_rows(buffer, starts, IMAGE_HEADER_DTYPE.itemsize).copy().view(IMAGE_HEADER_DTYPE).reshape(-1)
+    points = _gather_ranges(buffer, point_starts, num_points, POINT2D_DTYPE.itemsize).view(POINT2D_DTYPE)
+    return ImageTable(ids=headers["id"].astype(np.int64), qvecs=headers["qvec"].copy(), tvecs=headers["tvec"].copy(),
+                      camera_ids=headers["camera_id"].astype(np.int64), names=names, xys=points["xy"].copy(),
+                      point3D_ids=points["point3D_id"].copy(), offsets=_offsets(num_points))
+
+
+def read_images_text_table(path: str) -> ImageTable:
+    with open(path, "r") as fid:
+        lines = [line.strip() for line in fid]
+    # headers and point lines alternate, point lines may be empty
+    lines = [line for line in lines if not line.startswith("#")]
+    while len(lines) > 0 and lines[-1] == "":
+        lines.pop()
+    if len(lines) % 2 == 1:
+        lines.append("")
+    header_tokens = [line.split() for line in lines[0::2]]
+    point_tokens = [line.split() for line in lines[1::2]]
+
+    ids = np.asarray([int(t[0]) for t in header_tokens], dtype=np.int64)
+    poses = np.asarray([t[1:8] for t in header_tokens], dtype=np.float64).reshape(-1, 7)
+    camera_ids = np.asarray([int(t[8]) for t in header_tokens], dtype=np.int64)
+    names = [t[9] for t in header_tokens]
+
+    num_points = np.asarray([len(t) // 3 for t in point_tokens], dtype=np.int64)
+    values = np.asarray([v for t in point_tokens for v in t], dtype=np.float64).reshape(-1, 3)
+    return ImageTable(ids=ids, qvecs=poses[:, :4], tvecs=poses[:, 4:], camera_ids=camera_ids, names=names,
+                      xys=values[:, :2].copy(), point3D_ids=values[:, 2].astype(np.int64), offsets=_offsets(num_points))
+
+
+def read_points3D_binary_table(path: str) -> Point3DTable:
+    with open(path, "rb") as fid:
+        buffer = np.frombuffer(fid.read(), dtype=np.uint8)
+    num_points = int(buffer[:8].view("<u8")[0])
+
+    header_size = POINT3D_HEADER_DTYPE.itemsize
+    length_field = POINT3D_HEADER_DTYPE.fields["track_length"][1]
+    raw = buffer.tobytes()
+    starts = np.empty(num_points, dtype=np.int64)
+    offset = 8
+    for i in range(num_points):
+        starts[i] = offset
+        track_length = int.from_bytes(raw[offset + length_field:offset + header_size], "little")
+        offset += header_size + track_length * TRACK_DTYPE.itemsize
+
+    headers = _gather_rows(buffer, starts, header_size).copy().view(POINT3D_HEADER_DTYPE).reshape(-1)
+    track_lengths = headers["track_length"].astype(np.int64)
+    tracks = _gather_ranges(buffer, starts + header_size, track_lengths, TRACK_DTYPE.itemsize).view(TRACK_DTYPE)
+    return Point3DTable(ids=headers["id"].astype(np.int64), xyz=headers["xyz"].copy(), rgb=headers["rgb"].copy(),
+                        errors=headers["error"].copy(), image_ids=tracks["image_id"].astype(np.int64),
+                        point2D_idxs=tracks["point2D_idx"].astype(np.int64), offsets=_offsets(track_lengths))
+
+
+def read_points3D_text_table(path: str) -> Point3DTable:
+    with open(path, "r") as fid:
+        tokens = [line.split() for line in fid if len(line.strip()) > 0 and not line.startswith("#")]
+    lengths = np.asarray([len(t) for t in tokens], dtype=np.int64)
+    # a single conversion of all tokens, ids and indices are exact in float64
+    values = np.asarray([v for t in tokens for v in t], dtype=np.float64)
+    starts = _offsets(lengths)[:-1]
+
+    header_index = starts[:, None] + np.arange(8)
+    headers = values[header_index]
+    track_lengths = (lengths - 8) // 2
+    # everything after the 8 header values of a line belongs to its track
+    is_track = np.ones(len(values), dtype=bool)
+    is_track[header_index.reshape(-1)] = False
+    track_values = values[is_track]
+    track_values = track_values.reshape(-1, 2).astype(np.int64)
+    return Point3DTable(ids=headers[:, 0].astype(np.int64), xyz=headers[:, 1:4].copy(), rgb=headers[:, 4:7].astype(np.uint8),
+                        errors=headers[:, 7].copy(), image_ids=track_values[:, 0].copy(),
+                        point2D_idxs=track_values[:, 1].copy(), offsets=_offsets(track_lengths))
+
+
+def write_images_binary_table(table: ImageTable, path: str):
+    with open(path, "wb") as fid:
+        fid.write(np.array(len(table), dtype="<u8").tobytes())
+        headers = np.zeros(len(table), dtype=IMAGE_HEADER_DTYPE)
+        headers["id"], headers["qvec"], headers["tvec"], headers["camera_id"] = table.ids, table.qvecs, table.tvecs, table.camera_ids
+        points = np.zeros(len(table.point3D_ids), dtype=POINT2D_DTYPE)
+        points["xy"], points["point3D_id"] = table.xys, table.point3D_ids
+        for i in range(len(table)):
+            fid.write(headers[i].tobytes())
+            fid.write(table.names[i].encode("utf-8") + b"\x00")
+            fid.write(np.array(table.offsets[i + 1] - table.offsets[i], dtype="<u8").tobytes())
+            fid.write(points[table.offsets[i]:table.offsets[i + 1]].tobytes())
+
+
+def write_points3D_binary_table(table: Point3DTable, path: str):
+    track_lengths = np.diff(table.offsets)
+    headers = np.zeros(len(table), dtype=POINT3D_HEADER_DTYPE)
+    headers["id"], headers["xyz"], headers["rgb"], headers["error"] = table.ids, table.xyz, table.rgb, table.errors
+    headers["track_length"] = track_lengths
+    tracks = np.zeros(len(table.image_ids), dtype=TRACK_DTYPE)
+    tracks["image_id"], tracks["point2D_idx"] = table.image_ids, table.point2D_idxs
+
+    # interleave headers and tracks in a single buffer
+    header_bytes = headers.view(np.uint8).reshape(-1, POINT3D_HEADER_DTYPE.itemsize)
+    track_bytes = tracks.view(np.uint8)
+    record_sizes = POINT3D_HEADER_DTYPE.itemsize + track_lengths * TRACK_DTYPE.itemsize
+    record_starts = _offsets(record_sizes)
+    out = np.empty(8 + int(record_starts[-1]), dtype=np.uint8)
+    out[:8] = np.frombuffer(np.array(len(table), dtype="<u8").tobytes(), dtype=np.uint8)
+    out[8 + record_starts[:-1, None] + np.arange(POINT3D_HEADER_DTYPE.itemsize)] = header_bytes
+    track_nbytes = track_lengths * TRACK_DTYPE.itemsize
+    if track_nbytes.sum() > 0:
+        index = np.arange(int(track_nbytes.sum()), dtype=np.int64) \
+            - np.repeat(_offsets(track_nbytes)[:-1] - (8 + record_starts[:-1] + POINT3D_HEADER_DTYPE.itemsize), track_nbytes)
+        out[index] = track_bytes
+    with open(path, "wb") as fid:
+        fid.write(out.tobytes())
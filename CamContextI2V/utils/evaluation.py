@@ -53,6 +53,10 @@ import struct
 
 import numpy as np
 
+from utils.colmap_io import (ImageTable, Point3DTable, read_images_binary_table, read_images_text_table,
+                             read_points3D_binary_table, read_points3D_text_table, write_images_binary_table,
+                             write_points3D_binary_table)
+
 CameraModel = collections.namedtuple(
     "CameraModel", ["model_id", "model_name", "num_params"])
 Camera = collections.namedtuple(
@@ -207,35 +211,64 @@ def write_cameras_binary(cameras, path_to_model_file):
     return cameras
 
 
+def images_from_table(table: ImageTable):
+    """ dict of Image namedtuples, the compatibility view of an ImageTable """
+    images = {}
+    for i in range(len(table)):
+        xys, point3D_ids = table.points2D(i)
+        image_id = int(table.ids[i])
+        images[image_id] = Image(
+            id=image_id, qvec=table.qvecs[i], tvec=table.tvecs[i],
+            camera_id=int(table.camera_ids[i]), name=table.names[i],
+            xys=xys, point3D_ids=point3D_ids)
+    return images
+
+
+def images_to_table(images) -> ImageTable:
+    images = list(images.values())
+    return ImageTable(
+        ids=np.asarray([img.id for img in images], dtype=np.int64).reshape(-1),
+        qvecs=np.asarray([img.qvec for img in images], dtype=np.float64).reshape(-1, 4),
+        tvecs=np.asarray([img.tvec for img in images], dtype=np.float64).reshape(-1, 3),
+        camera_ids=np.asarray([img.camera_id for img in images], dtype=np.int64).reshape(-1),
+        names=[img.name for img in images],
+        xys=np.concatenate([np.asarray(img.xys, dtype=np.float64).reshape(-1, 2) for img in images] + [np.zeros((0, 2))]),
+        point3D_ids=np.concatenate([np.asarray(img.point3D_ids, dtype=np.int64).reshape(-1) for img in images] + [np.zeros(0, dtype=np.int64)]),
+        offsets=np.cumsum([0] + [len(img.point3D_ids) for img in images]).astype(np.int64))
+
+
+def points3D_from_table(table: Point3DTable):
+    """ dict of Point3D namedtuples, the compatibility view of a Point3DTable """
+    points3D = {}
+    for i in range(len(table)):
+        image_ids, point2D_idxs = table.track(i)
+        point3D_id = int(table.ids[i])
+        points3D[point3D_id] = Point3D(
+            id=point3D_id, xyz=table.xyz[i], rgb=table.rgb[i],
+            error=float(table.errors[i]), image_ids=image_ids,
+            point2D_idxs=point2D_idxs)
+    return points3D
+
+
+def points3D_to_table(points3D) -> Point3DTable:
+    points = list(points3D.values())
+    return Point3DTable(
+        ids=np.asarray([pt.id for pt in points], dtype=np.int64).reshape(-1),
+        xyz=np.asarray([pt.xyz for pt in points], dtype=np.float64).reshape(-1, 3),
+        rgb=np.asarray([pt.rgb for pt in points], dtype=np.uint8).reshape(-1, 3),
+        errors=np.asarray([pt.error for pt in points], dtype=np.float64).reshape(-1),
+        image_ids=np.concatenate([np.asarray(pt.image_ids, dtype=np.int64).reshape(-1) for pt in points] + [np.zeros(0, dtype=np.int64)]),
+        point2D_idxs=np.concatenate([np.asarray(pt.point2D_idxs, dtype=np.int64).reshape(-1) for pt in points] + [np.zeros(0, dtype=np.int64)]),
+        offsets=np.cumsum([0] + [len(pt.image_ids) for pt in points]).astype(np.int64))
+
+
 def read_images_text(path):
     """
     see: src/base/reconstruction.cc
         void Reconstruction::ReadImagesText(const std::string& path)
         void Reconstruction::WriteImagesText(const std::string& path)
     """
-    images = {}
-    with open(path, "r") as fid:
-        while True:
-            line = fid.readline()
-            if not line:
-                break
-            line = line.strip()
-            if len(line) > 0 and line[0] != "#":
-                elems = line.split()
-                image_id = int(elems[0])
-                qvec = np.array(tuple(map(float, elems[1:5])))
-                tvec = np.array(tuple(map(float, elems[5:8])))
-                camera_id = int(elems[8])
-                image_name = elems[9]
-                elems = fid.readline().split()
-                xys = np.column_stack([tuple(map(float, elems[0::3])),
-                                       tuple(map(float, elems[1::3]))])
-                point3D_ids = np.array(tuple(map(int, elems[2::3])))
-                images[image_id] = Image(
-                    id=image_id, qvec=qvec, tvec=tvec,
-                    camera_id=camera_id, name=image_name,
-                    xys=xys, point3D_ids=point3D_ids)
-    return images
+    return images_from_table(read_images_text_table(path))
 
 
 def read_images_binary(path_to_model_file):
@@ -244,33 +277,7 @@ def read_images_binary(path_to_model_file):
         void Reconstruction::ReadImagesBinary(const std::string& path)
         void Reconstruction::WriteImagesBinary(const std::string& path)
     """
-    images = {}
-    with open(path_to_model_file, "rb") as fid:
-        num_reg_images = read_next_bytes(fid, 8, "Q")[0]
-        for _ in range(num_reg_images):
-            binary_image_properties = read_next_bytes(
-                fid, num_bytes=64, format_char_sequence="idddddddi")
-            image_id = binary_image_properties[0]
-            qvec = np.array(binary_image_properties[1:5])
-            tvec = np.array(binary_image_properties[5:8])
-            camera_id = binary_image_properties[8]
-            image_name = ""
-            current_char = read_next_bytes(fid, 1, "c")[0]
-            while current_char != b"\x00":   # look for the ASCII 0 entry
-                image_name += current_char.decode("utf-8")
-                current_char = read_next_bytes(fid, 1, "c")[0]
-            num_points2D = read_next_bytes(fid, num_bytes=8,
-                                           format_char_sequence="Q")[0]
-            x_y_id_s = read_next_bytes(fid, num_bytes=24*num_points2D,
-                                       format_char_sequence="ddq"*num_points2D)
-            xys = np.column_stack([tuple(map(float, x_y_id_s[0::3])),
-                                   tuple(map(float, x_y_id_s[1::3]))])
-            point3D_ids = np.array(tuple(map(int, x_y_id_s[2::3])))
-            images[image_id] = Image(
-                id=image_id, qvec=qvec, tvec=tvec,
-                camera_id=camera_id, name=image_name,
-                xys=xys, point3D_ids=point3D_ids)
-    return images
+    return images_from_table(read_images_binary_table(path_to_model_file))
 
 
 def write_images_text(images, path):
@@ -307,19 +314,7 @@ def write_images_binary(images, path_to_model_file):
         void Reconstruction::ReadImagesBinary(const std::string& path)
         void Reconstruction::WriteImagesBinary(const std::string& path)
     """
-    with open(path_to_model_file, "wb") as fid:
-        write_next_bytes(fid, len(images), "Q")
-        for _, img in images.items():
-            write_next_bytes(fid, img.id, "i")
-            write_next_bytes(fid, img.qvec.tolist(), "dddd")
-            write_next_bytes(fid, img.tvec.tolist(), "ddd")
-            write_next_bytes(fid, img.camera_id, "i")
-            for char in img.name:
-                write_next_bytes(fid, char.encode("utf-8"), "c")
-            write_next_bytes(fid, b"\x00", "c")
-            write_next_bytes(fid, len(img.point3D_ids), "Q")
-            for xy, p3d_id in zip(img.xys, img.point3D_ids):
-                write_next_bytes(fid, [*xy, p3d_id], "ddq")
+    write_images_binary_table(images if isinstance(images, ImageTable) else images_to_table(images), path_to_model_file)
 
 
 def read_points3D_text(path):
@@ -328,25 +323,7 @@ def read_points3D_text(path):
         void Reconstruction::ReadPoints3DText(const std::string& path)
         void Reconstruction::WritePoints3DText(const std::string& path)
     """
-    points3D = {}
-    with open(path, "r") as fid:
-        while True:
-            line = fid.readline()
-            if not line:
-                break
-            line = line.strip()
-            if len(line) > 0 and line[0] != "#":
-                elems = line.split()
-                point3D_id = int(elems[0])
-                xyz = np.array(tuple(map(float, elems[1:4])))
-                rgb = np.array(tuple(map(int, elems[4:7])))
-                error = float(elems[7])
-                image_ids = np.array(tuple(map(int, elems[8::2])))
-                point2D_idxs = np.array(tuple(map(int, elems[9::2])))
-                points3D[point3D_id] = Point3D(id=point3D_id, xyz=xyz, rgb=rgb,
-                                               error=error, image_ids=image_ids,
-                                               point2D_idxs=point2D_idxs)
-    return points3D
+    return points3D_from_table(read_points3D_text_table(path))
 
 
 def read_points3D_binary(path_to_model_file):
@@ -355,28 +332,7 @@ def read_points3D_binary(path_to_model_file):
         void Reconstruction::ReadPoints3DBinary(const std::string& path)
         void Reconstruction::WritePoints3DBinary(const std::string& path)
     """
-    points3D = {}
-    with open(path_to_model_file, "rb") as fid:
-        num_points = read_next_bytes(fid, 8, "Q")[0]
-        for _ in range(num_points):
-            binary_point_line_properties = read_next_bytes(
-                fid, num_bytes=43, format_char_sequence="QdddBBBd")
-            point3D_id = binary_point_line_properties[0]
-            xyz = np.array(binary_point_line_properties[1:4])
-            rgb = np.array(binary_point_line_properties[4:7])
-            error = np.array(binary_point_line_properties[7])
-            track_length = read_next_bytes(
-                fid, num_bytes=8, format_char_sequence="Q")[0]
-            track_elems = read_next_bytes(
-                fid, num_bytes=8*track_length,
-                format_char_sequence="ii"*track_length)
-            image_ids = np.array(tuple(map(int, track_elems[0::2])))
-            point2D_idxs = np.array(tuple(map(int, track_elems[1::2])))
-            points3D[point3D_id] = Point3D(
-                id=point3D_id, xyz=xyz, rgb=rgb,
-                error=error, image_ids=image_ids,
-                point2D_idxs=point2D_idxs)
-    return points3D
+    return points3D_from_table(read_points3D_binary_table(path_to_model_file))
 
 
 def write_points3D_text(points3D, path):
@@ -410,17 +366,7 @@ def write_points3D_binary(points3D, path_to_model_file):
         void Reconstruction::ReadPoints3DBinary(const std::string& path)
         void Reconstruction::WritePoints3DBinary(const std::string& path)
     """
-    with open(path_to_model_file, "wb") as fid:
-        write_next_bytes(fid, len(points3D), "Q")
-        for _, pt in points3D.items():
-            write_next_bytes(fid, pt.id, "Q")
-            write_next_bytes(fid, pt.xyz.tolist(), "ddd")
-            write_next_bytes(fid, pt.rgb.tolist(), "BBB")
-            write_next_bytes(fid, pt.error, "d")
-            track_length = pt.image_ids.shape[0]
-            write_next_bytes(fid, track_length, "Q")
-            for image_id, point2D_id in zip(pt.image_ids, pt.point2D_idxs):
-                write_next_bytes(fid, [image_id, point2D_id], "ii")
+    write_points3D_binary_table(points3D if isinstance(points3D, Point3DTable) else points3D_to_table(points3D), path_to_model_file)
 
 
 def detect_model_format(path, ext):
@@ -460,6 +406,19 @@ def read_model(path, ext=""):
     return cameras, images, points3D
 
 
+def read_model_tables(path, ext=".txt", read_points=True):
+    """ Like read_model with columnar images and points3D (see utils.colmap_io), points3D is None unless read_points """
+    if ext == ".txt":
+        cameras = read_cameras_text(os.path.join(path, "cameras" + ext))
+        images = read_images_text_table(os.path.join(path, "images" + ext))
+        points3D = read_points3D_text_table(os.path.join(path, "points3D") + ext) if read_points else None
+    else:
+        cameras = read_cameras_binary(os.path.join(path, "cameras" + ext))
+        images = read_images_binary_table(os.path.join(path, "images" + ext))
+        points3D = read_points3D_binary_table(os.path.join(path, "points3D") + ext) if read_points else None
+    return cameras, images, points3D
+
+
 def write_model(cameras, images, points3D, path, ext=".bin"):
     if ext == ".txt":
         write_cameras_text(cameras, os.path.join(path, "cameras" + ext))
@@ -485,6 +444,15 @@ def qvec2rotmat(qvec):
          1 - 2 * qvec[1]**2 - 2 * qvec[2]**2]])
 
 
+def qvecs2rotmats(qvecs):
+    """ Batched qvec2rotmat, N x 4 -> N x 3 x 3 """
+    w, x, y, z = np.asarray(qvecs, dtype=np.float64).reshape(-1, 4).T
+    return np.stack([
+        1 - 2 * y**2 - 2 * z**2, 2 * x * y - 2 * w * z, 2 * z * x + 2 * w * y,
+        2 * x * y + 2 * w * z, 1 - 2 * x**2 - 2 * z**2, 2 * y * z - 2 * w * x,
+        2 * z * x - 2 * w * y, 2 * y * z + 2 * w * x, 1 - 2 * x**2 - 2 * y**2], axis=-1).reshape(-1, 3, 3)
+
+
 def rotmat2qvec(R):
     Rxx, Ryx, Rzx, Rxy, Ryy, Rzy, Rxz, Ryz, Rzz = R.flat
     K = np.array([
@@ -542,10 +510,15 @@ def normalize_depth_for_display(depth, pc=98, cmap='gray', eps=1e-9):
     depth = gray2rgb(depth, cmap=cmap)
     return depth
 
-def save_depth_pose(output_dir, cameras, images, points3D):
+def save_depth_pose(output_dir, cameras, images, points3D, save_depth=True):
     # Save the sparse depth image and camera pose (world-to-cam) from colmap outputs
+    # images and points3D may be dicts of namedtuples or tables of utils.colmap_io
+    if not isinstance(images, ImageTable):
+        images = images_to_table(images)
+    if save_depth and not isinstance(points3D, Point3DTable):
+        points3D = points3D_to_table(points3D)
     depth_dir = os.path.join(output_dir, "depths")
-    if not os.path.exists(depth_dir):
+    if save_depth and not os.path.exists(depth_dir):
         os.makedirs(depth_dir)
     pose_dir = os.path.join(output_dir, "poses")
     if not os.path.exists(pose_dir):
@@ -553,11 +526,12 @@ def save_depth_pose(output_dir, cameras, images, points3D):
     intrinsic_dir = os.path.join(output_dir, "intrinsics")
     if not os.path.exists(intrinsic_dir):
         os.makedirs(intrinsic_dir)
-    for key in tqdm(images.keys()):
-        image_name = images[key].name
+    # world-to-cam rotations of all images
+    rotations = qvecs2rotmats(images.qvecs)
+    for i in tqdm(range(len(images)), disable=not save_depth):
+        image_name = os.path.splitext(images.names[i])[0]
         # get camera intrinsics
-        camera_id = images[key].camera_id
-        camera = cameras[camera_id]
+        camera = cameras[int(images.camera_ids[i])]
         h, w, params = camera.height, camera.width, camera.params
         if camera.model == 'SIMPLE_PINHOLE':
             f, cx, cy = params
@@ -566,42 +540,41 @@ def save_depth_pose(output_dir, cameras, images, points3D):
         else:
             raise NotImplementedError
         K = np.array([[f, 0, cx], [0, f, cy], [0,0,1]])
-        np.savetxt(os.path.join(intrinsic_dir, os.path.splitext(image_name)[0]+'.txt'), K)
-        # world-to-cam quaternion and translation
-        qvec, tvec = images[key].qvec, images[key].tvec
-        R, t = qvec2rotmat(qvec), np.expand_dims(tvec, -1)
-        # acquire 3d points
-        xys = images[key].xys
-        points3D_ids = images[key].point3D_ids
-        points_3d, valid_xys = [], []
-        for i in range(len(points3D_ids)):
-            idx = points3D_ids[i]
-            if idx == -1:
-                continue
-            points_3d.append((points3D[idx].xyz))
-            valid_xys.append(xys[i])
-
-        points_3d = np.transpose(np.array(points_3d))
-        # project onto image
-        cam_points = np.matmul(R, points_3d) + t
-        project_depth = np.transpose(np.matmul(K, cam_points))[:,-1]
-        xy_int = np.round(np.array(valid_xys)).astype(np.int32)
-        xy_int[:,0] = np.clip(xy_int[:,0], 0, w-1)
-        xy_int[:,1] = np.clip(xy_int[:,1], 0, h-1)
-        depth = np.zeros(shape=(h,w))
-        depth[xy_int[:,1], xy_int[:,0]] = project_depth
-        # save depth and pose
-        np.save(os.path.join(depth_dir, os.path.splitext(image_name)[0]+'.npy'), depth)
-        plt.imsave(os.path.join(depth_dir, os.path.splitext(image_name)[0]+'.png'), normalize_depth_for_display(depth, cmap='binary'))
-        np.savetxt(os.path.join(pose_dir, os.path.splitext(image_name)[0]+'.txt'), np.concatenate([R, t], -1))
-
-def write_depth_pose_from_colmap_format(input_dir, output_dir, ext=''):
-    model = read_model(input_dir, ext=ext)
-    if model is None:
-        return
-    else:
-        cameras, images, points3D = model
-    save_depth_pose(output_dir, cameras, images, points3D)
+        np.savetxt(os.path.join(intrinsic_dir, image_name+'.txt'), K)
+        # world-to-cam rotation and translation
+        R, t = rotations[i], np.expand_dims(images.tvecs[i], -1)
+        if save_depth:
+            # acquire 3d points
+            xys, point3D_ids = images.points2D(i)
+            rows = points3D.lookup(point3D_ids)
+            valid = rows >= 0
+            points_3d = points3D.xyz[rows[valid]].T
+            # project onto image
+            cam_points = np.matmul(R, points_3d) + t
+            project_depth = np.transpose(np.matmul(K, cam_points))[:,-1]
+            xy_int = np.round(xys[valid]).astype(np.int32)
+            xy_int[:,0] = np.clip(xy_int[:,0], 0, w-1)
+            xy_int[:,1] = np.clip(xy_int[:,1], 0, h-1)
+            depth = np.zeros(shape=(h,w))
+            depth[xy_int[:,1], xy_int[:,0]] = project_depth
+            # save depth
+            np.save(os.path.join(depth_dir, image_name+'.npy'), depth)
+            plt.imsave(os.path.join(depth_dir, image_name+'.png'), normalize_depth_for_display(depth, cmap='binary'))
+        np.savetxt(os.path.join(pose_dir, image_name+'.txt'), np.concatenate([R, t], -1))
+
+def write_depth_pose_from_colmap_format(input_dir, output_dir, ext='', save_depth=True):
+    """ Writes the poses, intrinsics and, with save_depth, the sparse depth maps of a colmap model """
+    if ext == '':
+        if detect_model_format(input_dir, ".bin"):
+            ext = ".bin"
+        elif detect_model_format(input_dir, ".txt"):
+            ext = ".txt"
+        else:
+            save_depth_pose(output_dir, *read_model(input_dir), save_depth=save_depth)
+            return
+    # the points are only required for the depth maps
+    cameras, images, points3D = read_model_tables(input_dir, ext=ext, read_points=save_depth)
+    save_depth_pose(output_dir, cameras, images, points3D, save_depth=save_depth)
 
 def get_frames(file: str, output_dir: str, ex: bool = False) -> tuple[int, int]:
     mp4 = VideoFileClip(file, audio=False)
@@ -0,0 +1,82 @@
+"""
+    In-process camera pose estimation for quick screening of the pose metrics, no colmap/glomap required.
+
+    Shi-Tomasi corners are tracked with pyramidal Lucas-Kanade flow between consecutive frames, the relative motion
+    of every frame pair is estimated with an essential matrix RANSAC. Two-view translations are only known up to
+    scale, every step is chained with unit length and the trajectory is normalized as in utils.evaluation.normalize_t
+    by the metric. The result is comparable to compute_camera_poses, it is not a replacement of the SfM metrics.
+"""
+from typing import Tuple
+
+import numpy as np
+import torch
+from torch import Tensor
+
+from utils.evaluation import relative_pose
+
+
+def estimate_step(gray_0: np.ndarray, gray_1: np.ndarray, K: np.ndarray,
+                  max_corners: int = 1000, min_tracks: int = 16, ransac_threshold: float = 1.0) -> Tuple[np.ndarray, np.ndarray, bool]:
+    """
+        Relative motion from frame 0 to frame 1 (x_1 = R x_0 + t) with |t| = 1 or t = 0 without parallax.
+        Returns R, t and whether the estimation succeeded, identity motion otherwise.
+    """
+    import cv2
+
+    identity = (np.eye(3), np.zeros(3), False)
+    corners = cv2.goodFeaturesToTrack(gray_0, maxCorners=max_corners, qualityLevel=0.01, minDistance=7, blockSize=7)
+    if corners is None or len(corners) < min_tracks:
+        return identity
+    tracked, status, _ = cv2.calcOpticalFlowPyrLK(gray_0, gray_1, corners, None, winSize=(21, 21), maxLevel=3)
+    # forward-backward check
+    back, status_back, _ = cv2.calcOpticalFlowPyrLK(gray_1, gray_0, tracked, None, winSize=(21, 21), maxLevel=3)
+    valid = (status.reshape(-1) == 1) & (status_back.reshape(-1) == 1) & (np.linalg.norm((back - corners).reshape(-1, 2), axis=-1) < 1.0)
+    pts_0, pts_1 = corners.reshape(-1, 2)[valid], tracked.reshape(-1, 2)[valid]
+    if len(pts_0) < min_tracks:
+        return identity
+
+    E, inliers = cv2.findEssentialMat(pts_0, pts_1, K, method=cv2.RANSAC, prob=0.999, threshold=ransac_threshold)
+    if E is None or E.shape != (3, 3):
+        return identity
+    num_inliers, R, t, _ = cv2.recoverPose(E, pts_0, pts_1, K, mask=inliers)
+    if num_inliers < min_tracks:
+        return identity
+
+    # without parallax the translation direction is noise
+    if np.median(np.linalg.norm(pts_1 - pts_0, axis=-1)) < 0.5:
+        return R, np.zeros(3), True
+    return R, t.reshape(-1), True
+
+
+def estimate_camera_poses(frames: np.ndarray, fx: float, fy: float, cx: float, cy: float, seed: int = 0) -> Tuple[Tensor, float]:
+    """
+    Estimate relative camera poses of a video in-process.
+
+    Args:
+        frames (np.ndarray): T x H x W x 3 uint8 frames.
+        fx, fy, cx, cy (float): Pixel intrinsics.
+        seed (int, optional): Seed of the RANSAC, the estimate is deterministic. Defaults to 0.
+
+    Returns:
+        tuple[Tensor, float]: The relative camera-to-world transformations (T x 4 x 4, as returned by compute_camera_poses)
+            and the fraction of frame pairs that were estimated successfully.
+    """
+    import cv2
+    cv2.setRNGSeed(seed)
+
+    K = np.array([[fx, 0, cx], [0, fy, cy], [0, 0, 1]], dtype=np.float64)
+    grays = [cv2.cvtColor(np.ascontiguousarray(frame), cv2.COLOR_RGB2GRAY) for frame in frames]
+
+    w2c = np.eye(4)
+    w2cs = [w2c]
+    num_success = 0
+    for gray_0, gray_1 in zip(grays[:-1], grays[1:]):
+        R, t, success = estimate_step(gray_0, gray_1, K)
+        num_success += int(success)
+        step = np.eye(4)
+        step[:3, :3], step[:3, 3] = R, t
+        w2c = step @ w2c
+        w2cs.append(w2c)
+
+    c2w = torch.from_numpy(np.stack(w2cs, axis=0)).inverse()
+    return relative_pose(c2w, mode="left"), num_success / max(len(grays) - 1, 1)
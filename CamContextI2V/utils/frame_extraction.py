@@ -0,0 +1,116 @@
+"""
+    Frame extraction for the camera pose evaluation.
+
+    Videos are decoded in a single batched call (decord, torchvision or moviepy, whichever is available) and the
+    frames are written by a thread pool with OpenCV, which releases the GIL while encoding. BMP and PNG without
+    compression are written at memory bandwidth, PNG compression used to dominate the extraction time. In-process
+    estimators use the decoded frames directly and skip the image files.
+
+    StageTimer accumulates the wall time of the evaluation stages of a video (extraction, features, mapping), the
+    timings are reported next to the metrics.
+"""
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from contextlib import contextmanager
+from typing import Dict
+
+import numpy as np
+
+IMAGE_FORMATS = ("bmp", "png", "jpg")
+# decoded heights that are padded by the codec
+_ALIGN = {1088: 1080, 368: 360}
+
+
+class StageTimer:
+    """ Accumulated wall time per stage """
+
+    def __init__(self):
+        self.seconds: Dict[str, float] = {}
+
+    @contextmanager
+    def __call__(self, stage: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[stage] = self.seconds.get(stage, 0.0) + time.perf_counter() - start
+
+    def as_dict(self, prefix: str = "Time") -> Dict[str, float]:
+        return {f"{prefix}{stage.capitalize()}": seconds for stage, seconds in self.seconds.items()}
+
+
+def _decode_decord(file: str, num_threads: int) -> np.ndarray:
+    from decord import VideoReader, cpu
+    reader = VideoReader(file, ctx=cpu(0), num_threads=max(num_threads, 0))
+    return reader.get_batch(list(range(len(reader)))).asnumpy()
+
+
+def _decode_torchvision(file: str, num_threads: int) -> np.ndarray:
+    from torchvision.io import read_video
+    frames, _, _ = read_video(file, pts_unit="sec", output_format="THWC")
+    return frames.numpy()
+
+
+def _decode_moviepy(file: str, num_threads: int) -> np.ndarray:
+    from moviepy.video.io.VideoFileClip import VideoFileClip
+    mp4 = VideoFileClip(file, audio=False)
+    frames = np.stack(list(mp4.iter_frames(logger=None)), axis=0)
+    mp4.close()
+    return frames
+
+
+_DECODERS = (_decode_decord, _decode_torchvision, _decode_moviepy)
+
+
+def decode_frames(file: str, num_threads: int = 0) -> np.ndarray:
+    """ Decodes all frames of a video to T x H x W x 3 uint8, codec padded heights are resized as in get_frames """
+    frames = None
+    for decoder in _DECODERS:
+        try:
+            frames = decoder(file, num_threads)
+            break
+        except ImportError:
+            continue
+    if frames is None:
+        raise ImportError("Frame extraction requires decord, torchvision or moviepy")
+
+    height = frames.shape[1]
+    if height in _ALIGN:
+        import cv2
+        size = (frames.shape[2], _ALIGN[height])
+        frames = np.stack([cv2.resize(frame, size, interpolation=cv2.INTER_AREA) for frame in frames], axis=0)
+    return frames
+
+
+def write_frames(frames: np.ndarray, output_dir: str, image_format: str = "bmp", num_workers: int = 4,
+                 name_width: int = 3) -> int:
+    """
+        Writes T x H x W x 3 uint8 RGB frames as <output_dir>/<index>.<image_format> with a thread pool.
+        PNG is written without compression, JPEG at quality 95. Returns the number of written frames.
+    """
+    import cv2
+    if image_format not in IMAGE_FORMATS:
+        raise ValueError(f"Unknown image format '{image_format}', expected one of {IMAGE_FORMATS}")
+    params = {"png": [cv2.IMWRITE_PNG_COMPRESSION, 0], "jpg": [cv2.IMWRITE_JPEG_QUALITY, 95]}.get(image_format, [])
+    os.makedirs(output_dir, exist_ok=True)
+
+    def write(idx):
+        bgr = np.ascontiguousarray(frames[idx][..., ::-1])
+        if not cv2.imwrite(os.path.join(output_dir, f"{idx:0{name_width}d}.{image_format}"), bgr, params):
+            raise IOError(f"Could not write frame {idx} to {output_dir}")
+
+    if num_workers is None or num_workers <= 1:
+        for idx in range(len(frames)):
+            write(idx)
+    else:
+        with ThreadPoolExecutor(num_workers) as executor:
+            list(executor.map(write, range(len(frames))))
+    return len(frames)
+
+
+def extract_frames(file: str, output_dir: str, image_format: str = "bmp", num_workers: int = 4) -> np.ndarray:
+    """ Decodes a video and writes its frames for colmap/glomap, returns the decoded frames """
+    frames = decode_frames(file, num_threads=num_workers)
+    write_frames(frames, output_dir, image_format=image_format, num_workers=num_workers)
+    return frames
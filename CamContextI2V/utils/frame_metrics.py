@@ -0,0 +1,122 @@
+"""
+    Streaming frame metrics (MSE, SSIM, LPIPS) of generated against ground truth videos.
+
+    Videos are decoded in chunks of a bounded number of videos, the next chunk is decoded in a background thread
+    while the current one is evaluated. The (video, frame) pairs of a chunk are flattened into batches of
+    frame_batch_size images per metric call and only per-timestep running sums are kept, such that the peak memory
+    does not depend on the size of the split.
+"""
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Dict, List, Tuple
+
+import numpy as np
+import torch
+from torchmetrics.functional import structural_similarity_index_measure
+from torchmetrics.image import LearnedPerceptualImagePatchSimilarity
+
+
+class StreamingFrameMetrics:
+    """
+        Per-timestep running sums of MSE, SSIM and LPIPS.
+
+        Parameters:
+            data_range (float): Data range of the frames, used by SSIM.
+            frame_batch_size (int): Number of frames per metric call.
+            device (str): Device the metrics are computed on.
+    """
+
+    def __init__(self, data_range: float = 255, frame_batch_size: int = 256, device: str = None):
+        self.data_range = data_range
+        self.frame_batch_size = frame_batch_size
+        self.device = torch.device(device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+        self.lpips = LearnedPerceptualImagePatchSimilarity(net_type='squeeze').to(self.device).eval()
+        self.num_pixels = 0
+        self.sums = {"mse": np.zeros(0), "ssim": np.zeros(0), "lpips": np.zeros(0)}
+        self.counts = np.zeros(0, dtype=np.int64)
+
+    def _grow(self, T: int):
+        if T > len(self.counts):
+            pad = T - len(self.counts)
+            self.counts = np.pad(self.counts, (0, pad))
+            self.sums = {k: np.pad(v, (0, pad)) for k, v in self.sums.items()}
+
+    @torch.no_grad()
+    def update(self, gt_videos: torch.Tensor, sample_videos: torch.Tensor) -> Dict[str, np.ndarray]:
+        """ gt_videos, sample_videos: B x T x C x H x W, returns the B x T values of every metric """
+        B, T = sample_videos.shape[:2]
+        self._grow(T)
+        # flatten (video, frame) pairs
+        gt_frames = gt_videos.flatten(0, 1)
+        sample_frames = sample_videos.flatten(0, 1)
+
+        mse, ssim, lpips = [], [], []
+        for start in range(0, B * T, self.frame_batch_size):
+            gt = gt_frames[start:start + self.frame_batch_size].to(self.device, non_blocking=True).float()
+            sample = sample_frames[start:start + self.frame_batch_size].to(self.device, non_blocking=True).float()
+            mse.append(((gt - sample) ** 2).flatten(1).mean(dim=1))
+            ssim.append(structural_similarity_index_measure(sample, gt, data_range=self.data_range, reduction="none"))
+            lpips.append(self.lpips.net(sample, gt, normalize=self.lpips.normalize).flatten())
+
+        per_video = {}
+        for name, values in (("mse", mse), ("ssim", ssim), ("lpips", lpips)):
+            per_video[name] = torch.cat(values).view(B, T).double().cpu().numpy()
+            self.sums[name][:T] += per_video[name].sum(axis=0)
+        self.counts[:T] += B
+        self.num_pixels += gt_frames[0].numel() * B * T
+        return per_video
+
+    def compute(self) -> Dict[str, object]:
+        return summarize_frame_metrics(self.sums, self.counts)
+
+
+def summarize_frame_metrics(sums: Dict[str, np.ndarray], counts: np.ndarray) -> Dict[str, object]:
+    """ Overall and per-timestep metrics from per-timestep sums of mse, ssim and lpips over counts videos """
+    counts = np.asarray(counts)
+    safe_counts = np.maximum(counts, 1)
+    mse_per_timestep = sums["mse"] / safe_counts
+    ssim_per_timestep = sums["ssim"] / safe_counts
+    lpips_per_timestep = sums["lpips"] / safe_counts
+    # every frame has the same number of pixels, the mean of the per-frame MSE is the mean over all pixels
+    mse_total = float(sums["mse"].sum() / max(counts.sum(), 1))
+    return {
+        "mse_total": mse_total,
+        "mse_per_timestep": mse_per_timestep.tolist(),
+        "rmse": float(np.sqrt(mse_total)),
+        "ssim": float(np.mean(ssim_per_timestep)),
+        "lpips": float(np.mean(lpips_per_timestep)),
+        "ssim_per_timestep": ssim_per_timestep.tolist(),
+        "lpips_per_timestep": lpips_per_timestep.tolist(),
+    }
+
+
+def stream_frame_metrics(video_pairs: List[Tuple[str, str]],
+                         load_fn: Callable[[List[str]], torch.Tensor],
+                         videos_per_chunk: int = 16,
+                         frame_batch_size: int = 256,
+                         device: str = None,
+                         progress: Callable = None,
+                         on_chunk: Callable[[List[Tuple[str, str]], Dict[str, np.ndarray]], None] = None,
+                         ) -> Dict[str, object]:
+    """
+        Evaluates the (ground truth, generated) video pairs with a StreamingFrameMetrics. load_fn loads a list of video
+        paths to a B x T x C x H x W tensor, it is called for one chunk ahead of the evaluation.
+        on_chunk(pairs, values) receives the B x T values of every metric of each evaluated chunk.
+    """
+    metrics = StreamingFrameMetrics(frame_batch_size=frame_batch_size, device=device)
+    chunks = [video_pairs[i:i + videos_per_chunk] for i in range(0, len(video_pairs), videos_per_chunk)]
+
+    def load(chunk):
+        return load_fn([p[0] for p in chunk]), load_fn([p[1] for p in chunk])
+
+    with ThreadPoolExecutor(1) as executor:
+        pending = executor.submit(load, chunks[0]) if len(chunks) > 0 else None
+        iterator = range(len(chunks)) if progress is None else progress(range(len(chunks)))
+        for i in iterator:
+            gt_videos, sample_videos = pending.result()
+            pending = executor.submit(load, chunks[i + 1]) if i + 1 < len(chunks) else None
+            values = metrics.update(gt_videos, sample_videos)
+            if on_chunk is not None:
+                on_chunk(chunks[i], values)
+            del gt_videos, sample_videos
+
+    return metrics.compute()
@@ -0,0 +1,216 @@
+"""
+    Persistent I3D feature bank for FVD.
+
+    The ground truth set is the same in every evaluation, its per-video I3D features and reference statistics are
+    stored on disk and keyed by (video content hash, FVD method, number of frames, resolution). Subsequent evaluations
+    only embed the generated videos. Every video is decoded once and embedded by all requested methods.
+
+    The embedding follows the calculate_fvd path of fvdcal: videos are loaded with fvdcal.video_preprocess.load_video,
+    which returns float frames in [0, 1], and passed as B x C x T x H x W to the I3D of fvdcal.<method>.fvd. The
+    uint8 frames of a raw store are scaled to the same range.
+
+    Layout of the bank directory:
+        <method>/features/<key>.npy     per-video features
+        <method>/stats/<key>.npz        mean and covariance of a reference set
+"""
+import hashlib
+import importlib
+import inspect
+import logging
+import os
+from pathlib import Path
+from typing import Dict, List, Tuple
+
+import numpy as np
+import torch
+
+mainlogger = logging.getLogger('mainlogger')
+
+FVD_METHODS = ("videogpt", "stylegan")
+# fvdcal module names of the methods
+_BACKEND_MODULES = {"videogpt": ["videogpt"], "stylegan": ["stylegan", "styleganv"]}
+
+
+def file_hash(path: str, chunk_size: int = 2**20) -> str:
+    """ sha1 of the file content """
+    h = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            h.update(chunk)
+    return h.hexdigest()
+
+
+def frechet_distance(mu1: np.ndarray, sigma1: np.ndarray, mu2: np.ndarray, sigma2: np.ndarray) -> float:
+    """ Frechet distance between two gaussians """
+    from scipy import linalg
+    covmean, _ = linalg.sqrtm(sigma1.dot(sigma2), disp=False)
+    if not np.isfinite(covmean).all():
+        offset = np.eye(sigma1.shape[0]) * 1e-6
+        covmean = linalg.sqrtm((sigma1 + offset).dot(sigma2 + offset))
+    covmean = covmean.real
+    return float(((mu1 - mu2) ** 2).sum() + np.trace(sigma1) + np.trace(sigma2) - 2 * np.trace(covmean))
+
+
+def feature_statistics(feats: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    feats = feats.astype(np.float64)
+    return feats.mean(axis=0), np.cov(feats, rowvar=False)
+
+
+class _Backend:
+    """ I3D of an fvdcal method """
+
+    def __init__(self, method: str, model_path: str, device: torch.device):
+        module = None
+        for name in _BACKEND_MODULES[method]:
+            try:
+                module = importlib.import_module(f"fvdcal.{name}.fvd")
+                break
+            except ModuleNotFoundError:
+                continue
+        if module is None:
+            raise ImportError(f"fvdcal does not provide the FVD method '{method}'")
+        self.device = device
+        # older fvdcal releases load the checkpoints from a fixed directory
+        if "model_path" in inspect.signature(module.load_i3d_pretrained).parameters:
+            self.i3d = module.load_i3d_pretrained(device=device, model_path=model_path)
+        else:
+            self.i3d = module.load_i3d_pretrained(device=device)
+        self.embed_fn = module.get_fvd_logits if method == "videogpt" else module.get_fvd_feats
+
+    @torch.no_grad()
+    def __call__(self, videos: torch.Tensor) -> np.ndarray:
+        """ videos: B x C x T x H x W in [0, 1] """
+        feats = self.embed_fn(videos, self.i3d, self.device)
+        if isinstance(feats, torch.Tensor):
+            feats = feats.detach().cpu().numpy()
+        return np.asarray(feats, dtype=np.float32)
+
+
+class FVDFeatureBank:
+    """
+        On-disk cache of per-video I3D features and reference statistics.
+
+        Parameters:
+            root (str): Directory of the bank.
+            model_path (str): Directory of the I3D checkpoints.
+            methods (tuple): FVD methods to compute.
+            num_frames (int): Number of frames loaded per video, None loads all frames.
+            resolution (int): Input resolution of the I3D, part of the cache key.
+            device (str): Device of the I3D models.
+            raw_store (RawSampleStore): Raw test results, videos contained in it are read from the store.
+    """
+
+    def __init__(self,
+                 root: str,
+                 model_path: str = "ckpts",
+                 methods: Tuple[str] = FVD_METHODS,
+                 num_frames: int = None,
+                 resolution: int = 224,
+                 device: str = None,
+                 raw_store=None,
+                 ):
+        self.root = Path(root)
+        self.raw_store = raw_store
+        self.model_path = model_path
+        self.methods = tuple(methods)
+        self.num_frames = num_frames
+        self.resolution = resolution
+        self.device = torch.device(device if device is not None else ("cuda" if torch.cuda.is_available() else "cpu"))
+        self.hits = 0
+        self.misses = 0
+        self._backends = {}
+        self._hashes = {}
+        for method in self.methods:
+            os.makedirs(self.root / method / "features", exist_ok=True)
+            os.makedirs(self.root / method / "stats", exist_ok=True)
+
+    def backend(self, method: str) -> _Backend:
+        if method not in self._backends:
+            self._backends[method] = _Backend(method, self.model_path, self.device)
+        return self._backends[method]
+
+    def key(self, path: str, method: str) -> str:
+        path = str(path)
+        if path not in self._hashes:
+            raw = self.raw_store.resolve(path) if self.raw_store is not None else None
+            self._hashes[path] = self.raw_store.content_hash(*raw) if raw is not None else file_hash(path)
+        return hashlib.sha1(f"{self._hashes[path]}:{method}:{self.num_frames}:{self.resolution}".encode()).hexdigest()
+
+    def _feature_file(self, key: str, method: str) -> Path:
+        return self.root / method / "features" / f"{key}.npy"
+
+    def _load_video(self, path: str) -> torch.Tensor:
+        """ T x C x H x W frames in [0, 1] """
+        raw = self.raw_store.resolve(path) if self.raw_store is not None else None
+        if raw is not None:
+            frames = torch.from_numpy(self.raw_store.frames(*raw)).permute(0, 3, 1, 2)  # T,C,H,W uint8
+            frames = frames[:self.num_frames] if self.num_frames is not None else frames
+            return frames.float() / 255.0
+        from fvdcal.video_preprocess import load_video
+        return load_video(path, num_frames=self.num_frames).float()
+
+    def _load_videos(self, paths: List[str]) -> torch.Tensor:
+        videos = torch.stack([self._load_video(path) for path in paths])  # B,T,C,H,W
+        return videos.permute(0, 2, 1, 3, 4).contiguous()  # B,C,T,H,W
+
+    def embed(self, paths: List[str], batch_size: int = None, use_cache: bool = True) -> Dict[str, np.ndarray]:
+        """
+            Returns the N x D features of the videos for every method. With use_cache, stored features are reused and
+            new features are stored, otherwise all videos are embedded and nothing is written.
+        """
+        paths = [str(p) for p in paths]
+        feats = {method: [None] * len(paths) for method in self.methods}
+        todo = []
+        for i, path in enumerate(paths):
+            missing = False
+            for method in self.methods:
+                feature_file = self._feature_file(self.key(path, method), method) if use_cache else None
+                if feature_file is not None and feature_file.exists():
+                    feats[method][i] = np.load(feature_file)
+                else:
+                    missing = True
+            if missing:
+                todo.append(i)
+        self.hits += len(paths) - len(todo)
+        self.misses += len(todo)
+
+        batch_size = batch_size or max(1, len(todo))
+        for start in range(0, len(todo), batch_size):
+            indices = todo[start:start + batch_size]
+            # decoded once, shared by all methods
+            videos = self._load_videos([paths[i] for i in indices])
+            for method in self.methods:
+                batch_feats = self.backend(method)(videos)
+                for i, f in zip(indices, batch_feats):
+                    feats[method][i] = f
+                    if use_cache:
+                        np.save(self._feature_file(self.key(paths[i], method), method), f)
+            del videos
+
+        return {method: np.stack(f, axis=0) for method, f in feats.items()}
+
+    def reference_statistics(self, paths: List[str], batch_size: int = None) -> Dict[str, Tuple[np.ndarray, np.ndarray]]:
+        """ Mean and covariance of the features of a reference set, stored per set of videos """
+        stats, todo = {}, []
+        for method in self.methods:
+            set_key = hashlib.sha1("\n".join(self.key(p, method) for p in paths).encode()).hexdigest()
+            stats_file = self.root / method / "stats" / f"{set_key}.npz"
+            if stats_file.exists():
+                data = np.load(stats_file)
+                stats[method] = (data["mu"], data["sigma"])
+            else:
+                todo.append((method, stats_file))
+        if len(todo) > 0:
+            feats = self.embed(paths, batch_size)
+            for method, stats_file in todo:
+                mu, sigma = feature_statistics(feats[method])
+                np.savez(stats_file, mu=mu, sigma=sigma, num_videos=len(paths))
+                stats[method] = (mu, sigma)
+        return stats
+
+    def fvd(self, gt_paths: List[str], gen_paths: List[str], batch_size: int = None, cache_generated: bool = False) -> Dict[str, float]:
+        """ FVD of the generated videos against the ground truth videos for every method """
+        ref_stats = self.reference_statistics(gt_paths, batch_size)
+        gen_feats = self.embed(gen_paths, batch_size, use_cache=cache_generated)
+        mainlogger.info(f"FVD feature bank: {self.hits} hits, {self.misses} misses")
+        return {method: frechet_distance(*feature_statistics(gen_feats[method]), *ref_stats[method]) for method in self.methods}
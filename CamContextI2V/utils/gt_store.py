@@ -0,0 +1,90 @@
+"""
+    Content-addressed store of the ground truth artifacts of test samples.
+
+    The ground truth video, the context frames and the camera data of a test sample only depend on the dataset sample,
+    not on the model. They are written once per (dataset sample, frame indices, context indices, resolution, format)
+    into <root>/<key[:2]>/<key> and every run directory links to them. If the artifacts of all samples of a batch are
+    present, the image logger skips the reconstruction of the ground truth latents.
+
+    Artifacts are written into a temporary directory and published with an atomic rename, see write_manifest.
+"""
+import hashlib
+import json
+import os
+import uuid
+from pathlib import Path
+from typing import List, Sequence, Tuple
+
+GT_VIDEO_NAMES = ("ground_truth.mp4", "ground_truth.gif")
+
+
+def gt_key(video_path: str, frame_indices: Sequence[int], context_indices: Sequence[int], resolution: Sequence[int],
+           video_format: str = "mp4", fps: int = None) -> str:
+    """ Key of the ground truth artifacts of a dataset sample """
+    desc = {
+        "sample": Path(video_path).stem,
+        "frames": [int(i) for i in frame_indices],
+        "context": [int(i) for i in context_indices],
+        "resolution": [int(r) for r in resolution],
+        "format": video_format,
+        "fps": fps,
+    }
+    return hashlib.sha1(json.dumps(desc, sort_keys=True).encode()).hexdigest()
+
+
+def batch_gt_keys(batch: dict, video_format: str = "mp4", fps: int = None) -> List[str]:
+    """ Keys of the samples of a test batch, None if the batch lacks the frame indices """
+    if "frame_indices" not in batch or "video_path" not in batch:
+        return None
+    videos = batch["video"]
+    resolution = videos.shape[-2:]
+    context_indices = batch.get("context_indices")
+    # context frames present in the batch, the collate function may drop context frames of the samples
+    rt_cond = batch.get("RT_cond")
+    num_context = rt_cond.shape[1] if rt_cond is not None and rt_cond.dim() == 4 else 0
+    keys = []
+    for i, video_path in enumerate(batch["video_path"]):
+        context = context_indices[i, :num_context].tolist() if context_indices is not None else []
+        keys.append(gt_key(video_path, batch["frame_indices"][i].tolist(), context, resolution, video_format, fps))
+    return keys
+
+
+class GTArtifactStore:
+    """
+        Shared ground truth artifacts of the test samples of all runs.
+
+        Parameters:
+            root (str): Directory of the store, shared by all runs.
+    """
+
+    def __init__(self, root: str):
+        # links in the run directories are absolute
+        self.root = Path(root).resolve()
+        os.makedirs(self.root, exist_ok=True)
+
+    def path(self, key: str) -> Path:
+        return self.root / key[:2] / key
+
+    def __contains__(self, key: str) -> bool:
+        return key is not None and self.path(key).is_dir()
+
+    def contains_all(self, keys: Sequence[str]) -> bool:
+        return keys is not None and len(keys) > 0 and all(key in self for key in keys)
+
+    def put(self, key: str, manifest: List[Tuple]) -> List[Tuple]:
+        """
+            Maps the write operations of the ground truth artifacts of a sample to a temporary directory of the store,
+            followed by the publication of the directory. The returned operations are executed by write_manifest.
+        """
+        target = self.path(key)
+        tmp_dir = target.parent / f".{key}.{uuid.uuid4().hex[:8]}.tmp"
+        ops = [(kind, tmp_dir / Path(path).name, data, options) for kind, path, data, options in manifest]
+        ops.append(("publish", target, str(tmp_dir), {}))
+        return ops
+
+    def link(self, key: str, sample_dir: Path, names: Sequence[str] = None) -> List[Tuple]:
+        """ Write operations linking the artifacts of a sample into sample_dir """
+        target = self.path(key)
+        if names is None:
+            names = sorted(p.name for p in target.iterdir())
+        return [("link", Path(sample_dir) / name, str(target / name), {}) for name in names]
@@ -0,0 +1,133 @@
+import logging
+import multiprocessing as mp
+import os
+import shutil
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from typing import List, Tuple
+
+import numpy as np
+
+mainlogger = logging.getLogger('mainlogger')
+
+
+def to_numpy(value):
+    """ uint8 cpu tensors are passed to the writer processes as numpy arrays """
+    if hasattr(value, "numpy"):
+        return value.detach().cpu().numpy()
+    return value
+
+
+def write_manifest(manifest: List[Tuple]) -> List[str]:
+    """
+        Executes a list of write operations, each a tuple (kind, path, data, options):
+            ("video", path, uint8 T x H x W x C, {"fps": ..., "crf": ...})  encoded with h264
+            ("gif", path, uint8 T x H x W x C, {"fps": ...})
+            ("png", path, uint8 C x H x W, {})
+            ("npy", path, array, {})
+            ("text", path, str, {})
+            ("link", path, target, {})          symlink to target, copied if the file system has no symlinks
+            ("publish", path, tmp_dir, {})      atomic rename of tmp_dir to path, skipped after an error
+        Returns the list of errors, a failing operation does not abort the remaining ones.
+    """
+    import torch
+    import torchvision
+
+    errors = []
+    for kind, path, data, options in manifest:
+        try:
+            os.makedirs(Path(path).parent, exist_ok=True)
+            if kind == "video":
+                torchvision.io.write_video(str(path), torch.from_numpy(np.asarray(data)), fps=options["fps"],
+                                           video_codec='h264', options={'crf': str(options.get("crf", 10))})
+            elif kind == "gif":
+                import imageio
+                imageio.mimsave(path, np.asarray(data), fps=options["fps"])
+            elif kind == "png":
+                torchvision.io.write_png(torch.from_numpy(np.asarray(data)), str(path))
+            elif kind == "npy":
+                np.save(path, data)
+            elif kind == "text":
+                with open(path, 'w') as f:
+                    f.write(data)
+            elif kind == "link":
+                if os.path.lexists(path):
+                    os.remove(path)
+                try:
+                    os.symlink(data, path)
+                except OSError:
+                    shutil.copy2(data, path)
+            elif kind == "publish":
+                if len(errors) > 0:
+                    shutil.rmtree(data, ignore_errors=True)
+                    raise RuntimeError("incomplete artifacts are not published")
+                try:
+                    os.rename(data, path)
+                except OSError:
+                    # published concurrently by another process
+                    if not os.path.isdir(path):
+                        raise
+                    shutil.rmtree(data, ignore_errors=True)
+            else:
+                raise ValueError(f"Unknown write operation '{kind}'")
+        except Exception as e:
+            errors.append(f"{path}: {e}")
+    return errors
+
+
+def _init_writer():
+    import torch
+    # encoding parallelism comes from the pool
+    torch.set_num_threads(1)
+
+
+class MediaWriterPool:
+    """
+        Bounded pool of writer processes for videos, images and arrays produced during evaluation. Encoding runs
+        in separate processes and does not hold the GIL of the training process. submit() blocks while
+        max_pending manifests are in flight, such that host memory stays bounded if encoding is slower than
+        generation.
+
+        Parameters:
+            num_workers (int): Number of writer processes.
+            max_pending (int): Maximum number of submitted manifests that have not been written yet.
+    """
+
+    def __init__(self, num_workers: int = 4, max_pending: int = 16):
+        self.num_workers = num_workers
+        self.max_pending = max(1, max_pending)
+        self.written = 0
+        self.failed = 0
+        self._pending = set()
+        # spawn: forking a process holding a cuda context is not safe
+        self._executor = ProcessPoolExecutor(num_workers, mp_context=mp.get_context("spawn"), initializer=_init_writer)
+
+    def submit(self, manifest: List[Tuple]):
+        if len(self._pending) >= self.max_pending:
+            # backpressure, wait for at least one manifest to be written
+            done, self._pending = wait(self._pending, return_when=FIRST_COMPLETED)
+            self._collect(done)
+        manifest = [(kind, str(path), to_numpy(data), options) for kind, path, data, options in manifest]
+        self._pending.add(self._executor.submit(write_manifest, manifest))
+
+    def flush(self):
+        """ Blocks until all submitted manifests are written """
+        done, self._pending = wait(self._pending), set()
+        self._collect(done.done)
+
+    def close(self):
+        self.flush()
+        self._executor.shutdown(wait=True)
+
+    def _collect(self, futures):
+        for future in futures:
+            try:
+                errors = future.result()
+            except Exception as e:
+                errors = [str(e)]
+            if len(errors) > 0:
+                self.failed += 1
+                for error in errors:
+                    mainlogger.warning(f"Failed to write {error}")
+            else:
+                self.written += 1
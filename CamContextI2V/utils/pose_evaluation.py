@@ -0,0 +1,407 @@
+"""
+    Camera pose evaluation of generated videos with COLMAP/GLOMAP.
+
+    Videos are evaluated by a pool of workers, every task runs in a private scratch directory. The heavy lifting
+    happens in the colmap/glomap subprocesses, hence a thread pool suffices and the number of threads per
+    subprocess is limited such that concurrent tasks do not oversubscribe the cpu.
+"""
+import os
+import shutil
+import subprocess
+import time
+import traceback
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from pathlib import Path
+from typing import Callable, List, Literal
+
+import numpy as np
+import torch
+from termcolor import colored
+from torch import Tensor
+from tqdm import tqdm
+
+from utils.fast_pose import estimate_camera_poses
+from utils.frame_extraction import StageTimer, decode_frames, write_frames
+from utils.evaluation import get_rt, normalize_t, relative_pose, rt34_to_44, write_depth_pose_from_colmap_format
+
+
+def run_command(cmd: List[str], suppress_output: bool = False, timeout: float = None, num_threads: int = None) -> bool:
+    """ Runs a colmap/glomap command, returns False on failure or timeout """
+    if not suppress_output:
+        print(colored("Running: ", "yellow") + " ".join(cmd))
+    env = None
+    if num_threads is not None and num_threads > 0:
+        env = {**os.environ, "OMP_NUM_THREADS": str(num_threads)}
+    try:
+        result = subprocess.run(cmd, shell=False, stdout=subprocess.DEVNULL if suppress_output else None,
+                                stderr=subprocess.PIPE, timeout=timeout, env=env)
+    except subprocess.TimeoutExpired:
+        print(colored("Timeout:", "red"), f"{cmd[0]} {cmd[1]} exceeded {timeout}s")
+        return False
+    if result.returncode != 0:
+        print(colored("Error:", "red"), result.stderr.decode("utf-8", errors="replace")[-2000:])
+        return False
+    return True
+
+
+def _convert(config: dict) -> list[str]:
+    return sum([[f"--{k}", f"{v}"] for k, v in config.items()], [])
+
+
+def build_feature_database(img_dir: str, pose_dir: str, f: float, cx: float, cy: float,
+                           suppress_output: bool = False, timeout: float = None, num_threads: int = -1) -> str:
+    """
+    Extract and match features of the video frames into a COLMAP database.
+
+    Feature extraction and sequential matching are deterministic, the database can be shared by all mapping trials of
+    a video.
+
+    Args:
+        img_dir (str): Directory where extracted video frames are stored.
+        pose_dir (str): Directory to store the database in.
+        f (float): Focal length.
+        cx (float): Principal point x-coordinate.
+        cy (float): Principal point y-coordinate.
+        suppress_output (bool, optional): If True, suppresses command output messages. Defaults to False.
+        timeout (float, optional): Timeout in seconds of every command. Defaults to None.
+        num_threads (int, optional): Number of threads per command, -1 uses all cores. Defaults to -1.
+
+    Returns:
+        str: Path of the database, None if a command failed.
+    """
+    os.makedirs(pose_dir, exist_ok=True)
+    db_path = f"{pose_dir}/database.db"
+
+    if os.path.exists(db_path):
+        os.remove(db_path)
+
+    config = {
+        "feature_extractor": {
+            "database_path": db_path,
+            "image_path": img_dir,
+            "ImageReader.single_camera": 1,
+            "ImageReader.camera_model": "SIMPLE_PINHOLE",
+            "ImageReader.camera_params": f"{f},{cx},{cy}",
+            "SiftExtraction.estimate_affine_shape": 1,
+            "SiftExtraction.domain_size_pooling": 1,
+            "SiftExtraction.num_threads": num_threads,
+        },
+        "sequential_matcher": {
+            "database_path": db_path,
+            "SiftMatching.guided_matching": 1,
+            "SiftMatching.max_num_matches": 65536,
+            "SiftMatching.num_threads": num_threads,
+        },
+    }
+
+    kwargs = dict(suppress_output=suppress_output, timeout=timeout, num_threads=num_threads)
+    if not run_command(["colmap", "feature_extractor"] + _convert(config["feature_extractor"]), **kwargs):
+        return None
+    if not run_command(["colmap", "sequential_matcher"] + _convert(config["sequential_matcher"]), **kwargs):
+        return None
+    return db_path
+
+
+def map_camera_poses(db_path: str, img_dir: str, trial_dir: str, use_colmap=False,
+                     suppress_output: bool = False, timeout: float = None, num_threads: int = -1) -> Tensor:
+    """
+    Run the (stochastic) mapper on a private copy of the feature database and return the relative camera-to-world
+    transformations, None if mapping failed.
+    """
+    model_dir = f"{trial_dir}/model"
+    if os.path.exists(trial_dir):
+        shutil.rmtree(trial_dir)
+    os.makedirs(model_dir, exist_ok=True)
+
+    # the mapper writes to the database, every trial starts from the same state
+    trial_db_path = f"{trial_dir}/database.db"
+    shutil.copyfile(db_path, trial_db_path)
+
+    config = {
+        "database_path": trial_db_path,
+        "image_path": img_dir,
+        "output_path": model_dir,
+        "output_format": "txt",
+        "RelPoseEstimation.max_epipolar_error": 4,
+        "BundleAdjustment.optimize_intrinsics": 0,
+    }
+    if not run_command(["glomap" if not use_colmap else "colmap", "mapper"] + _convert(config),
+                       suppress_output=suppress_output, timeout=timeout, num_threads=num_threads):
+        return None
+
+    # only the poses are evaluated, the sparse depth maps are skipped
+    write_depth_pose_from_colmap_format(f"{model_dir}/0", model_dir, ext=".txt", save_depth=False)
+
+    w2c = rt34_to_44(get_rt(f"{model_dir}/poses"))
+    c2w = w2c.inverse()
+    rel_c2w = relative_pose(c2w, mode="left")
+
+    return rel_c2w
+
+
+def compute_camera_poses(img_dir: str, pose_dir: str, f: float, cx: float, cy: float, use_colmap=False,
+                         suppress_output: bool = False, timeout: float = None, num_threads: int = -1) -> tuple:
+    """
+    Compute relative camera poses from video frames using COLMAP or GLOMAP.
+
+    This function computes camera poses by running feature extraction, matching, and mapping commands
+    on the extracted video frames. It then converts the results to obtain the relative camera-to-world transformation.
+
+    Args:
+        img_dir (str): Directory where extracted video frames are stored.
+        pose_dir (str): Directory to store pose estimation results.
+        f (float): Focal length.
+        cx (float): Principal point x-coordinate.
+        cy (float): Principal point y-coordinate.
+        use_colmap (bool, optional): Whether to use COLMAP instead of GLOMAP. Defaults to False.
+        suppress_output (bool, optional): If True, suppresses command output messages. Defaults to False.
+        timeout (float, optional): Timeout in seconds of every command. Defaults to None.
+        num_threads (int, optional): Number of threads per command, -1 uses all cores. Defaults to -1.
+
+    Returns:
+        tuple: The computed relative camera pose transformation.
+    """
+    kwargs = dict(suppress_output=suppress_output, timeout=timeout, num_threads=num_threads)
+    db_path = build_feature_database(img_dir, pose_dir, f, cx, cy, **kwargs)
+    if db_path is None:
+        return None
+    return map_camera_poses(db_path, img_dir, f"{pose_dir}/trial", use_colmap=use_colmap, **kwargs)
+
+
+def calc_roterr(r1: Tensor, r2: Tensor) -> Tensor:  # N, 3, 3
+    """
+    Calculate the rotation error between two rotation matrices.
+
+    Args:
+        r1 (Tensor): First rotation matrix tensor of shape (N, 3, 3).
+        r2 (Tensor): Second rotation matrix tensor of shape (N, 3, 3).
+
+    Returns:
+        Tensor: The rotation error in radians.
+    """
+    return (((r1.transpose(-1, -2) @ r2).diagonal(dim1=-1, dim2=-2).sum(-1) - 1) / 2).clamp(-1, 1).acos()
+
+
+def calc_transerr(t1: Tensor, t2: Tensor) -> Tensor:  # N, 3
+    """
+    Calculate the translation error between two translation vectors.
+
+    Args:
+        t1 (Tensor): First translation vector tensor of shape (N, 3).
+        t2 (Tensor): Second translation vector tensor of shape (N, 3).
+
+    Returns:
+        Tensor: The Euclidean distance (L2 norm) between the two translation vectors.
+    """
+    return (t2 - t1).norm(p=2, dim=-1)
+
+
+def calc_cammc(rt1: Tensor, rt2: Tensor) -> Tensor:  # N, 3, 4
+    """
+    Calculate the camera metric error between two camera pose representations.
+
+    Args:
+        rt1 (Tensor): First camera pose tensor of shape (N, 3, 4).
+        rt2 (Tensor): Second camera pose tensor of shape (N, 3, 4).
+
+    Returns:
+        Tensor: The computed camera metric error.
+    """
+    return (rt2 - rt1).reshape(-1, 12).norm(p=2, dim=-1)
+
+
+def metric(c2w_1: Tensor, c2w_2: Tensor) -> tuple[float, float, float]:
+    """
+    Compute the overall error metrics between two sets of camera poses.
+
+    This function computes the total rotation error, translation error, and camera metric error
+    between the provided camera-to-world transformation tensors.
+
+    Args:
+        c2w_1 (Tensor): First set of camera-to-world transformations of shape (N, 3, 4).
+        c2w_2 (Tensor): Second set of camera-to-world transformations of shape (N, 3, 4).
+
+    Returns:
+        tuple[float, float, float]: A tuple containing the rotation error, translation error, and camera metric error.
+    """
+    RotErr = calc_roterr(c2w_1[:, :3, :3], c2w_2[:, :3, :3]).sum().item()
+
+    c2w_1_rel = normalize_t(c2w_1, c2w_1)
+    c2w_2_rel = normalize_t(c2w_2, c2w_2)
+
+    TransErr = calc_transerr(c2w_1_rel[:, :3, 3], c2w_2_rel[:, :3, 3]).sum().item()
+    CamMC = calc_cammc(c2w_1_rel[:, :3, :4], c2w_2_rel[:, :3, :4]).sum().item()
+
+    return RotErr, TransErr, CamMC
+
+
+def aggregate_trials(trial_rot_err: list, trial_trans_err: list, trial_cam_mc: list,
+                     trial_strategy: Literal['average', 'best'] = "average") -> tuple[float, float, float]:
+    """ Aggregates the errors of the successful trials of a video """
+    if len(trial_cam_mc) == 1:
+        return trial_rot_err[0], trial_trans_err[0], trial_cam_mc[0]
+    if trial_strategy == "average":
+        return float(np.mean(trial_rot_err)), float(np.mean(trial_trans_err)), float(np.mean(trial_cam_mc))
+    elif trial_strategy == "best":
+        min_index = int(np.argmin(trial_cam_mc))
+        return trial_rot_err[min_index], trial_trans_err[min_index], trial_cam_mc[min_index]
+    raise ValueError(f"Invalid trial strategy: {trial_strategy}")
+
+
+def trials_converged(trial_cam_mc: list, early_stop_tol: float = None, min_trials: int = 2) -> bool:
+    """ True if at least min_trials succeeded and their CamMC spread is within early_stop_tol of the mean """
+    if early_stop_tol is None or len(trial_cam_mc) < max(min_trials, 2):
+        return False
+    return max(trial_cam_mc) - min(trial_cam_mc) <= early_stop_tol * max(float(np.mean(trial_cam_mc)), 1e-8)
+
+
+def evaluate_video(video_dir: Path,
+                   scratch_dir: Path,
+                   use_colmap: bool = False,
+                   trials_per_video: int = 1,
+                   trial_strategy: Literal['average', 'best'] = "average",
+                   timeout: float = None,
+                   num_threads: int = -1,
+                   early_stop_tol: float = None,
+                   min_trials: int = 2,
+                   raw_store=None,
+                   estimator: Literal['sfm', 'fast'] = "sfm",
+                   image_format: str = "bmp",
+                   ) -> dict:
+    """
+        Estimates the camera poses of the generated video in video_dir and compares them against the ground truth.
+        Returns None if the video can not be evaluated.
+
+        Frames are extracted and features are extracted and matched once, only the mapper is run for every trial.
+        With early_stop_tol, the remaining trials are skipped once the successful trials converged, see
+        trials_converged. Samples contained in the raw_store are read from it instead of decoding the video.
+        The "fast" estimator runs the in-process tracker of utils.fast_pose instead of colmap/glomap, a single
+        deterministic trial. Frames are written as image_format for colmap/glomap, the wall time of frame
+        extraction, feature extraction/matching and mapping is reported as TimeExtract, TimeFeatures and TimeMapping.
+    """
+    cam_data_file = video_dir / "camera_data.npy"
+    video_file = video_dir / "generated.mp4"
+    name = str(video_dir.name)
+    use_raw = raw_store is not None and name in raw_store
+    if use_raw and raw_store.camera_data(name) is not None:
+        cam_data_gt = torch.from_numpy(raw_store.camera_data(name)).float()
+    elif cam_data_file.exists():
+        cam_data_gt = torch.from_numpy(np.load(cam_data_file)).float()
+    else:
+        print(f"Could not find camera data for {str(video_dir.stem)}. Skipping...")
+        return None
+
+    cam_data_gt = cam_data_gt[:, 1:]
+    gt_w2c = cam_data_gt[:, 6:].reshape((-1, 3, 4))
+    gt_c2w = rt34_to_44(gt_w2c).inverse()
+
+    fx, fy, cx, cy = cam_data_gt[0, :4]
+    timer = StageTimer()
+    io_threads = num_threads if num_threads > 0 else os.cpu_count()
+    with timer("extract"):
+        frames = raw_store.frames(name) if use_raw else decode_frames(str(video_file), num_threads=io_threads)
+    if estimator == "fast":
+        # in-process, no image files
+        with timer("mapping"):
+            sample_rel_c2w, tracked = estimate_camera_poses(frames, fx.item(), fy.item(), cx.item(), cy.item())
+        num_gen_imgs = sample_rel_c2w.shape[0]
+        gt_rel_c2w = relative_pose(gt_c2w[:num_gen_imgs], mode="left")
+        rot_err, trans_err, cam_mc = metric(gt_rel_c2w.float().clone(), sample_rel_c2w.float().clone())
+        return {"RotErr": rot_err, "TransErr": trans_err, "CamMC": cam_mc, "Trials": 1, "Tracked": tracked, **timer.as_dict()}
+
+    img_dir = f"{scratch_dir}/img"
+    with timer("extract"):
+        write_frames(frames, img_dir, image_format=image_format, num_workers=io_threads)
+    del frames
+
+    kwargs = dict(suppress_output=True, timeout=timeout, num_threads=num_threads)
+    with timer("features"):
+        db_path = build_feature_database(img_dir, f"{scratch_dir}/pose", fx, cx, cy, **kwargs)
+    if db_path is None:
+        return None
+
+    trial_rot_err = []
+    trial_trans_err = []
+    trial_cam_mc = []
+    for trial in range(trials_per_video):
+        with timer("mapping"):
+            sample_rel_c2w = map_camera_poses(db_path, img_dir, f"{scratch_dir}/pose/trial_{trial}", use_colmap=use_colmap, **kwargs)
+        if sample_rel_c2w is None:
+            continue
+        num_gen_imgs = sample_rel_c2w.shape[0]
+        gt_rel_c2w = relative_pose(gt_c2w[:num_gen_imgs], mode="left")
+        rot_err, trans_err, cam_mc = metric(gt_rel_c2w.float().clone(), sample_rel_c2w.float().clone())
+        trial_rot_err.append(rot_err)
+        trial_trans_err.append(trans_err)
+        trial_cam_mc.append(cam_mc)
+        shutil.rmtree(f"{scratch_dir}/pose/trial_{trial}", ignore_errors=True)
+        if trials_converged(trial_cam_mc, early_stop_tol, min_trials):
+            break
+    if len(trial_cam_mc) == 0:
+        return None
+
+    rot_err, trans_err, cam_mc = aggregate_trials(trial_rot_err, trial_trans_err, trial_cam_mc, trial_strategy)
+    return {"RotErr": rot_err, "TransErr": trans_err, "CamMC": cam_mc, "Trials": len(trial_cam_mc),
+            "TrialRotErr": trial_rot_err, "TrialTransErr": trial_trans_err, "TrialCamMC": trial_cam_mc, **timer.as_dict()}
+
+
+def _evaluate_task(index: int, video_dir: Path, scratch_root: Path, retries: int, keep_scratch: bool, **kwargs):
+    scratch_dir = scratch_root / f"{index:06d}_{video_dir.stem}"
+    result = None
+    start = time.perf_counter()
+    for attempt in range(retries + 1):
+        try:
+            if scratch_dir.exists():
+                shutil.rmtree(scratch_dir)
+            result = evaluate_video(video_dir, scratch_dir, **kwargs)
+        except Exception as e:
+            print(colored(f"Error processing '{str(video_dir.stem)}' (attempt {attempt + 1}/{retries + 1}): {str(e)}", "red"))
+            traceback.print_exc()
+            result = None
+        if result is not None:
+            break
+    if not keep_scratch and scratch_dir.exists():
+        shutil.rmtree(scratch_dir, ignore_errors=True)
+    if result is not None:
+        result["Time"] = time.perf_counter() - start
+    return index, result
+
+
+def default_num_workers(threads_per_task: int) -> int:
+    """ Number of concurrent tasks such that every task gets threads_per_task cores """
+    cpus = len(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else os.cpu_count()
+    return max(1, cpus // max(1, threads_per_task))
+
+
+def run_pose_evaluation(eval_paths: List[Path],
+                        scratch_root: Path,
+                        num_workers: int = None,
+                        threads_per_task: int = 4,
+                        retries: int = 1,
+                        keep_scratch: bool = False,
+                        on_result: Callable[[int, dict], None] = None,
+                        **kwargs) -> List[dict]:
+    """
+        Evaluates all videos with a pool of num_workers concurrent tasks. Each task runs in a private scratch directory
+        below scratch_root, failing tasks are retried. The results are returned in the order of eval_paths, None for
+        videos that could not be evaluated, such that the aggregated metrics do not depend on the completion order.
+        on_result(index, result) is called from the calling thread as soon as a video is done.
+        Remaining keyword arguments are passed to evaluate_video.
+    """
+    num_workers = num_workers if num_workers is not None else default_num_workers(threads_per_task)
+    # a single task may use all cores
+    num_threads = threads_per_task if num_workers > 1 else -1
+    print(f"Evaluating camera poses with {num_workers} workers ({num_threads} threads per task)")
+
+    results = [None] * len(eval_paths)
+    with ThreadPoolExecutor(num_workers) as executor:
+        futures = [
+            executor.submit(_evaluate_task, i, Path(p), Path(scratch_root), retries, keep_scratch, num_threads=num_threads, **kwargs)
+            for i, p in enumerate(eval_paths)
+        ]
+        for future in tqdm(as_completed(futures), total=len(futures)):
+            index, result = future.result()
+            results[index] = result
+            if on_result is not None:
+                on_result(index, result)
+    return results
@@ -0,0 +1,63 @@
+"""
+    Cheap previews of the denoised latents (pred_x0) during sampling.
+
+    Modes:
+        latent_rgb: linear projection of the 4 latent channels to rgb, no first stage decode. The result has 1/8 of
+                    the video resolution and is upsampled by upscale.
+        vae:        first stage decode of every frame_step-th frame.
+
+    The sampler calls the preview callback every preview_every steps, see DDIMSampler.ddim_sampling.
+"""
+import time
+
+import torch
+import torch.nn.functional as F
+
+# linear approximation of the Stable Diffusion first stage decoder on the scaled latents, 4 x rgb
+LATENT_RGB_FACTORS = (
+    (0.3512, 0.2297, 0.3227),
+    (0.3250, 0.4974, 0.2350),
+    (-0.2829, 0.1762, 0.2721),
+    (-0.2120, -0.2616, -0.7177),
+)
+PREVIEW_MODES = ("latent_rgb", "vae")
+
+
+class LatentPreview:
+    """
+        Decodes preview videos of latents, b x c x t x h x w, to b x 3 x t' x h' x w' in [-1, 1].
+
+        Parameters:
+            model: Latent diffusion model, its first stage is used in the vae mode.
+            mode (str): latent_rgb or vae.
+            upscale (int): Spatial upsampling of the latent_rgb previews.
+            frame_step (int): Frame subsampling of the vae previews.
+    """
+
+    def __init__(self, model, mode: str = "latent_rgb", upscale: int = 4, frame_step: int = 4):
+        assert mode in PREVIEW_MODES, f"Unknown preview mode '{mode}'"
+        self.model = model
+        self.mode = mode
+        self.upscale = upscale
+        self.frame_step = frame_step
+        self.times = []
+
+    @torch.no_grad()
+    def __call__(self, z: torch.Tensor) -> torch.Tensor:
+        start = time.perf_counter()
+        if self.mode == "vae":
+            video = self.model.decode_first_stage(z[:, :, ::self.frame_step])
+        else:
+            factors = torch.tensor(LATENT_RGB_FACTORS, device=z.device, dtype=z.dtype)
+            video = torch.einsum("bcthw,cr->brthw", z, factors)
+            if self.upscale > 1:
+                video = F.interpolate(video.float(), scale_factor=(1, self.upscale, self.upscale), mode="trilinear")
+        video = video.clamp(-1.0, 1.0).float().cpu()
+        self.times.append(time.perf_counter() - start)
+        return video
+
+    def summary(self) -> str:
+        if len(self.times) == 0:
+            return f"no previews ({self.mode})"
+        total = sum(self.times)
+        return f"{len(self.times)} previews ({self.mode}) in {total:.2f}s, {1000 * total / len(self.times):.1f}ms each"
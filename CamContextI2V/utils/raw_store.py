@@ -0,0 +1,108 @@
+"""
+    Lossless raw output of generated and ground truth videos.
+
+    Next to (or instead of) the h264 videos, the test results are appended as uint8 frames to frame stores below
+    <save_dir>/raw/rank_<rank>/{generated,ground_truth}. The store index is the manifest: sample name, shard, offset,
+    number of frames and the camera data of every sample. The evaluation reads the memory-mapped frames directly
+    and skips the mp4 decode as well as the codec loss.
+"""
+import hashlib
+from pathlib import Path
+from typing import Dict, Optional, Tuple
+
+import numpy as np
+
+from data.frame_store import FrameStore, FrameStoreWriter, INDEX_FILE
+
+RAW_DIRECTORY = "raw"
+RAW_KINDS = ("generated", "ground_truth")
+
+
+class RawSampleWriter:
+    """
+        Appends the test results of a process to its own frame stores. Stores are created on the first sample, at the
+        resolution of the samples.
+
+        Parameters:
+            save_dir (str): Test directory, the stores are written below save_dir/raw.
+            rank (int): Global rank of the process, every rank writes its own stores.
+            shard_size_gb (float): Approximate size of a shard file.
+            flush_every (int): Number of samples between index updates, the index is also written by flush() at the
+                end of the test.
+    """
+
+    def __init__(self, save_dir: str, rank: int = 0, shard_size_gb: float = 1.0, flush_every: int = 32):
+        self.root = Path(save_dir) / RAW_DIRECTORY / f"rank_{rank}"
+        self.shard_size_gb = shard_size_gb
+        self.flush_every = flush_every
+        self.written = 0
+        self._writers = {}
+
+    def _writer(self, kind: str, resolution: Tuple[int, int]) -> FrameStoreWriter:
+        if kind not in self._writers:
+            # the index holds the camera data of all samples, it is rewritten every flush_every samples only
+            self._writers[kind] = FrameStoreWriter(self.root / kind, list(resolution), load_raw_resolution=True,
+                                                   shard_size_gb=self.shard_size_gb, flush_every=self.flush_every)
+        return self._writers[kind]
+
+    def add(self, name: str, videos: Dict[str, np.ndarray], fps: float, camera_data: np.ndarray = None):
+        """ videos: kind -> T x H x W x 3 uint8 frames """
+        for kind, frames in videos.items():
+            frames = np.asarray(frames)
+            extra = {"camera_data": np.asarray(camera_data).tolist()} if camera_data is not None else {}
+            self._writer(kind, frames.shape[1:3]).add(name, frames, fps, frames.shape[1:3], **extra)
+        self.written += 1
+
+    def flush(self):
+        for writer in self._writers.values():
+            writer.flush()
+
+
+class RawSampleStore:
+    """ Read-only view of the raw outputs of all ranks of a test directory """
+
+    def __init__(self, save_dir: str):
+        self.root = Path(save_dir) / RAW_DIRECTORY
+        self.stores = {kind: {} for kind in RAW_KINDS}
+        for rank_dir in sorted(p for p in self.root.iterdir() if p.is_dir()):
+            for kind in RAW_KINDS:
+                if (rank_dir / kind / INDEX_FILE).exists():
+                    store = FrameStore(rank_dir / kind)
+                    for name in store.videos:
+                        self.stores[kind][name] = store
+
+    def __contains__(self, name: str) -> bool:
+        return name in self.stores["generated"]
+
+    def __len__(self):
+        return len(self.stores["generated"])
+
+    def names(self):
+        return sorted(self.stores["generated"].keys())
+
+    def resolve(self, path: str) -> Optional[Tuple[str, str]]:
+        """ Maps <save_dir>/<name>/<kind>.mp4 to (name, kind) if the sample is in the store """
+        path = Path(path)
+        name, kind = path.parent.name, path.stem
+        if kind in self.stores and name in self.stores[kind]:
+            return name, kind
+        return None
+
+    def frames(self, name: str, kind: str = "generated") -> np.ndarray:
+        """ T x H x W x 3 uint8 frames """
+        return np.asarray(self.stores[kind][name].open(name).frames)
+
+    def camera_data(self, name: str) -> Optional[np.ndarray]:
+        entry = self.stores["generated"][name].videos[name]
+        return np.asarray(entry["camera_data"], dtype=np.float32) if "camera_data" in entry else None
+
+    def content_hash(self, name: str, kind: str = "generated") -> str:
+        return hashlib.sha1(np.ascontiguousarray(self.frames(name, kind)).data).hexdigest()
+
+
+def open_raw_store(save_dir: str) -> Optional[RawSampleStore]:
+    """ Returns the raw store of a test directory, None if the results were only saved as videos """
+    if not (Path(save_dir) / RAW_DIRECTORY).is_dir():
+        return None
+    store = RawSampleStore(save_dir)
+    return store if len(store) > 0 else None
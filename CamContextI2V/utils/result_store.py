@@ -0,0 +1,184 @@
+"""
+    Resumable per-sample evaluation results in a SQLite database.
+
+    Every row holds one value of a (run, sample, metric, trial) together with the content hash of the inputs it was
+    computed from. A metric name is prefixed by its stage, which includes the stage settings, e.g.
+    "pose[glomap,trials=5,average]/CamMC", such that results computed with different settings are never mixed.
+    Trial -1 holds the per-sample value, trials >= 0 the individual trials or timesteps. Evaluation stages skip samples
+    whose rows exist for the current input hash and aggregates are derived from the stored rows. A sample that failed
+    is stored as a single failure row (Trials = 0), such that it is not evaluated again on resume.
+
+    Query and compare runs:
+        python -m utils.result_store --db results/evaluation.db runs
+        python -m utils.result_store --db results/evaluation.db show <run>
+        python -m utils.result_store --db results/evaluation.db compare <run> <run>
+"""
+import argparse
+import hashlib
+import os
+import sqlite3
+import time
+from pathlib import Path
+from typing import Dict, Iterable, List, Tuple
+
+DEFAULT_RESULT_DB = "results/evaluation.db"
+
+SAMPLE_TRIAL = -1
+FAILURE_METRIC = "Trials"
+
+_SCHEMA = """
+CREATE TABLE IF NOT EXISTS runs (
+    run TEXT PRIMARY KEY,
+    path TEXT,
+    created REAL
+);
+CREATE TABLE IF NOT EXISTS results (
+    run TEXT NOT NULL,
+    sample TEXT NOT NULL,
+    metric TEXT NOT NULL,
+    trial INTEGER NOT NULL,
+    value REAL,
+    input_hash TEXT,
+    created REAL,
+    PRIMARY KEY (run, sample, metric, trial)
+);
+"""
+
+
+def hash_files(*paths) -> str:
+    """ sha1 over the content of the existing files among paths """
+    h = hashlib.sha1()
+    for path in paths:
+        if path is None or not os.path.exists(path):
+            continue
+        with open(path, "rb") as f:
+            for chunk in iter(lambda: f.read(2**20), b""):
+                h.update(chunk)
+    return h.hexdigest()
+
+
+class ResultStore:
+    """ SQLite store of per-sample evaluation results, a connection must only be used by its creating thread """
+
+    def __init__(self, path: str = DEFAULT_RESULT_DB):
+        self.path = path
+        os.makedirs(Path(path).parent, exist_ok=True)
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.executescript(_SCHEMA)
+        self.connection.commit()
+
+    def close(self):
+        self.connection.close()
+
+    def register_run(self, run: str, path: str = None):
+        self.connection.execute("INSERT OR IGNORE INTO runs (run, path, created) VALUES (?, ?, ?)", (run, path, time.time()))
+        self.connection.commit()
+
+    def completed(self, run: str, stage: str, input_hashes: Dict[str, str]) -> set:
+        """ Samples that have per-sample rows of the stage computed from the given input hash """
+        rows = self.connection.execute(
+            "SELECT sample, input_hash FROM results WHERE run = ? AND substr(metric, 1, ?) = ? AND trial = ?",
+            (run, len(stage) + 1, f"{stage}/", SAMPLE_TRIAL)).fetchall()
+        return {sample for sample, input_hash in rows if input_hashes.get(sample) == input_hash}
+
+    def put_sample(self, run: str, stage: str, sample: str, input_hash: str, values: Dict[str, float],
+                   trials: Dict[str, List[float]] = None):
+        """ Replaces the rows of a sample, values are per-sample values, trials per-trial or per-timestep values """
+        now = time.time()
+        rows = [(run, sample, f"{stage}/{metric}", SAMPLE_TRIAL, float(value), input_hash, now) for metric, value in values.items()]
+        for metric, trial_values in (trials or {}).items():
+            rows += [(run, sample, f"{stage}/{metric}", i, float(value), input_hash, now) for i, value in enumerate(trial_values)]
+        with self.connection:
+            self.connection.execute("DELETE FROM results WHERE run = ? AND sample = ? AND substr(metric, 1, ?) = ?",
+                                    (run, sample, len(stage) + 1, f"{stage}/"))
+            self.connection.executemany("INSERT INTO results VALUES (?, ?, ?, ?, ?, ?, ?)", rows)
+
+    def put_failure(self, run: str, stage: str, sample: str, input_hash: str):
+        """ Replaces the rows of a sample by a failure row """
+        self.put_sample(run, stage, sample, input_hash, {FAILURE_METRIC: 0})
+
+    def failed(self, run: str, stage: str, input_hashes: Dict[str, str]) -> set:
+        """ Samples whose failure row of the stage was computed from the given input hash """
+        metric = f"{stage}/{FAILURE_METRIC}"
+        rows = self.connection.execute(
+            "SELECT r.sample, r.input_hash FROM results r WHERE r.run = ? AND r.metric = ? AND r.trial = ? AND r.value = 0 "
+            "AND (SELECT COUNT(*) FROM results o WHERE o.run = r.run AND o.sample = r.sample "
+            "AND substr(o.metric, 1, ?) = ?) = 1",
+            (run, metric, SAMPLE_TRIAL, len(stage) + 1, f"{stage}/")).fetchall()
+        return {sample for sample, input_hash in rows if input_hashes.get(sample) == input_hash}
+
+    def values(self, run: str, stage: str, samples: Iterable[str] = None, trial: int = SAMPLE_TRIAL) -> Dict[str, Dict[str, float]]:
+        """ metric -> sample -> value of the given trial """
+        rows = self.connection.execute(
+            "SELECT sample, metric, value FROM results WHERE run = ? AND substr(metric, 1, ?) = ? AND trial = ?",
+            (run, len(stage) + 1, f"{stage}/", trial)).fetchall()
+        samples = set(samples) if samples is not None else None
+        result = {}
+        for sample, metric, value in rows:
+            if samples is None or sample in samples:
+                result.setdefault(metric.split("/", 1)[1], {})[sample] = value
+        return result
+
+    def trials(self, run: str, stage: str, metric: str, samples: Iterable[str] = None) -> Dict[str, List[float]]:
+        """ sample -> per-trial (or per-timestep) values of a metric """
+        rows = self.connection.execute(
+            "SELECT sample, trial, value FROM results WHERE run = ? AND metric = ? AND trial >= 0 ORDER BY sample, trial",
+            (run, f"{stage}/{metric}")).fetchall()
+        samples = set(samples) if samples is not None else None
+        result = {}
+        for sample, _, value in rows:
+            if samples is None or sample in samples:
+                result.setdefault(sample, []).append(value)
+        return result
+
+    def summary(self, run: str) -> List[Tuple[str, float, int]]:
+        """ (metric, mean, number of samples) of the per-sample values of a run """
+        return self.connection.execute(
+            "SELECT metric, AVG(value), COUNT(*) FROM results WHERE run = ? AND trial = ? GROUP BY metric ORDER BY metric",
+            (run, SAMPLE_TRIAL)).fetchall()
+
+    def runs(self) -> List[Tuple[str, str, float, int]]:
+        return self.connection.execute(
+            "SELECT r.run, r.path, r.created, COUNT(DISTINCT s.sample) FROM runs r LEFT JOIN results s ON r.run = s.run "
+            "GROUP BY r.run ORDER BY r.created").fetchall()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Query the evaluation result store")
+    parser.add_argument("--db", type=str, default=DEFAULT_RESULT_DB)
+    subparsers = parser.add_subparsers(dest="command", required=True)
+    subparsers.add_parser("runs", help="List all runs")
+    show = subparsers.add_parser("show", help="Mean of every metric of a run")
+    show.add_argument("run")
+    compare = subparsers.add_parser("compare", help="Compare the metrics of runs on their common samples")
+    compare.add_argument("runs", nargs="+")
+    args = parser.parse_args()
+
+    store = ResultStore(args.db)
+    if args.command == "runs":
+        for run, path, created, num_samples in store.runs():
+            print(f"{run:40s} {num_samples:6d} samples  {time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(created))}  {path}")
+    elif args.command == "show":
+        for metric, mean, count in store.summary(args.run):
+            print(f"{metric:60s} {mean:12.4f}  (n={count})")
+    elif args.command == "compare":
+        # metrics are compared on the samples evaluated in all runs
+        per_run = {run: {} for run in args.runs}
+        for run in args.runs:
+            for sample, metric, value in store.connection.execute(
+                    "SELECT sample, metric, value FROM results WHERE run = ? AND trial = ?", (run, SAMPLE_TRIAL)):
+                per_run[run].setdefault(metric, {})[sample] = value
+        metrics = sorted(set.intersection(*[set(m.keys()) for m in per_run.values()]))
+        print(f"{'metric':60s} " + " ".join(f"{run[-16:]:>16s}" for run in args.runs) + "       n")
+        for metric in metrics:
+            common = set.intersection(*[set(per_run[run][metric].keys()) for run in args.runs])
+            if len(common) == 0:
+                continue
+            means = [sum(per_run[run][metric][s] for s in common) / len(common) for run in args.runs]
+            print(f"{metric:60s} " + " ".join(f"{m:16.4f}" for m in means) + f" {len(common):7d}")
+    store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -14,6 +14,10 @@ from torch import Tensor
 from torchvision.utils import make_grid
 from torchvision.transforms.functional import to_tensor
 
+from utils.media_writer import MediaWriterPool, write_manifest
+from utils.raw_store import RawSampleWriter
+from utils.gt_store import GTArtifactStore
+
 
 def frames_to_mp4(frame_dir,output_path,fps):
     def read_first_n_frames(d: os.PathLike, num_frames: int):
@@ -68,7 +72,19 @@ def log_evaluation(batch_logs,
                     save_as_gif = False, 
                     rescale = False, 
                     save_image_condition = False,
-                    print_out=False):
+                    print_out=False,
+                    writer: MediaWriterPool = None,
+                    raw_writer: RawSampleWriter = None,
+                    save_videos: bool = True,
+                    gt_store: GTArtifactStore = None,
+                    gt_keys: list = None):
+    """
+        Saves generated and ground truth videos, context frames, camera data and captions per sample.
+        With a writer, the files are written asynchronously by the writer pool. With a raw_writer, the uint8 frames
+        of the generated and ground truth videos are additionally appended to the raw store, save_videos=False
+        skips the video encoding. With a gt_store and the keys of the samples, the ground truth video, context frames
+        and camera data are written once to the store and linked into the sample directories.
+    """
 
     if batch_logs is None:
         return False
@@ -110,46 +126,51 @@ def log_evaluation(batch_logs,
     batch_size = samples.shape[0]
     
     for i in range(batch_size):
-        if not os.path.exists(Path(save_dir) / video_names[i]):
-            os.makedirs(Path(save_dir) / video_names[i])
-
-        file_name = Path(save_dir) / video_names[i] / (f"generated.gif" if save_as_gif else f"generated.mp4")
-        gt_file_name = Path(save_dir) / video_names[i] / (f"ground_truth.gif" if save_as_gif else f"ground_truth.mp4")
-        cam_data_file_name = Path(save_dir) / video_names[i] / "camera_data.npy"
-        caption_file_name = Path(save_dir) / video_names[i] / "captions.txt"
-        sample = samples[i]
-
-        gt_video = ground_truth[i]
-        try:
-            if save_as_gif:
-                sample = sample.numpy()
-                gt_video = gt_video.numpy()
-                imageio.mimsave(file_name, sample, fps=save_fps)
-                imageio.mimsave(gt_file_name, gt_video, fps=save_fps)
-            else:
-                torchvision.io.write_video(file_name, sample, fps=save_fps, video_codec='h264', options={'crf': '10'})
-                torchvision.io.write_video(gt_file_name, gt_video, fps=save_fps, video_codec='h264', options={'crf': '10'})
-        except Exception as e:
-            mainlogger.warning(f"Failed to save results for {video_names[i]}: {e}")
+        sample_dir = Path(save_dir) / video_names[i]
+        manifest = []
+        if raw_writer is not None:
+            raw_writer.add(video_names[i], {"generated": samples[i].numpy(), "ground_truth": ground_truth[i].numpy()}, fps=save_fps,
+                           camera_data=camera_data[i].numpy() if camera_data is not None else None)
+        # artifacts that only depend on the dataset sample
+        gt_manifest = []
+        if not save_videos:
+            pass  # raw output only
+        elif save_as_gif:
+            manifest.append(("gif", sample_dir / "generated.gif", samples[i], {"fps": save_fps}))
+            gt_manifest.append(("gif", sample_dir / "ground_truth.gif", ground_truth[i], {"fps": save_fps}))
+        else:
+            manifest.append(("video", sample_dir / "generated.mp4", samples[i], {"fps": save_fps, "crf": 10}))
+            gt_manifest.append(("video", sample_dir / "ground_truth.mp4", ground_truth[i], {"fps": save_fps, "crf": 10}))
 
         if add_cond_images is not None:
             imgs_cond = add_cond_images[i]
             for j in range(imgs_cond.shape[0]):
-                img_cond = imgs_cond[j]
-                torchvision.io.write_png(img_cond, Path(save_dir) / video_names[i] / f"context_{j}.png")
+                gt_manifest.append(("png", sample_dir / f"context_{j}.png", imgs_cond[j], {}))
         if camera_data is not None:
-            cdata = camera_data[i]
-            np.save(cam_data_file_name, cdata)
+            gt_manifest.append(("npy", sample_dir / "camera_data.npy", camera_data[i], {}))
 
-        with open(caption_file_name, 'w') as f:
-            for j, txt in enumerate(captions):
-                f.write(f'{txt}\n')
-            f.close()
+        if gt_store is not None and gt_keys is not None:
+            if gt_keys[i] in gt_store:
+                manifest += gt_store.link(gt_keys[i], sample_dir)
+            else:
+                manifest += gt_store.put(gt_keys[i], gt_manifest)
+                manifest += gt_store.link(gt_keys[i], sample_dir, names=[Path(path).name for _, path, _, _ in gt_manifest])
+        else:
+            manifest += gt_manifest
+
+        manifest.append(("text", sample_dir / "captions.txt", "".join(f'{txt}\n' for txt in captions), {}))
 
         if save_image_condition:
-            cond_image = cond_images[i]
-            torchvision.io.write_png(cond_image, Path(save_dir) / video_names[i] / "condition.png")                
+            manifest.append(("png", sample_dir / "condition.png", cond_images[i], {}))
+
+        if writer is not None:
+            writer.submit(manifest)
+            if print_out:
+                mainlogger.info(f"Queued evaluation results for: {video_names[i]}")
+            continue
 
+        for error in write_manifest(manifest):
+            mainlogger.warning(f"Failed to save results for {video_names[i]}: {error}")
         if print_out:
             mainlogger.info(f"Saved evaluation results for: {video_names[i]}")
 
@@ -0,0 +1,102 @@
+"""
+    Pool of frozen weights shared by the models of the demo.
+
+    CamContextI2V, CamI2V, CameraCtrl and MotionCtrl are all built on the same DynamiCrafter UNet, AutoencoderKL and
+    OpenCLIP encoders. The pool keys every parameter by (dtype, shape, content hash) of its checkpoint tensor, a
+    parameter that is already in the pool is replaced by the pooled nn.Parameter, such that the frozen backbone is
+    resident once and all models reference it. Parameters used by a single model (the camera modules) are the
+    per-model deltas; offloading a model only moves its deltas, the shared backbone stays on the device.
+
+    Shared parameters must not be modified in place, models with EMA weights are not shared.
+"""
+import hashlib
+import logging
+from typing import Dict, Set, Tuple
+
+import torch
+from torch import nn
+
+mainlogger = logging.getLogger('mainlogger')
+
+
+def tensor_key(tensor: torch.Tensor) -> Tuple[str, Tuple[int, ...], str]:
+    """ (dtype, shape, blake2b of the content) of a tensor """
+    data = tensor.detach().reshape(-1).contiguous().cpu().view(torch.uint8).numpy()
+    return str(tensor.dtype), tuple(tensor.shape), hashlib.blake2b(data.data, digest_size=16).hexdigest()
+
+
+class WeightPool:
+    """ Content-addressed frozen parameters shared across model instances """
+
+    def __init__(self):
+        self._params: Dict[tuple, nn.Parameter] = {}
+        self._users: Dict[tuple, Set[str]] = {}
+        self._keys: Dict[str, Set[tuple]] = {}
+
+    def share(self, name: str, model: nn.Module) -> Tuple[int, int]:
+        """
+            Registers the parameters of a model and replaces parameters already in the pool by the pooled ones.
+            Returns the number of shared parameters and their size in bytes.
+        """
+        if getattr(model, "use_ema", False):
+            mainlogger.warning(f"Model {name} uses EMA weights, its parameters are not shared")
+            return 0, 0
+        if name in self._keys:
+            self.release(name)
+
+        keys = set()
+        num_shared, shared_bytes = 0, 0
+        for module in model.modules():
+            for param_name, param in module._parameters.items():
+                if param is None or param.requires_grad:
+                    continue
+                key = tensor_key(param)
+                pooled = self._params.get(key)
+                if pooled is None:
+                    self._params[key] = param
+                    self._users[key] = set()
+                elif pooled is not param and name not in self._users[key]:
+                    # identical frozen tensor of another model
+                    module._parameters[param_name] = pooled
+                    num_shared += 1
+                    shared_bytes += param.numel() * param.element_size()
+                self._users[key].add(name)
+                keys.add(key)
+        self._keys[name] = keys
+        mainlogger.info(f"Weight pool: {name} shares {num_shared} tensors ({shared_bytes / 2**30:.2f} GiB), "
+                        f"pool holds {len(self._params)} tensors for {len(self._keys)} models")
+        return num_shared, shared_bytes
+
+    def release(self, name: str):
+        """ Removes a model from the pool, tensors without users are dropped """
+        for key in self._keys.pop(name, set()):
+            self._users[key].discard(name)
+            if len(self._users[key]) == 0:
+                del self._users[key]
+                del self._params[key]
+
+    @torch.no_grad()
+    def offload(self, model: nn.Module, device: str = "cpu"):
+        """
+            Moves the parameters and buffers of a model that are not shared with other models to device. The shared
+            backbone stays where it is, the model is moved back with model.to(device) before it is used.
+        """
+        shared = {id(p) for key, p in self._params.items() if len(self._users[key]) > 1}
+        for module in model.modules():
+            for param in module._parameters.values():
+                if param is not None and id(param) not in shared and param.device != torch.device(device):
+                    param.data = param.data.to(device)
+            for buffer_name, buffer in module._buffers.items():
+                if buffer is not None:
+                    module._buffers[buffer_name] = buffer.to(device)
+
+    def nbytes(self) -> Tuple[int, int]:
+        """ Size of the shared and of the per-model tensors in bytes """
+        shared, private = 0, 0
+        for key, param in self._params.items():
+            size = param.numel() * param.element_size()
+            if len(self._users[key]) > 1:
+                shared += size
+            else:
+                private += size
+        return shared, private